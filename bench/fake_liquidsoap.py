@@ -0,0 +1,114 @@
+# Stand-in for the Liquidsoap telnet server, for benchmarks and simulations.
+# Implements the commands radio_player sends and answers in Liquidsoap's format
+# (reply lines, then END). A fixed latency can be added to every reply, and
+# on_command(name, arg) is called for every command that is received. Queues are
+# only recorded here; playout (what plays when, skips) is up to the caller, see
+# next_source() and bench/simulate_day.py.
+import argparse
+import socketserver
+import threading
+import time
+from collections import Counter
+
+
+class FakeLiquidsoap:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.normal_queue = []
+        self.special_queue = []
+        self.jingle_queue = []
+        self.commands = Counter()
+        self.on_command = None
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode('utf-8', errors='replace').strip()
+                    if command == 'quit':
+                        self.wfile.write(b"Bye!\r\n")
+                        return
+                    reply = fake.handle(command)
+                    if fake.latency:
+                        time.sleep(fake.latency)
+                    self.wfile.write((reply + "\r\nEND\r\n").encode('utf-8'))
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def handle(self, command):
+        name, _, arg = command.partition(' ')
+        with self.lock:
+            self.commands[name] += 1
+            if name == 'get_normal_queue_length':
+                reply = str(len(self.normal_queue))
+            elif name == 'set_next_track':
+                self.normal_queue.append(arg)
+                reply = 'OK'
+            elif name in ('skip_track', 'skip_normal'):
+                reply = 'Done'
+            elif name == 'play_radio_show':
+                self.special_queue.append(arg)
+                reply = 'OK'
+            elif name == 'get_special_queue_contents':
+                reply = '\r\n'.join(self.special_queue)
+            elif name == 'play_jingle':
+                self.jingle_queue.append(arg)
+                reply = 'OK'
+            elif name == 'play_playlist':
+                reply = 'OK'
+            elif name == 'get_status':
+                reply = 'Status: OK'
+            else:
+                reply = f"ERROR: There is no such command: {name}"
+        if self.on_command is not None:
+            self.on_command(name, arg)
+        return reply
+
+    def next_source(self):
+        # Что заиграет следующим: special_queue, затем джинглы, затем normal_queue
+        with self.lock:
+            if self.special_queue:
+                return 'special', self.special_queue.pop(0)
+            if self.jingle_queue:
+                return 'jingle', self.jingle_queue.pop(0)
+            if self.normal_queue:
+                return 'normal', self.normal_queue.pop(0)
+        return None, None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.server.serve_forever, name='fake-liquidsoap', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Liquidsoap telnet server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every reply')
+    args = parser.parse_args()
+    fake = FakeLiquidsoap(args.host, args.port, args.latency).start()
+    print(f"Fake Liquidsoap listening on {fake.address[0]}:{fake.address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
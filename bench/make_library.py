@@ -0,0 +1,100 @@
+# Generates a synthetic SQLite track library for benchmarks and simulations.
+# Tables are created in the player's original (pre-migration) layout with
+# user_version 0, so radio_player migrates the file on first start exactly like
+# an old production database. Audio files are created empty: the player only
+# checks that they exist (the library scanner is disabled by the harness).
+import argparse
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+STYLES = ('dnb', 'jungle', 'dub', 'techno', 'ambient', 'breaks', 'house', 'electro')
+
+BASE_SCHEMA = [
+    """CREATE TABLE tracks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        path TEXT,
+        artist TEXT,
+        title TEXT,
+        track_title TEXT,
+        duration INTEGER,
+        path_img TEXT,
+        style TEXT,
+        track_info TEXT DEFAULT 'track',
+        status TEXT DEFAULT 'available',
+        playcount INTEGER DEFAULT 0,
+        upload_date TEXT
+    )""",
+    """CREATE TABLE schedule (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        track_path TEXT,
+        start_time TEXT,
+        enabled INTEGER DEFAULT 1,
+        queued INTEGER DEFAULT 0
+    )"""
+]
+
+
+def track_rows(count, music_dir, shows, rng):
+    # Артистов примерно в 8 раз меньше, чем треков; у некоторых артистов много треков
+    artists = [f"Artist {n}" for n in range(max(1, count // 8))]
+    now = datetime(2026, 1, 1)
+    for n in range(count):
+        is_show = n < shows
+        name = f"{'show' if is_show else 't'}{n:06d}.mp3"
+        path = os.path.join(music_dir, f"{n // 1000:03d}", name)
+        artist = rng.choice(artists[:max(1, len(artists) // 20)]) if rng.random() < 0.3 else rng.choice(artists)
+        title = f"Title {n}"
+        uploaded = now - timedelta(days=rng.randint(0, 3 * 365), seconds=rng.randint(0, 86399))
+        yield (
+            name,
+            path,
+            artist,
+            title if is_show else None,
+            title,
+            rng.randint(3000, 7200) if is_show else rng.randint(120, 480),
+            rng.choice(STYLES),
+            'radio_show' if is_show else 'track',
+            'unavailable' if rng.random() < 0.01 else 'available',
+            rng.randint(0, 50),
+            uploaded.strftime('%Y-%m-%dT%H:%M:%S')
+        )
+
+
+def make_library(db_path, count, music_dir, shows=0, seed=1, touch=True):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    for statement in BASE_SCHEMA:
+        conn.execute(statement)
+    rows = list(track_rows(count, music_dir, shows, rng))
+    conn.executemany("""
+        INSERT INTO tracks (name, path, artist, title, track_title, duration, style, track_info, status, playcount, upload_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+    if touch:
+        for row in rows:
+            path = row[1]
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'wb').close()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic radio_player track library')
+    parser.add_argument('db_path')
+    parser.add_argument('--tracks', type=int, default=1000)
+    parser.add_argument('--shows', type=int, default=0, help='how many of the tracks are radio shows')
+    parser.add_argument('--music-dir', default='bench_music')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-files', action='store_true', help='do not create the (empty) audio files')
+    args = parser.parse_args()
+    make_library(args.db_path, args.tracks, os.path.abspath(args.music_dir), args.shows, args.seed, not args.no_files)
+    print(f"Created {args.db_path} with {args.tracks} tracks")
@@ -0,0 +1,232 @@
+# Benchmarks for radio_player against the fake Liquidsoap and a generated library.
+# Each library size runs in its own child process: the child builds a scratch
+# environment, imports radio_player (which migrates the library and fills the
+# queue as on a real start) and times the hot paths. Results are JSON, and
+# --compare reports the change against an earlier run (exit code 1 on regression).
+#
+#   python bench/run_benchmarks.py --tracks 1000,100000 --output after.json --compare before.json
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLAYER_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'player')
+sys.path.insert(0, BENCH_DIR)
+
+from fake_liquidsoap import FakeLiquidsoap
+from make_library import make_library
+
+
+def player_environment(work_dir, telnet_port, log_level):
+    music_dir = os.path.join(work_dir, 'music')
+    env = {
+        'DB_PATH': os.path.join(work_dir, 'radio.db'),
+        'TELNET_HOST': '127.0.0.1',
+        'TELNET_PORT': str(telnet_port),
+        'LOGS_DIR': work_dir,
+        'LOG_FILE': 'radio_player.log',
+        'LOG_LEVEL': log_level,
+        'CURRENT_TRACK_FILE': os.path.join(work_dir, 'current_track.json'),
+        'LAST_PLAYED_TRACK_FILE': os.path.join(work_dir, 'last_played_track.txt'),
+        'PLAYBACK_HISTORY_FILE': os.path.join(work_dir, 'playback_history.txt'),
+        'TRACKS_DIR': music_dir,
+        'UPLOAD_TRACK_DIR': os.path.join(work_dir, 'upload_tracks'),
+        'UPLOAD_RADIO_DIR': os.path.join(work_dir, 'upload_radio'),
+        'IMAGES_DIR': os.path.join(work_dir, 'images') + '/',
+        # Сканер и фоновый анализ только мешали бы замерам
+        'LIBRARY_SCAN_ON_START': '0',
+        'LIBRARY_WATCH': '0',
+        'LIBRARY_POLL_INTERVAL': '0'
+    }
+    for key in ('UPLOAD_TRACK_DIR', 'UPLOAD_RADIO_DIR', 'IMAGES_DIR'):
+        os.makedirs(env[key], exist_ok=True)
+    return env, music_dir
+
+
+def summarize(name, samples, **extra):
+    samples = sorted(samples)
+    total = sum(samples)
+
+    def percentile(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return dict({
+        'name': name,
+        'iterations': len(samples),
+        'mean_ms': total / len(samples) * 1000,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': samples[-1] * 1000,
+        'ops_per_s': len(samples) / total if total else None
+    }, **extra)
+
+
+def measure(name, fn, iterations, warmup=10, **extra):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start_time)
+    return summarize(name, samples, **extra)
+
+
+def run_suite(tracks, iterations, client_counts, log_level):
+    work_dir = tempfile.mkdtemp(prefix='radio_bench_')
+    fake = FakeLiquidsoap().start()
+    env, music_dir = player_environment(work_dir, fake.address[1], log_level)
+    os.environ.update(env)
+    started = time.perf_counter()
+    rows = make_library(env['DB_PATH'], tracks, music_dir, shows=max(1, tracks // 100))
+    results = [summarize('generate_library', [time.perf_counter() - started], tracks=tracks, setup=True)]
+
+    started = time.perf_counter()
+    sys.path.insert(0, PLAYER_DIR)
+    import radio_player as rp
+    results.append(summarize('startup', [time.perf_counter() - started], tracks=tracks))
+    rp.loudness_analyzer.shutdown()
+    rp.cover_worker.shutdown()
+    logging.getLogger('apscheduler').setLevel(logging.ERROR)
+
+    available = [row[1] for row in rows if row[8] == 'available' and row[7] == 'track']
+    rng = random.Random(1)
+    client = rp.app.test_client()
+
+    results.append(measure('select_next_track', rp.select_next_track, iterations, tracks=tracks))
+
+    def track_callback():
+        client.post('/track', json={'filename': rng.choice(available), 'artist': 'a', 'title': 'b',
+                                    'normal_queue_length': 2, 'special_queue_length': 0, 'queue': 'normal'})
+    results.append(measure('track_callback', track_callback, iterations, tracks=tracks))
+
+    results.append(measure('tracks_listing', lambda: client.get('/tracks?limit=50'), iterations, tracks=tracks))
+    results.append(measure('tracks_search', lambda: client.get(f"/tracks?limit=50&q=Artist {rng.randint(0, tracks // 8)}"),
+                           iterations, tracks=tracks))
+
+    # От callback /track до set_next_track в Liquidsoap: выбор трека, планировщик и telnet вместе
+    refilled = threading.Event()
+    fake.on_command = lambda name, arg: refilled.set() if name == 'set_next_track' else None
+    samples = []
+    for _ in range(max(10, iterations // 10)):
+        # Предыдущее пополнение должно закончиться, иначе планировщик пропустит новое
+        while rp.scheduler.get_job('refill_event') is not None or rp.refill_lock.locked():
+            time.sleep(0.001)
+        with fake.lock:
+            del fake.normal_queue[1:]
+        refilled.clear()
+        start_time = time.perf_counter()
+        client.post('/track', json={'filename': rng.choice(available), 'artist': 'a', 'title': 'b',
+                                    'normal_queue_length': 1, 'special_queue_length': 0, 'queue': 'normal'})
+        if refilled.wait(5):
+            samples.append(time.perf_counter() - start_time)
+    fake.on_command = None
+    if samples:
+        results.append(summarize('track_change_to_refill', samples, tracks=tracks))
+
+    document = rp.get_now_playing_payload()['document']
+    for count in client_counts:
+        clients = [rp.socketio.test_client(rp.app) for _ in range(count)]
+        for sio in clients:
+            sio.get_received()
+        samples = []
+        for _ in range(max(5, iterations // 20)):
+            start_time = time.perf_counter()
+            rp.socketio.emit('track_update', document)
+            samples.append(time.perf_counter() - start_time)
+            # Каждый клиент должен получить событие; вычитываем вне замера
+            missing = sum(1 for sio in clients if not sio.get_received())
+            if missing:
+                raise RuntimeError(f"{missing} of {count} clients did not receive track_update")
+        for sio in clients:
+            sio.disconnect()
+        results.append(summarize('socketio_fanout', samples, tracks=tracks, clients=count))
+    fake.stop()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return (result['name'], result.get('tracks'), result.get('clients'))
+
+
+def compare(baseline, current, threshold):
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = 0
+    lines = [f"{'benchmark':<40} {'p50 before':>11} {'p50 after':>11} {'change':>8}"]
+    for result in current['results']:
+        old = previous.get(result_key(result))
+        if old is None or not old['p50_ms'] or result.get('setup'):
+            continue
+        change = (result['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100
+        label = result['name'] + ''.join(f" {key}={result[key]}" for key in ('tracks', 'clients') if result.get(key) is not None)
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        lines.append(f"{label:<40} {old['p50_ms']:>11.3f} {result['p50_ms']:>11.3f} {change:>+7.1f}%{flag}")
+    return '\n'.join(lines), regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='radio_player benchmarks')
+    parser.add_argument('--tracks', default='1000', help='comma-separated library sizes, e.g. 1000,100000,500000')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--clients', default='10,100,500', help='comma-separated Socket.IO client counts')
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='p50 slowdown in percent counted as a regression')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    client_counts = [int(count) for count in args.clients.split(',') if count]
+
+    if args.child:
+        with open(args.output, 'w') as f:
+            json.dump(run_suite(args.child, args.iterations, client_counts, args.log_level), f)
+        sys.exit(0)
+
+    # Каждый размер библиотеки — отдельный процесс: radio_player инициализируется при импорте
+    results = []
+    for tracks in (int(size) for size in args.tracks.split(',') if size):
+        with tempfile.NamedTemporaryFile(suffix='.json') as child_output:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--child', str(tracks),
+                                   '--iterations', str(args.iterations), '--clients', args.clients,
+                                   '--log-level', args.log_level, '--output', child_output.name])
+            results.extend(json.load(child_output))
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            table, regressions = compare(json.load(f), report, args.threshold)
+        print(table, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,334 @@
+# Replays a broadcast day on a virtual clock against the fake Liquidsoap.
+# radio_player runs unmodified except for its time sources: radio_player.clock
+# and radio_player.scheduler are replaced, and the schedule executor and the
+# control-job sequencer are driven through run_due() instead of their threads.
+# Playout follows tracks.duration: when a track ends the next one starts
+# (special queue, then jingles, then normal queue) and the /track callback is
+# posted as Liquidsoap would. The report covers show-start lateness, dead air,
+# repeat distance and rotation fairness.
+#
+#   python bench/simulate_day.py --tracks 5000 --shows 10:00,14:00,20:00 --skips 20 --output day.json
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import pytz
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLAYER_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'player')
+sys.path.insert(0, BENCH_DIR)
+
+from fake_liquidsoap import FakeLiquidsoap
+from make_library import make_library
+from run_benchmarks import player_environment
+
+ANNOTATE_RE = re.compile(r'^annotate:(?:[^:"]|"[^"]*")*:')
+
+
+class VirtualClock:
+    def __init__(self, start):
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self.current, tz)
+
+
+# Замена BackgroundScheduler из apscheduler: те же вызовы add_job() (немедленные, 'date' и
+# 'interval'), исполняемые на виртуальных часах.
+class VirtualScheduler:
+    def __init__(self, clock):
+        self.clock = clock
+        self.jobs = {}
+        self._seq = 0
+
+    def add_job(self, func, trigger=None, args=None, id=None, replace_existing=False, run_date=None, seconds=None, **kwargs):
+        self._seq += 1
+        if trigger == 'date':
+            due = run_date.timestamp()
+        elif trigger == 'interval':
+            due = self.clock.time() + seconds
+        else:
+            due = self.clock.time()
+        self.jobs[id or f"job-{self._seq}"] = {'func': func, 'args': args or [], 'due': due, 'interval': seconds if trigger == 'interval' else None}
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def next_due(self):
+        return min((job['due'] for job in self.jobs.values()), default=None)
+
+    def run_due(self):
+        ran = False
+        while True:
+            due = [(job['due'], job_id) for job_id, job in self.jobs.items() if job['due'] <= self.clock.time()]
+            if not due:
+                return ran
+            _, job_id = min(due)
+            job = self.jobs[job_id]
+            if job['interval']:
+                job['due'] += job['interval']
+            else:
+                del self.jobs[job_id]
+            job['func'](*job['args'])
+            ran = True
+
+    def shutdown(self, wait=False):
+        pass
+
+
+class Playout:
+    def __init__(self, fake, clock, client, library, jingle_duration):
+        self.fake = fake
+        self.clock = clock
+        self.client = client
+        self.library = library
+        self.jingle_duration = jingle_duration
+        self.current = None
+        self.dead_air_since = None
+        self.gaps = []
+        self.played = []
+        self._skips = []
+        self._lock = threading.Lock()
+        fake.on_command = self._on_command
+
+    def _on_command(self, name, arg):
+        if name in ('skip_track', 'skip_normal'):
+            with self._lock:
+                self._skips.append(name)
+
+    def next_due(self):
+        return self.current['ends'] if self.current else None
+
+    def update(self):
+        now = self.clock.time()
+        with self._lock:
+            skips, self._skips = self._skips, []
+        for name in skips:
+            # skip_normal пропускает только трек из normal_queue
+            if self.current and (name == 'skip_track' or self.current['source'] == 'normal'):
+                self.current['ends'] = now
+                self.current['skipped'] = True
+        if self.current and self.current['ends'] <= now:
+            self.current = None
+        if self.current is not None:
+            return False
+        source, uri = self.fake.next_source()
+        if source is None:
+            if self.dead_air_since is None:
+                self.dead_air_since = now
+            return False
+        if self.dead_air_since is not None:
+            self.gaps.append({'start': self.dead_air_since, 'seconds': now - self.dead_air_since})
+            self.dead_air_since = None
+        path = ANNOTATE_RE.sub('', uri)
+        track = self.library.get(path, {})
+        duration = self.jingle_duration if source == 'jingle' else (track.get('duration') or 180)
+        self.current = {'path': path, 'source': source, 'started': now, 'ends': now + duration, 'skipped': False}
+        self.played.append(self.current)
+        if source != 'jingle':
+            with self.fake.lock:
+                normal_length, special_length = len(self.fake.normal_queue), len(self.fake.special_queue)
+            self.client.post('/track', json={
+                'filename': path, 'artist': track.get('artist') or '', 'title': track.get('track_title') or '',
+                'normal_queue_length': normal_length, 'special_queue_length': special_length,
+                'timestamp': self.clock.now().strftime('%Y-%m-%dT%H:%M:%S'), 'queue': source
+            })
+        return True
+
+    def finish(self, end):
+        if self.dead_air_since is not None:
+            self.gaps.append({'start': self.dead_air_since, 'seconds': end - self.dead_air_since})
+
+
+def gini(values):
+    values = sorted(values)
+    total = sum(values)
+    if not values or not total:
+        return 0.0
+    weighted = sum((index + 1) * value for index, value in enumerate(values))
+    return (2 * weighted) / (len(values) * total) - (len(values) + 1) / len(values)
+
+
+def build_report(playout, library, shows, start, end, counts):
+    tracks = [item for item in playout.played if item['source'] == 'normal']
+    show_reports = []
+    for show in shows:
+        started = next((item['started'] for item in playout.played
+                        if item['source'] == 'special' and item['path'] == show['track_path']
+                        and item['started'] >= show['due'] - 60), None)
+        show_reports.append({
+            'track_path': show['track_path'],
+            'scheduled': show['scheduled'],
+            'lateness_s': round(started - show['due'], 1) if started is not None else None
+        })
+    lateness = [show['lateness_s'] for show in show_reports if show['lateness_s'] is not None]
+
+    positions = {}
+    distances = []
+    distance_seconds = []
+    for index, item in enumerate(tracks):
+        previous = positions.get(item['path'])
+        if previous is not None:
+            distances.append(index - previous[0])
+            distance_seconds.append(item['started'] - previous[1])
+        positions[item['path']] = (index, item['started'])
+    same_artist = sum(1 for a, b in zip(tracks, tracks[1:])
+                      if library.get(a['path'], {}).get('artist') and library.get(a['path'], {}).get('artist') == library.get(b['path'], {}).get('artist'))
+
+    eligible = [path for path, track in library.items() if track['status'] == 'available' and track['track_info'] == 'track']
+    plays = Counter(item['path'] for item in tracks)
+    style_plays = Counter(library[item['path']]['style'] for item in tracks if item['path'] in library)
+    style_library = Counter(library[path]['style'] for path in eligible)
+    artist_plays = Counter(library[item['path']]['artist'] for item in tracks if item['path'] in library)
+    gaps = playout.gaps
+    return {
+        'simulated_hours': round((end - start) / 3600, 2),
+        'tracks_played': len(tracks),
+        'shows_played': sum(1 for item in playout.played if item['source'] == 'special'),
+        'jingles_played': sum(1 for item in playout.played if item['source'] == 'jingle'),
+        'skipped': sum(1 for item in playout.played if item['skipped']),
+        'shows': show_reports,
+        'show_lateness': {
+            'missed': sum(1 for show in show_reports if show['lateness_s'] is None),
+            'max_s': max(lateness) if lateness else None,
+            'mean_s': round(statistics.mean(lateness), 1) if lateness else None
+        },
+        'dead_air': {
+            'gaps': len(gaps),
+            'total_s': round(sum(gap['seconds'] for gap in gaps), 1),
+            'longest_s': round(max((gap['seconds'] for gap in gaps), default=0), 1),
+            'first': [{'at': datetime.fromtimestamp(gap['start']).strftime('%H:%M:%S'), 'seconds': round(gap['seconds'], 1)}
+                      for gap in gaps[:20]]
+        },
+        'repeats': {
+            'count': len(distances),
+            'min_tracks': min(distances) if distances else None,
+            'median_tracks': statistics.median(distances) if distances else None,
+            'min_hours': round(min(distance_seconds) / 3600, 2) if distance_seconds else None,
+            'median_hours': round(statistics.median(distance_seconds) / 3600, 2) if distance_seconds else None
+        },
+        'fairness': {
+            'eligible_tracks': len(eligible),
+            'distinct_played': len(plays),
+            'coverage': round(len(plays) / len(eligible), 4) if eligible else None,
+            'max_plays_per_track': max(plays.values(), default=0),
+            'gini_played': round(gini(list(plays.values())), 4),
+            'same_artist_back_to_back': same_artist,
+            'top_artist_share': round(artist_plays.most_common(1)[0][1] / len(tracks), 4) if tracks else None,
+            'style_share_deviation': round(max((abs(style_plays[style] / len(tracks) - style_library[style] / len(eligible))
+                                                for style in style_library), default=0), 4) if tracks and eligible else None
+        },
+        'liquidsoap_commands': dict(counts)
+    }
+
+
+def simulate(args):
+    work_dir = tempfile.mkdtemp(prefix='radio_sim_')
+    fake = FakeLiquidsoap().start()
+    env, music_dir = player_environment(work_dir, fake.address[1], args.log_level)
+    os.environ.update(env)
+    make_library(env['DB_PATH'], args.tracks, music_dir, shows=max(10, len(args.shows)), seed=args.seed)
+    conn = sqlite3.connect(env['DB_PATH'])
+    conn.row_factory = sqlite3.Row
+    library = {row['path']: dict(row) for row in conn.execute("SELECT path, artist, track_title, duration, style, status, track_info FROM tracks")}
+    conn.close()
+    show_paths = [path for path, track in library.items() if track['track_info'] == 'radio_show' and track['status'] == 'available']
+
+    sys.path.insert(0, PLAYER_DIR)
+    import radio_player as rp
+    # Реальные часы и потоки останавливаем: дальше всё идёт по виртуальному времени
+    rp.scheduler.shutdown(wait=False)
+    rp.schedule_executor.stop()
+    rp.control_jobs.stop()
+    rp.loudness_analyzer.shutdown()
+    rp.cover_worker.shutdown()
+
+    tz = pytz.timezone('Europe/Moscow')
+    day = datetime.strptime(args.date, '%Y-%m-%d')
+    start = tz.localize(day).timestamp()
+    end = start + args.hours * 3600
+    clock = VirtualClock(start)
+    scheduler = VirtualScheduler(clock)
+    rp.clock = clock
+    rp.scheduler = scheduler
+    scheduler.add_job(rp.add_track_to_queue, 'interval', seconds=rp.REFILL_SAFETY_INTERVAL, id='refill_safety')
+    client = rp.app.test_client()
+    playout = Playout(fake, clock, client, library, args.jingle_duration)
+
+    shows = []
+    for index, show_time in enumerate(args.shows):
+        scheduled = f"{args.date}T{show_time}"
+        track_path = show_paths[index % len(show_paths)]
+        client.post('/schedule_play', json={'track_path': track_path, 'scheduled_time': scheduled})
+        shows.append({'track_path': track_path, 'scheduled': scheduled,
+                      'due': tz.localize(datetime.strptime(scheduled, '%Y-%m-%dT%H:%M')).timestamp()})
+
+    # Внешние события: пропуски в случайные моменты и джингл в начале каждого часа
+    rng = random.Random(args.seed)
+    external = [(start + rng.uniform(0, end - start), 'skip') for _ in range(args.skips)]
+    if args.jingle_every:
+        external += [(start + minute * 60, 'jingle') for minute in range(args.jingle_every, int((end - start) / 60), args.jingle_every)]
+    external.sort()
+
+    wall_started = time.perf_counter()
+    while clock.time() < end:
+        while external and external[0][0] <= clock.time():
+            _, kind = external.pop(0)
+            if kind == 'skip':
+                client.post('/smart_skip')
+            else:
+                client.post('/play_jingle', json={'jingle_path': '/jingles/station_id.mp3'})
+        # Всё, что должно произойти в этот момент, доводим до конца, прежде чем двигать часы
+        for _ in range(100):
+            progressed = scheduler.run_due()
+            rp.schedule_executor.run_due()
+            rp.control_jobs.run_due()
+            progressed = playout.update() or progressed
+            if not progressed and all(due is None or due > clock.time() for due in
+                                      (rp.schedule_executor.next_due(), rp.control_jobs.next_due(), scheduler.next_due())):
+                break
+        candidates = [due for due in (scheduler.next_due(), rp.schedule_executor.next_due(), rp.control_jobs.next_due(),
+                                      playout.next_due(), external[0][0] if external else None) if due is not None]
+        clock.current = max(clock.time() + 0.001, min(candidates + [end]))
+    playout.finish(end)
+    report = build_report(playout, library, shows, start, end, fake.commands)
+    report['wall_time_s'] = round(time.perf_counter() - wall_started, 2)
+    report['library_tracks'] = args.tracks
+    fake.stop()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a broadcast day of radio_player on a virtual clock')
+    parser.add_argument('--tracks', type=int, default=2000)
+    parser.add_argument('--date', default=datetime.now().strftime('%Y-%m-%d'), help='simulated day (Europe/Moscow)')
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--shows', default='10:00,14:00,20:00', help='comma-separated HH:MM start times of scheduled shows')
+    parser.add_argument('--skips', type=int, default=10, help='smart skips at random moments of the day')
+    parser.add_argument('--jingle-every', type=int, default=60, help='minutes between jingles, 0 to disable')
+    parser.add_argument('--jingle-duration', type=float, default=15)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+    args.shows = [show for show in args.shows.split(',') if show]
+    report = simulate(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,231 @@
+# Разбор медиафайлов (теги, громкость, обложки) в процессах пулов radio_player.
+# Отдельный модуль без побочных эффектов: forkserver пулов импортирует только его,
+# radio_player в рабочих процессах не загружается.
+import array
+import hashlib
+import io
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import wave
+
+import mutagen
+from PIL import Image
+
+def probe_audio_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    info = {'content_hash': digest.hexdigest(), 'duration': None, 'artist': None, 'title': None, 'error': None}
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as e:
+        info['error'] = str(e)
+        return info
+    if audio is None:
+        info['error'] = 'Unrecognized audio format'
+        return info
+    length = getattr(audio.info, 'length', None)
+    if length:
+        info['duration'] = int(round(length))
+    tags = audio.tags
+    if tags is not None:
+        for key in ('artist', 'title'):
+            try:
+                values = tags.get(key)
+            except Exception:
+                values = None
+            if values:
+                value = str(values[0] if isinstance(values, list) else values).strip()
+                info[key] = value or None
+    return info
+
+# Громкость (BS.1770 / EBU R128) и тишина в начале и конце трека.
+# Основной путь — ffmpeg (ebur128 + silencedetect за один проход); без ffmpeg
+# 16-битные WAV разбираются на чистом Python (без K-фильтра, для тестов и отладки).
+FFMPEG_BIN = shutil.which('ffmpeg')
+
+def analyze_audio_file(path, silence_db=-50.0, min_silence=0.5):
+    try:
+        if FFMPEG_BIN:
+            result = _analyze_ffmpeg(path, silence_db, min_silence)
+        elif path.lower().endswith('.wav'):
+            result = _analyze_pcm(path, silence_db, min_silence)
+        else:
+            return {'error': 'No decoder available (ffmpeg not installed)'}
+    except Exception as e:
+        return {'error': str(e)}
+    result['error'] = None
+    return result
+
+# Усиление до целевой громкости; вверх не больше max_gain и не выше потолка по пику
+def replay_gain(loudness, peak, target_lufs=-16.0, max_gain=10.0, peak_ceiling=-1.0):
+    if loudness is None:
+        return None
+    gain = min(max_gain, target_lufs - loudness)
+    if peak is not None and gain > 0:
+        gain = min(gain, max(0.0, peak_ceiling - peak))
+    return round(gain, 2)
+
+def _cue_points(silences, duration, min_silence):
+    cue_in = None
+    cue_out = None
+    for start, end in silences:
+        if start <= 0.05 and end - start >= min_silence:
+            cue_in = round(end, 3)
+        if duration and end >= duration - 0.05 and end - start >= min_silence and start > (cue_in or 0):
+            cue_out = round(start, 3)
+    # Трек целиком из тишины — не режем ничего
+    if cue_in is not None and duration and cue_in >= duration - min_silence:
+        cue_in = None
+    return cue_in, cue_out
+
+def _analyze_ffmpeg(path, silence_db, min_silence):
+    command = [FFMPEG_BIN, '-hide_banner', '-nostats', '-nostdin', '-i', path, '-vn',
+               '-af', f"ebur128=peak=true:framelog=quiet,silencedetect=noise={silence_db}dB:d={min_silence}",
+               '-f', 'null', '-']
+    output = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=3600).stderr
+    output = output.decode('utf-8', 'replace')
+    duration = None
+    match = re.search(r'Duration: (\d+):(\d+):([\d.]+)', output)
+    if match:
+        duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+    loudness = re.findall(r'I:\s+(-?[\d.]+|-inf) LUFS', output)
+    peak = re.findall(r'Peak:\s+(-?[\d.]+|-inf) dBFS', output)
+    silences = []
+    start = None
+    for kind, value in re.findall(r'silence_(start|end): (-?[\d.]+)', output):
+        if kind == 'start':
+            start = float(value)
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    if start is not None and duration:
+        silences.append((start, duration))
+    cue_in, cue_out = _cue_points(silences, duration, min_silence)
+    return {
+        'loudness': float(loudness[-1]) if loudness and loudness[-1] != '-inf' else None,
+        'peak': float(peak[-1]) if peak and peak[-1] != '-inf' else None,
+        'cue_in': cue_in,
+        'cue_out': cue_out,
+        'duration': duration,
+        'method': 'ffmpeg'
+    }
+
+def _analyze_pcm(path, silence_db, min_silence):
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError('Only 16-bit PCM WAV is supported without ffmpeg')
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        block_frames = max(1, rate // 10)
+        powers = []
+        peak = 0
+        while True:
+            frames = wav.readframes(block_frames)
+            if not frames:
+                break
+            samples = array.array('h', frames)
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            peak = max(peak, max(samples), -min(samples))
+            powers.append(sum(sample * sample for sample in samples) / (len(samples) * 32768.0 * 32768.0) * channels)
+    duration = len(powers) / 10.0
+    # 400 мс окна с шагом 100 мс, абсолютный порог -70 LUFS и относительный -10 LU
+    windows = [sum(powers[i:i + 4]) / 4 for i in range(max(1, len(powers) - 3))] if powers else []
+    gated = [power for power in windows if power > 0 and -0.691 + 10 * math.log10(power) > -70]
+    loudness = None
+    if gated:
+        relative = -0.691 + 10 * math.log10(sum(gated) / len(gated)) - 10
+        gated = [power for power in gated if -0.691 + 10 * math.log10(power) > relative]
+        loudness = round(-0.691 + 10 * math.log10(sum(gated) / len(gated)), 2)
+    threshold = 10 ** (silence_db / 10)
+    loud = [i for i, power in enumerate(powers) if power / channels > threshold]
+    silences = []
+    if loud:
+        if loud[0] > 0:
+            silences.append((0.0, loud[0] / 10.0))
+        if loud[-1] + 1 < len(powers):
+            silences.append(((loud[-1] + 1) / 10.0, duration))
+    elif powers:
+        silences.append((0.0, duration))
+    cue_in, cue_out = _cue_points(silences, duration, min_silence)
+    return {
+        'loudness': loudness,
+        'peak': round(20 * math.log10(peak / 32768.0), 2) if peak else None,
+        'cue_in': cue_in,
+        'cue_out': cue_out,
+        'duration': duration,
+        'method': 'pcm'
+    }
+
+# Обложка, встроенная в теги: APIC (ID3), METADATA_BLOCK_PICTURE (FLAC/Ogg), covr (MP4)
+def extract_embedded_cover(path):
+    audio = mutagen.File(path)
+    if audio is None:
+        return None
+    pictures = getattr(audio, 'pictures', None)
+    if pictures:
+        # Тип 3 — лицевая сторона обложки
+        front = [picture for picture in pictures if picture.type == 3]
+        return (front or pictures)[0].data
+    tags = audio.tags
+    if tags is None:
+        return None
+    if hasattr(tags, 'getall'):
+        frames = tags.getall('APIC')
+        if frames:
+            front = [frame for frame in frames if frame.type == 3]
+            return (front or frames)[0].data
+    covers = tags.get('covr') if hasattr(tags, 'get') else None
+    if covers:
+        return bytes(covers[0])
+    return None
+
+def cover_file_name(cover_hash, size, fmt):
+    return f"{cover_hash}-{size}.{'jpg' if fmt == 'jpeg' else fmt}"
+
+# Производные обложки фиксированных размеров (WebP и JPEG); имя файла — хэш исходных байтов,
+# поэтому файлы неизменяемы и готовые повторно не пересчитываются
+def render_cover_derivatives(image_path, audio_path, out_dir, sizes=(96, 300, 800), webp_quality=80, jpeg_quality=85):
+    try:
+        if image_path:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        else:
+            data = extract_embedded_cover(audio_path)
+            if not data:
+                return {'hash': None, 'error': None}
+        cover_hash = hashlib.sha256(data).hexdigest()[:20]
+        names = [(size, fmt, os.path.join(out_dir, cover_file_name(cover_hash, size, fmt)))
+                 for size in sizes for fmt in ('webp', 'jpeg')]
+        if all(os.path.exists(path) for _, _, path in names):
+            return {'hash': cover_hash, 'error': None}
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        if image.mode not in ('RGB', 'L'):
+            background = Image.new('RGB', image.size, (0, 0, 0))
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').split()[-1])
+            image = background
+        elif image.mode == 'L':
+            image = image.convert('RGB')
+        os.makedirs(out_dir, exist_ok=True)
+        for size, fmt, path in names:
+            if os.path.exists(path):
+                continue
+            derivative = image.copy()
+            # Меньшие исходники не растягиваем
+            derivative.thumbnail((size, size), Image.LANCZOS)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            if fmt == 'webp':
+                derivative.save(tmp_path, 'WEBP', quality=webp_quality, method=4)
+            else:
+                derivative.save(tmp_path, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+        return {'hash': cover_hash, 'width': image.width, 'height': image.height, 'error': None}
+    except Exception as e:
+        return {'hash': None, 'error': str(e)}
@@ -0,0 +1,251 @@
+# Несколько процессов radio_player на одной машине: шина Socket.IO через UNIX-сокет
+# и запуск рабочих процессов.
+#
+#   python cluster.py --workers 4 --port 5001
+#
+# Процесс N слушает порт --port + N. Все процессы подключены к шине, поэтому emit
+# из любого процесса доходит до клиентов всех процессов. Плейаутом (Liquidsoap,
+# расписание, пополнение очереди, сканер) занимается один лидер. Лидер выбирается
+# по lockf (fcntl.lockf) на LEADER_LOCK_FILE, см. LeaderElection в radio_player.py.
+import argparse
+import logging
+import os
+import pickle
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import socketio
+from dotenv import load_dotenv
+
+logger = logging.getLogger('cluster')
+
+FRAME_HEADER = struct.Struct('!I')
+ROLE_PUBLISH = b'P'
+ROLE_SUBSCRIBE = b'S'
+
+def read_frames(sock):
+    buffer = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return
+        buffer += chunk
+        while len(buffer) >= FRAME_HEADER.size:
+            (size,) = FRAME_HEADER.unpack_from(buffer)
+            if len(buffer) < FRAME_HEADER.size + size:
+                break
+            yield buffer[FRAME_HEADER.size:FRAME_HEADER.size + size]
+            buffer = buffer[FRAME_HEADER.size + size:]
+
+def connect(path, role, socket_module=socket):
+    sock = socket_module.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(role)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+# Широковещательный узел шины. Каждый кадр издателя копируется всем подписчикам, включая
+# отправителя: старые версии python-socketio доставляют emit локально, только когда он
+# возвращается из очереди. Подписчик, не читающий SEND_TIMEOUT секунд, отключается и
+# переподключается.
+class BusHub:
+    SEND_TIMEOUT = 5
+
+    def __init__(self, path):
+        self.path = path
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        hub = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                role = self.request.recv(1)
+                if role == ROLE_SUBSCRIBE:
+                    hub._subscribe(self.request)
+                elif role == ROLE_PUBLISH:
+                    for payload in read_frames(self.request):
+                        hub.broadcast(payload)
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = Server(path, Handler)
+        os.chmod(path, 0o600)
+        self._thread = None
+
+    def _subscribe(self, sock):
+        sock.settimeout(self.SEND_TIMEOUT)
+        with self._lock:
+            self._subscribers[sock] = threading.Lock()
+        try:
+            # Подписчик ничего не пишет; ждём закрытия соединения
+            while True:
+                try:
+                    if not sock.recv(1):
+                        break
+                except socket.timeout:
+                    continue
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._subscribers.pop(sock, None)
+
+    def broadcast(self, payload):
+        frame = FRAME_HEADER.pack(len(payload)) + payload
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for sock, send_lock in subscribers:
+            try:
+                with send_lock:
+                    sock.sendall(frame)
+            except OSError as e:
+                logger.warning(f"Dropping bus subscriber: {str(e)}")
+                with self._lock:
+                    self._subscribers.pop(sock, None)
+                sock.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='bus-hub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Клиентский менеджер python-socketio поверх BusHub (unix:///path/to/bus.sock). Публикация идёт
+# через блокирующий сокет под блокировкой, потому что emit вызывается и из потоков
+# планировщика, и из гринлетов; слушатель работает как фоновая задача Socket.IO и использует
+# сокеты gevent, когда сервер запущен под gevent.
+class UnixSocketManager(socketio.PubSubManager):
+    name = 'unix'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        self.path = url[len('unix://'):]
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        frame = pickle.dumps(data)
+        frame = FRAME_HEADER.pack(len(frame)) + frame
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = connect(self.path, ROLE_PUBLISH)
+                    self._publisher.sendall(frame)
+                    return
+                except OSError:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                        self._publisher = None
+                    if attempt:
+                        raise
+
+    def _socket_module(self):
+        if self.server is not None and self.server.async_mode.startswith('gevent'):
+            from gevent import socket as gevent_socket
+            return gevent_socket
+        return socket
+
+    def _listen(self):
+        socket_module = self._socket_module()
+        while True:
+            try:
+                sock = connect(self.path, ROLE_SUBSCRIBE, socket_module)
+            except OSError as e:
+                self._get_logger().warning(f"Socket.IO bus {self.path} unavailable: {str(e)}")
+                self.server.sleep(1)
+                continue
+            try:
+                for payload in read_frames(sock):
+                    yield pickle.loads(payload)
+            except OSError as e:
+                self._get_logger().warning(f"Socket.IO bus connection lost: {str(e)}")
+            finally:
+                sock.close()
+            self.server.sleep(1)
+
+def create_bus_manager(url, on_emit=None, channel='flask-socketio'):
+    # Тот же выбор бэкенда по схеме URL, что и у Flask-SocketIO, плюс unix://
+    if url.startswith('unix://'):
+        base = UnixSocketManager
+    elif url.startswith(('redis://', 'rediss://')):
+        base = socketio.RedisManager
+    else:
+        base = socketio.KombuManager
+
+    class BusManager(base):
+        def _handle_emit(self, message):
+            if on_emit is not None:
+                try:
+                    on_emit(message)
+                except Exception:
+                    self._get_logger().exception('Error in Socket.IO bus emit hook')
+            super()._handle_emit(message)
+
+    return BusManager(url, channel=channel)
+
+def run_workers(workers, port, bus_path, lock_path, restart_delay=2):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'radio_player.py')
+    hub = BusHub(bus_path).start()
+    env = dict(os.environ, SOCKETIO_MESSAGE_QUEUE=f"unix://{bus_path}", LEADER_LOCK_FILE=lock_path)
+    stopping = threading.Event()
+
+    def spawn(worker_id):
+        logger.info(f"Starting worker {worker_id} on port {port + worker_id}")
+        return subprocess.Popen([sys.executable, script], cwd=os.path.dirname(script),
+                                env=dict(env, HTTP_PORT=str(port + worker_id), WORKER_ID=str(worker_id)))
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    processes = {worker_id: spawn(worker_id) for worker_id in range(workers)}
+    try:
+        while not stopping.wait(1):
+            for worker_id, process in list(processes.items()):
+                if process.poll() is not None:
+                    logger.error(f"Worker {worker_id} exited with code {process.returncode}, restarting in {restart_delay}s")
+                    time.sleep(restart_delay)
+                    processes[worker_id] = spawn(worker_id)
+    finally:
+        # SIGTERM: воркер останавливает HTTP-сервер и при выходе дописывает отложенные события воспроизведения
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.time() + 10
+        for process in processes.values():
+            try:
+                process.wait(max(0.1, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        hub.stop()
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    parser = argparse.ArgumentParser(description='Run several radio_player processes with a shared Socket.IO bus')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_WORKERS', os.cpu_count() or 2)))
+    parser.add_argument('--port', type=int, default=int(os.getenv('HTTP_PORT', 5001)), help='port of worker 0; worker N listens on port + N')
+    parser.add_argument('--bus', default=os.getenv('SOCKETIO_BUS_SOCKET', os.path.join(tempfile.gettempdir(), 'vtrnk_radio_bus.sock')))
+    parser.add_argument('--lock', default=os.getenv('LEADER_LOCK_FILE') or (os.getenv('DB_PATH', 'radio') + '.leader'))
+    args = parser.parse_args()
+    run_workers(args.workers, args.port, args.bus, args.lock)
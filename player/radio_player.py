@@ -1,26 +1,66 @@
-from flask import Flask, jsonify, request, Response
+from flask import Flask, jsonify, request, Response, stream_with_context, g
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
 import sqlite3
 import json
 import logging
 import logging.handlers
-import telnetlib
+import asyncio
 import threading
 import time
 import os
+import sys
+import socket
 from dotenv import load_dotenv
 import random
+import bisect
+import heapq
+import atexit
+import copy
+import hashlib
+import base64
+import errno
+import re
+import shutil
+import uuid
+import select
+import signal
+import struct
+import fcntl
+import http.client
+import ctypes
+import ctypes.util
+import multiprocessing
+import importlib.machinery
+from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 import pytz
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import concurrent.futures.process
+from collections import deque, OrderedDict, namedtuple
+from types import MappingProxyType
+from contextlib import contextmanager
+from functools import lru_cache
+from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from audio_probe import (probe_audio_file, analyze_audio_file, replay_gain, render_cover_derivatives,
+                         cover_file_name, FFMPEG_BIN)
+from cluster import create_bus_manager
 
 load_dotenv()  # Загружает .env
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Шина Socket.IO между процессами (см. cluster.py): unix:///путь/к/bus.sock, redis://... или amqp://...;
+# пусто — один процесс без шины
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+socketio_options = {}
+if SOCKETIO_MESSAGE_QUEUE:
+    # track_update с шины запоминается: ведомый процесс отдаёт его в /now_playing и при подключении
+    socketio_options['client_manager'] = create_bus_manager(SOCKETIO_MESSAGE_QUEUE, on_emit=lambda message: mirror_bus_emit(message))
+socketio = SocketIO(app, cors_allowed_origins="*", **socketio_options)
 
 # Очередь для хранения обновлений
 updates = Queue()
@@ -31,20 +71,121 @@ logger.setLevel(logging.INFO)
 log_dir = os.getenv('LOGS_DIR')
 log_file = os.getenv('LOG_FILE')
 log_path = os.path.join(log_dir, log_file) if log_dir and log_file else '/home/beasty197/projects/vtrnk_radio/logs/radio_player.log'  # Дефолт на случай отсутствия .env
-handler = logging.handlers.RotatingFileHandler(
+# Формат записей (json или text), уровень по умолчанию и по подсистемам ("liquidsoap=WARNING,library=DEBUG"),
+# лимит записей с одного места вызова за окно (сек), доля записей опросов (1 из N) и длина очереди записей
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = dict(item.split('=', 1) for item in os.getenv('LOG_LEVELS', '').replace(' ', '').split(',') if '=' in item)
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 30))
+LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', 60))
+LOG_POLL_SAMPLE = int(os.getenv('LOG_POLL_SAMPLE', 10))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+# Один JSON-объект на строку. Поля из extra={...} пишутся как есть,
+# рядом с подсистемой (имя дочернего логгера), потоком и отформатированным исключением.
+class JsonLogFormatter(logging.Formatter):
+    RESERVED = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'subsystem': record.name.split('.', 1)[1] if '.' in record.name else 'app',
+            'msg': record.getMessage(),
+            'thread': record.threadName
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Отсекает записи до постановки в очередь. Место вызова с extra={'sample': N} пишет каждую
+# N-ю запись; место, выдавшее больше LOG_RATE_LIMIT записей за LOG_RATE_WINDOW, молчит до конца
+# окна, и первая прошедшая после этого запись несёт число подавленных.
+class LogThrottle(logging.Filter):
+    def __init__(self, rate_limit, window):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = {'seen': 0, 'count': 0, 'suppressed': 0, 'window_start': record.created}
+            site['seen'] += 1
+            sample = getattr(record, 'sample', None)
+            if sample and (site['seen'] - 1) % sample:
+                return False
+            if record.created - site['window_start'] >= self.window:
+                site['window_start'] = record.created
+                site['count'] = 0
+            site['count'] += 1
+            if self.rate_limit and site['count'] > self.rate_limit:
+                site['suppressed'] += 1
+                return False
+            if site['suppressed']:
+                record.suppressed = site['suppressed']
+                site['suppressed'] = 0
+        return True
+
+# Вызывающий поток только форматирует сообщение и кладёт запись в очередь;
+# запись на диск и ротация — в потоке QueueListener. При переполнении запись теряется, но не блокирует
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+file_handler = logging.handlers.RotatingFileHandler(
     filename=log_path,
     maxBytes=5*1024*1024,
     backupCount=5
 )
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-
-# Фильтр для исключения DEBUG-логов
-class NoDebugFilter(logging.Filter):
-    def filter(self, record):
-        return record.levelno > logging.DEBUG
-handler.addFilter(NoDebugFilter())
+if LOG_FORMAT == 'json':
+    file_handler.setFormatter(JsonLogFormatter())
+else:
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+log_queue = Queue(LOG_QUEUE_SIZE)
+handler = LogQueueHandler(log_queue)
+handler.addFilter(LogThrottle(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
 logger.addHandler(handler)
+logger.setLevel(LOG_LEVEL)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+log_listener.start()
+# Регистрируется первым, значит при выходе останавливается последним и дописывает очередь
+atexit.register(log_listener.stop)
+
+# Логгеры подсистем: уровень каждой задаётся через LOG_LEVELS
+liquidsoap_log = logger.getChild('liquidsoap')
+db_log = logger.getChild('db')
+library_log = logger.getChild('library')
+upload_log = logger.getChild('upload')
+schedule_log = logger.getChild('schedule')
+jobs_log = logger.getChild('jobs')
+for subsystem, level in LOG_LEVELS.items():
+    logger.getChild(subsystem).setLevel(level.upper())
 
 # Параметры Telnet для Liquidsoap (из .env)
 TELNET_HOST = os.getenv('TELNET_HOST', '127.0.0.1')
@@ -58,233 +199,2136 @@ CURRENT_TRACK_FILE = os.getenv('CURRENT_TRACK_FILE')
 LAST_PLAYED_TRACK_FILE = os.getenv('LAST_PLAYED_TRACK_FILE')
 PLAYBACK_HISTORY_FILE = os.getenv('PLAYBACK_HISTORY_FILE')
 
-# Максимальное количество треков в истории
-MAX_HISTORY_SIZE = 30
+# Максимальное количество треков в истории (окно без повторов)
+MAX_HISTORY_SIZE = int(os.getenv('MAX_HISTORY_SIZE', 30))
+# Через сколько дописываний файл истории переписывается целиком
+PLAYBACK_HISTORY_COMPACT_EVERY = int(os.getenv('PLAYBACK_HISTORY_COMPACT_EVERY', 100))
+
+# Отложенная запись событий воспроизведения: размер пачки и максимальная задержка сброса
+PLAY_WRITER_BATCH_SIZE = int(os.getenv('PLAY_WRITER_BATCH_SIZE', 50))
+PLAY_WRITER_FLUSH_INTERVAL = float(os.getenv('PLAY_WRITER_FLUSH_INTERVAL', 1.0))
 
 # Режим воспроизведения
 playback_mode = "random"
 
-# Переменная для хранения next_track
-next_track = None
-
 # Задержка между командами
 COMMAND_DELAY = 2
+# Сколько завершённых управляющих заданий хранить для /jobs
+CONTROL_JOB_KEEP = int(os.getenv('CONTROL_JOB_KEEP', 200))
+
+# Пополнение normal_queue: целевая глубина, упреждение до конца трека и страховочный опрос
+REFILL_TARGET_DEPTH = int(os.getenv('REFILL_TARGET_DEPTH', 2))
+REFILL_PREFETCH_SECONDS = int(os.getenv('REFILL_PREFETCH_SECONDS', 30))
+REFILL_SAFETY_INTERVAL = int(os.getenv('REFILL_SAFETY_INTERVAL', 120))
+
+# Треки, отправленные в normal_queue, но ещё не начавшие играть
+recently_queued = deque(maxlen=REFILL_TARGET_DEPTH + 1)
+refill_lock = threading.Lock()
+
+# Ротация: число кандидатов и веса (свежесть, разнообразие стилей, разнос артистов)
+ROTATION_CANDIDATES = int(os.getenv('ROTATION_CANDIDATES', 20))
+ROTATION_FRESHNESS_WEIGHT = float(os.getenv('ROTATION_FRESHNESS_WEIGHT', 1.0))
+ROTATION_FRESHNESS_HALF_LIFE_DAYS = float(os.getenv('ROTATION_FRESHNESS_HALF_LIFE_DAYS', 30))
+ROTATION_STYLE_WEIGHT = float(os.getenv('ROTATION_STYLE_WEIGHT', 0.5))
+ROTATION_STYLE_WINDOW = int(os.getenv('ROTATION_STYLE_WINDOW', 3))
+ROTATION_ARTIST_SEPARATION = int(os.getenv('ROTATION_ARTIST_SEPARATION', 3))
+# Фиксированный seed делает выбор воспроизводимым (для тестов)
+ROTATION_SEED = os.getenv('ROTATION_SEED')
+
+# Расписание: окно запуска после start_time, число попыток и страховочная перезагрузка
+SCHEDULE_WINDOW_MINUTES = int(os.getenv('SCHEDULE_WINDOW_MINUTES', 5))
+SCHEDULE_ATTEMPTS = int(os.getenv('SCHEDULE_ATTEMPTS', 3))
+SCHEDULE_RELOAD_INTERVAL = int(os.getenv('SCHEDULE_RELOAD_INTERVAL', 300))
+
+# Long-poll для /now_playing: максимальное ожидание и шаг проверки версии
+NOW_PLAYING_LONG_POLL_TIMEOUT = float(os.getenv('NOW_PLAYING_LONG_POLL_TIMEOUT', 25))
+NOW_PLAYING_LONG_POLL_STEP = float(os.getenv('NOW_PLAYING_LONG_POLL_STEP', 0.25))
+# Как часто рассыльщик track_update проверяет версию состояния (изменения внутри интервала склеиваются)
+NOW_PLAYING_BROADCAST_INTERVAL = float(os.getenv('NOW_PLAYING_BROADCAST_INTERVAL', 0.25))
+
+# Список треков: максимальный размер страницы и колонки полнотекстового поиска
+TRACKS_PAGE_MAX = int(os.getenv('TRACKS_PAGE_MAX', 500))
+TRACKS_FTS_COLUMNS = ('artist', 'track_title', 'title', 'name')
+tracks_fts_available = False
+
+# SQLite: путь к базе, ожидание снятия блокировки (с), размер пула читателей,
+# кэш подготовленных выражений на соединение и число повторов записи при блокировке
+DB_PATH = os.getenv('DB_PATH')
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 5))
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', 4))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 256))
+DB_LOCK_RETRIES = int(os.getenv('DB_LOCK_RETRIES', 5))
+
+# Кэш ответов /styles, /schedule, /db_schema и /track_duration: максимум записей (0 — выключен)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 512))
+
+# Загрузки: каталог незавершённых загрузок, лимит размера файла, рекомендуемый размер
+# чанка для клиента, блок записи на диск, срок жизни брошенных загрузок и число процессов разбора
+UPLOAD_TMP_DIR = os.getenv('UPLOAD_TMP_DIR', os.path.join(os.getenv('UPLOAD_RADIO_DIR', '/tmp'), '.uploads'))
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+UPLOAD_BLOCK_SIZE = int(os.getenv('UPLOAD_BLOCK_SIZE', 1024 * 1024))
+UPLOAD_EXPIRE_SECONDS = int(os.getenv('UPLOAD_EXPIRE_SECONDS', 86400))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))
+# Тип загрузки -> (переменная окружения с каталогом, допустимые расширения); тип пишется в track_info
+UPLOAD_KINDS = {
+    'track': ('UPLOAD_TRACK_DIR', ('.mp3', '.wav', '.flac')),
+    'radio_show': ('UPLOAD_RADIO_DIR', ('.mp3',))
+}
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_SIZE
+
+# Сканер библиотеки: расширения аудиофайлов, размер пачки записи, сканирование при старте,
+# слежение через inotify (с паузой debounce) и интервал опроса, если inotify недоступен
+LIBRARY_EXTENSIONS = tuple(ext.strip().lower() for ext in os.getenv('LIBRARY_EXTENSIONS', '.mp3,.wav,.flac,.ogg,.m4a').split(',') if ext.strip())
+LIBRARY_SCAN_BATCH = int(os.getenv('LIBRARY_SCAN_BATCH', 500))
+LIBRARY_SCAN_ON_START = os.getenv('LIBRARY_SCAN_ON_START', '1') == '1'
+LIBRARY_WATCH = os.getenv('LIBRARY_WATCH', '1') == '1'
+LIBRARY_WATCH_DEBOUNCE = float(os.getenv('LIBRARY_WATCH_DEBOUNCE', 2))
+LIBRARY_POLL_INTERVAL = int(os.getenv('LIBRARY_POLL_INTERVAL', 300))
+
+# Анализ громкости: целевая громкость (LUFS), максимальное усиление и потолок по пику (дБ),
+# порог и минимальная длина тишины для cue-точек, процессы, размер пачки, пауза между проверками
+LOUDNESS_TARGET_LUFS = float(os.getenv('LOUDNESS_TARGET_LUFS', -16))
+LOUDNESS_MAX_GAIN = float(os.getenv('LOUDNESS_MAX_GAIN', 10))
+LOUDNESS_PEAK_CEILING = float(os.getenv('LOUDNESS_PEAK_CEILING', -1))
+LOUDNESS_SILENCE_DB = float(os.getenv('LOUDNESS_SILENCE_DB', -50))
+LOUDNESS_MIN_SILENCE = float(os.getenv('LOUDNESS_MIN_SILENCE', 0.5))
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', 1))
+ANALYSIS_BATCH = int(os.getenv('ANALYSIS_BATCH', 20))
+ANALYSIS_INTERVAL = int(os.getenv('ANALYSIS_INTERVAL', 60))
+# Передавать ли Liquidsoap annotate:-URI с liq_amplify/liq_cue_in/liq_cue_out
+LIQUIDSOAP_ANNOTATE = os.getenv('LIQUIDSOAP_ANNOTATE', '1') == '1'
+
+# Обложки: каталог картинок, каталог и URL производных, размеры (px), размер для cover_path,
+# процессы, размер пачки и пауза между проверками
+IMAGES_DIR = os.getenv('IMAGES_DIR', '/home/beasty197/projects/vtrnk_radio/images/')
+COVERS_DIR = os.path.join(IMAGES_DIR, 'covers')
+COVERS_URL = '/images/covers'
+COVER_SIZES = tuple(int(size) for size in os.getenv('COVER_SIZES', '96,300,800').split(','))
+COVER_DEFAULT_SIZE = int(os.getenv('COVER_DEFAULT_SIZE', 300))
+COVER_WORKERS = int(os.getenv('COVER_WORKERS', 1))
+COVER_BATCH = int(os.getenv('COVER_BATCH', 20))
+COVER_INTERVAL = int(os.getenv('COVER_INTERVAL', 60))
+
+# Несколько процессов: HTTP-порт и номер этого процесса, файл блокировки лидера (пусто — один процесс,
+# он всегда лидер), пауза между попытками стать лидером и таймаут пересылки запроса лидеру
+HTTP_PORT = int(os.getenv('HTTP_PORT', 5001))
+WORKER_ID = os.getenv('WORKER_ID', '0')
+LEADER_LOCK_FILE = os.getenv('LEADER_LOCK_FILE', '')
+LEADER_RETRY_INTERVAL = float(os.getenv('LEADER_RETRY_INTERVAL', 2))
+LEADER_PROXY_TIMEOUT = float(os.getenv('LEADER_PROXY_TIMEOUT', 60))
 
 # Блокировка для предотвращения дублирования
 last_played_track_lock = threading.Lock()
 
-def get_db():
-    db_path = os.getenv('DB_PATH')
+# Параметры постоянного подключения к Liquidsoap
+LIQUIDSOAP_POOL_SIZE = int(os.getenv('LIQUIDSOAP_POOL_SIZE', 2))
+LIQUIDSOAP_COMMAND_TIMEOUT = float(os.getenv('LIQUIDSOAP_COMMAND_TIMEOUT', 5))
+# Liquidsoap закрывает простаивающие telnet-сессии (settings.server.timeout, 30s по умолчанию)
+LIQUIDSOAP_IDLE_TIMEOUT = float(os.getenv('LIQUIDSOAP_IDLE_TIMEOUT', 25))
+LIQUIDSOAP_MAX_BACKOFF = float(os.getenv('LIQUIDSOAP_MAX_BACKOFF', 30))
+
+# Как работает управляющая часть: threads — потоки и BackgroundScheduler; asyncio — один цикл событий
+# (клиент Liquidsoap на asyncio, расписание и пополнение очереди — задачи цикла), а синхронная работа
+# с SQLite уходит в отдельный пул из DB_EXECUTOR_WORKERS потоков
+RUNTIME = os.getenv('RUNTIME', 'threads')
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 4))
+
+# Источник времени для логики эфира (пополнение, ротация, расписание, управляющие задания).
+# bench/simulate_day.py подставляет виртуальные часы, чтобы прогнать сутки за секунды.
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def now(self, tz=None):
+        return datetime.now(tz)
+
+clock = SystemClock()
+
+# Куча таймеров, которую обслуживает один поток: колбэки ставятся со сроком по часам модуля
+# и выполняются в порядке сроков. run_due()/next_due() позволяют симулятору гонять ту же логику
+# на виртуальных часах после того, как stop() остановил поток.
+class TimerLoop:
+    name = 'timer-loop'
+
+    def __init__(self, log):
+        self.log = log
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = 0
+        self._thread = None
+        self._stopped = False
+        # Будит задачу цикла событий при новом сроке (RUNTIME=asyncio)
+        self.waker = None
+
+    def now(self):
+        return clock.time()
+
+    def _push(self, due, callback, *args):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (due, self._seq, callback, args))
+            self._cond.notify()
+        if self.waker is not None:
+            self.waker()
+
+    def _start_thread(self):
+        # В режиме asyncio сроки ждёт задача control_loop, а не собственный поток
+        if control_loop is not None:
+            self._stopped = False
+            control_loop.spawn(self.name, control_loop.drive, self)
+        elif self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def next_due(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def run_due(self):
+        while True:
+            with self._cond:
+                if not self._heap or self._heap[0][0] > self.now():
+                    return
+                due, _, callback, args = heapq.heappop(self._heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log.error(f"Error in {self.name} ({callback.__name__}): {str(e)}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._heap or self._heap[0][0] > self.now()):
+                    timeout = self._heap[0][0] - self.now() if self._heap else None
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+            self.run_due()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if control_loop is not None:
+            control_loop.cancel(self.name)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+# Асинхронный режим (RUNTIME=asyncio): один цикл событий в своём потоке исполняет клиент
+# Liquidsoap, таймерные циклы выше (как задачи) и задания пополнения AsyncIOScheduler.
+# Синхронная работа (SQLite, выбор трека, колбэки таймеров) уходит в отдельный пул потоков,
+# назначенный исполнителем цикла по умолчанию, поэтому на самом цикле ничего не блокируется.
+# Потоки и гринлеты обращаются к циклу через call(). stop() отменяет задачи, выполняет
+# обработчики завершения и закрывает пул.
+class ControlLoop:
+    MONITOR_INTERVAL = 1.0
+
+    def __init__(self, db_workers):
+        self.loop = asyncio.new_event_loop()
+        self.db_executor = ThreadPoolExecutor(db_workers, thread_name_prefix='db')
+        self.loop.set_default_executor(self.db_executor)
+        self._tasks = {}
+        self._shutdown_hooks = []
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='control-loop', daemon=True)
+            self._thread.start()
+            self.spawn('loop-monitor', self._monitor)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _monitor(self):
+        # Опоздание пробуждения = время, на которое кто-то занял цикл блокирующим вызовом
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.MONITOR_INTERVAL)
+            control_loop_lag.observe(max(0.0, self.loop.time() - started - self.MONITOR_INTERVAL))
+
+    def call(self, coro, timeout=None):
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError('ControlLoop.call() inside the event loop would deadlock, await the coroutine instead')
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            # Гринлет gevent не должен держать хаб, пока ждёт ответа: проверяем готовность короткими socketio.sleep
+            if socketio.async_mode == 'gevent' and threading.current_thread() is threading.main_thread():
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not future.done():
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError(f"Control loop call timed out after {timeout}s")
+                    socketio.sleep(0.005)
+            return future.result(timeout)
+        except (TimeoutError, concurrent.futures.TimeoutError):
+            # Зависшая корутина отменяется, иначе она так и держала бы соединение из пула
+            future.cancel()
+            raise
+
+    async def run_db(self, fn, *args):
+        return await self.loop.run_in_executor(self.db_executor, fn, *args)
+
+    def spawn(self, name, coro_fn, *args):
+        def create():
+            task = self._tasks.get(name)
+            if task is None or task.done():
+                self._tasks[name] = self.loop.create_task(coro_fn(*args), name=name)
+        self.loop.call_soon_threadsafe(create)
+
+    def cancel(self, name):
+        def cancel_task():
+            task = self._tasks.pop(name, None)
+            if task is not None:
+                task.cancel()
+        self.loop.call_soon_threadsafe(cancel_task)
+
+    def add_shutdown_hook(self, coro_fn):
+        self._shutdown_hooks.append(coro_fn)
+
+    async def drive(self, timer):
+        wakeup = asyncio.Event()
+        timer.waker = lambda: self.loop.call_soon_threadsafe(wakeup.set)
+        try:
+            while True:
+                wakeup.clear()
+                due = timer.next_due()
+                if due is not None and due <= timer.now():
+                    # Обработчики синхронные (SQLite, команды Liquidsoap через call) — в пуле
+                    await self.run_db(timer.run_due)
+                    continue
+                try:
+                    await asyncio.wait_for(wakeup.wait(), None if due is None else due - timer.now())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            timer.waker = None
+
+    async def _shutdown(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for hook in reversed(self._shutdown_hooks):
+            try:
+                await hook()
+            except Exception as e:
+                logger.error(f"Error in control loop shutdown hook: {str(e)}")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(10)
+        except Exception as e:
+            logger.error(f"Error stopping control loop: {str(e)}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        self._thread = None
+        self.db_executor.shutdown(wait=False)
+
+control_loop = ControlLoop(DB_EXECUTOR_WORKERS) if RUNTIME == 'asyncio' else None
+
+# In-process metrics rendered in the Prometheus text format (no client library).
+# Values are keyed by label tuples; a gauge can instead be backed by a callback
+# evaluated at scrape time. Everything is per process and resets on restart.
+def format_metric_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{format_metric_labels(self.labelnames, labels)} {value}" for labels, value in items]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        if self.callback is None:
+            return super().render()
+        value = self.callback()
+        return self.header() + ([] if value is None else [f"{self.name} {value}"])
+
+class Histogram(Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # Счётчик по корзине + сумма; накопительные значения считаются при выдаче
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted((labels, list(entry)) for labels, entry in self._values.items())
+        lines = self.header()
+        names = self.labelnames + ('le',)
+        for labels, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{format_metric_labels(names, labels + (le,))} {cumulative}")
+            suffix = format_metric_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {entry[-1]:.6f}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self._add(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+liquidsoap_command_seconds = metrics.histogram('radio_liquidsoap_command_seconds', 'Liquidsoap telnet command latency', ('command',))
+liquidsoap_command_errors = metrics.counter('radio_liquidsoap_command_errors_total', 'Failed or timed out Liquidsoap commands', ('command',))
+http_request_seconds = metrics.histogram('radio_http_request_seconds', 'HTTP request latency per route', ('route', 'method'))
+http_requests_total = metrics.counter('radio_http_requests_total', 'HTTP requests per route and status', ('route', 'method', 'status'))
+db_query_seconds = metrics.histogram('radio_db_query_seconds', 'SQLite statement execution time (without fetching rows)', ('statement',),
+                                     buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+track_selection_seconds = metrics.histogram('radio_track_selection_seconds', 'Time to pick the next track')
+queue_refill_seconds = metrics.histogram('radio_queue_refill_seconds', 'Time to top up normal_queue (selection and Liquidsoap commands)')
+queue_depth = metrics.gauge('radio_queue_length', 'Last known Liquidsoap queue length', ('queue',))
+track_callback_at = None
+track_callback_age = metrics.gauge('radio_seconds_since_track_callback', 'Seconds since the last /track callback from Liquidsoap',
+                                   callback=lambda: round(time.time() - track_callback_at, 3) if track_callback_at else None)
+websocket_clients = metrics.gauge('radio_websocket_clients', 'Connected Socket.IO clients')
+broadcast_seconds = metrics.histogram('radio_broadcast_seconds', 'Socket.IO broadcast fan-out time', ('event',))
+schedule_attempts = metrics.counter('radio_schedule_attempts_total', 'Scheduled show insertion attempts by outcome', ('result',))
+control_job_seconds = metrics.histogram('radio_control_job_seconds', 'Control job run time including step delays', ('kind',),
+                                        buckets=(0.1, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0))
+log_records_dropped = metrics.gauge('radio_log_records_dropped', 'Log records dropped because the log queue was full',
+                                  callback=lambda: handler.dropped)
+leader_state = metrics.gauge('radio_leader', '1 if this process owns Liquidsoap and background duties',
+                             callback=lambda: int(leader_election.is_leader))
+leader_proxy_seconds = metrics.histogram('radio_leader_proxy_seconds', 'Requests forwarded from a follower process to the leader')
+control_loop_lag = metrics.histogram('radio_control_loop_lag_seconds', 'Event loop wake-up delay in RUNTIME=asyncio (time the loop was blocked)',
+                                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+control_jobs_coalesced = metrics.counter('radio_control_jobs_coalesced_total', 'Control jobs merged into an unfinished job', ('kind',))
+response_cache_requests = metrics.counter('radio_response_cache_requests_total', 'Cached endpoint lookups by result', ('endpoint', 'result'))
+response_cache_entries = metrics.gauge('radio_response_cache_entries', 'Responses held in the response cache',
+                                       callback=lambda: len(response_cache))
+
+# Метка запроса для radio_db_query_seconds: команда и таблица, без параметров и списков IN (...)
+SQL_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?(?!(?:ON|OF)\b)([A-Za-z_][A-Za-z0-9_]*)', re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def sql_statement_label(sql):
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else ''
+    match = SQL_TABLE_RE.search(sql)
+    return f"{verb} {match.group(1)}" if match else verb
+
+# Какую таблицу меняет выражение: для DDL — sqlite_master, для записи без
+# распознанной таблицы — '*' (сбрасывает все поколения), для чтения — None
+SQL_WRITE_VERBS = frozenset(('INSERT', 'REPLACE', 'UPDATE', 'DELETE'))
+SQL_SCHEMA_VERBS = frozenset(('CREATE', 'ALTER', 'DROP'))
+
+@lru_cache(maxsize=1024)
+def sql_written_table(sql):
+    verb, _, table = sql_statement_label(sql).partition(' ')
+    if verb in SQL_SCHEMA_VERBS:
+        return 'sqlite_master'
+    if verb in SQL_WRITE_VERBS:
+        return table or '*'
+    return None
+
+# Поколения записи по таблицам для кэша ответов. Каждое соединение собирает таблицы, которые
+# меняют его запросы; когда соединение выходит из транзакции (после COMMIT или запроса в
+# autocommit), их поколения увеличиваются. Пишет только лидер, поэтому ведомый процесс этих
+# увеличений не видит: он опрашивает PRAGMA data_version на отдельном соединении и при любом
+# чужом коммите увеличивает общую эпоху. Процесс, только что ставший лидером, делает последний
+# опрос, чтобы не пропустить коммиты прежнего лидера.
+class TableGenerations:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._generations = {}
+        self._epoch = 0
+        self._probe = None
+        self._data_version = None
+
+    def written(self, conn, sql):
+        table = sql_written_table(sql)
+        if table is not None:
+            conn.written_tables.add(table)
+        if conn.written_tables and not conn.in_transaction:
+            tables, conn.written_tables = conn.written_tables, set()
+            self.bump(*tables)
+
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    def _check_external(self):
+        with self._probe_lock:
+            try:
+                if self._probe is None:
+                    self._probe = get_db(read_only=True)
+                version = self._probe.execute("PRAGMA data_version").fetchone()[0]
+            except Exception as e:
+                db_log.warning("data_version probe failed: %s", e)
+                version = None
+            if version is None or version != self._data_version:
+                self._data_version = version
+                with self._lock:
+                    self._epoch += 1
+            if (version is None or leader_election.is_leader) and self._probe is not None:
+                self._probe.close()
+                self._probe = None
+
+    def snapshot(self, tables):
+        if not leader_election.is_leader or self._probe is not None:
+            self._check_external()
+        with self._lock:
+            return (self._epoch, self._generations.get('*', 0)) + tuple(self._generations.get(table, 0) for table in tables)
+
+table_generations = TableGenerations()
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start_time, sql_statement_label(sql))
+            table_generations.written(self.connection, sql)
+
+    def executemany(self, sql, seq_of_parameters):
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start_time, sql_statement_label(sql))
+            table_generations.written(self.connection, sql)
+
+# Connection.execute() создаёт курсор в обход cursor(), поэтому переопределены оба пути
+class TimedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Таблицы, изменённые в текущей транзакции, см. TableGenerations
+        self.written_tables = set()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class LiquidsoapError(Exception):
+    pass
+
+# Общая часть клиентов Liquidsoap: экспоненциальная задержка переподключения и статистика по
+# командам. Протокол — строки telnet; каждый ответ заканчивается строкой "END", поэтому
+# многострочные ответы читаются целиком, а несколько команд можно отправить разом и прочитать
+# ответы по порядку.
+class LiquidsoapClientBase:
+    END_MARKER = "END"
+
+    def __init__(self, host, port, pool_size=2, timeout=5.0, idle_timeout=25.0, max_backoff=30.0):
+        self.host = host
+        self.port = port
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_backoff = max_backoff
+        self._backoff_lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0.0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'commands': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'total_time': 0.0,
+            'max_time': 0.0,
+            'last_time': 0.0,
+            'by_command': {}
+        }
+
+    def _check_backoff(self):
+        with self._backoff_lock:
+            wait = self._retry_at - time.time()
+        if wait > 0:
+            raise LiquidsoapError(f"Liquidsoap unavailable, next connection attempt in {wait:.1f}s")
+
+    def _connect_failed(self, error):
+        with self._backoff_lock:
+            self._failures += 1
+            delay = min(self.max_backoff, 2 ** (self._failures - 1))
+            self._retry_at = time.time() + delay
+        liquidsoap_log.error(f"Cannot connect to Liquidsoap at {self.host}:{self.port}: {str(error)}, retry in {delay:.0f}s")
+        return LiquidsoapError(str(error) or error.__class__.__name__)
+
+    def _connect_succeeded(self):
+        with self._backoff_lock:
+            self._failures = 0
+            self._retry_at = 0.0
+        with self._stats_lock:
+            self._stats['connects'] += 1
+
+    def _reconnecting(self, error):
+        # Сессия протухла на стороне Liquidsoap — переподключаемся один раз
+        liquidsoap_log.warning(f"Liquidsoap connection lost ({str(error)}), reconnecting")
+        with self._stats_lock:
+            self._stats['reconnects'] += 1
+
+    @staticmethod
+    def _payload(commands):
+        return ''.join(f"{command}\n" for command in commands).encode('utf-8')
+
+    def _record(self, commands, elapsed, error=None):
+        with self._stats_lock:
+            stats = self._stats
+            stats['commands'] += len(commands)
+            stats['total_time'] += elapsed
+            stats['last_time'] = elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if error is not None:
+                stats['errors'] += 1
+                if isinstance(error, (socket.timeout, asyncio.TimeoutError)):
+                    stats['timeouts'] += 1
+            for command in commands:
+                name = command.split(' ', 1)[0]
+                liquidsoap_command_seconds.observe(elapsed / len(commands), name)
+                if error is not None:
+                    liquidsoap_command_errors.inc(name)
+                entry = stats['by_command'].setdefault(name, {'count': 0, 'errors': 0, 'total_time': 0.0, 'max_time': 0.0})
+                entry['count'] += 1
+                entry['total_time'] += elapsed / len(commands)
+                entry['max_time'] = max(entry['max_time'], elapsed)
+                if error is not None:
+                    entry['errors'] += 1
+
+    def _failed(self, commands, start_time, error):
+        self._record(commands, time.time() - start_time, error)
+        if isinstance(error, LiquidsoapError):
+            return error
+        return LiquidsoapError(str(error) or error.__class__.__name__)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats['by_command'] = {name: dict(entry) for name, entry in self._stats['by_command'].items()}
+        stats['avg_time'] = stats['total_time'] / stats['commands'] if stats['commands'] else 0.0
+        return stats
+
+# Долгоживущие блокирующие сессии с Liquidsoap, общие для всех потоков (обычные сокеты;
+# telnetlib удалён в Python 3.13).
+class LiquidsoapClient(LiquidsoapClientBase):
+    def __init__(self, host, port, pool_size=2, timeout=5.0, idle_timeout=25.0, max_backoff=30.0):
+        super().__init__(host, port, pool_size, timeout, idle_timeout, max_backoff)
+        self._pool = Queue()
+        for _ in range(self.pool_size):
+            self._pool.put({'sock': None, 'buffer': b'', 'last_used': 0.0})
+
+    def _open(self, conn):
+        self._check_backoff()
+        try:
+            conn['sock'] = socket.create_connection((self.host, self.port), self.timeout)
+        except OSError as e:
+            raise self._connect_failed(e)
+        conn['buffer'] = b''
+        self._connect_succeeded()
+
+    def _close(self, conn):
+        sock = conn['sock']
+        conn['sock'] = None
+        if sock is None:
+            return
+        try:
+            sock.settimeout(0.5)
+            sock.sendall(b"quit\n")
+        except Exception:
+            pass
+        try:
+            sock.close()
+        except Exception:
+            pass
+
+    def _read_line(self, conn, deadline):
+        while b"\n" not in conn['buffer']:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Liquidsoap command timed out")
+            conn['sock'].settimeout(remaining)
+            chunk = conn['sock'].recv(4096)
+            if not chunk:
+                raise EOFError("Liquidsoap closed the connection")
+            conn['buffer'] += chunk
+        line, conn['buffer'] = conn['buffer'].split(b"\n", 1)
+        return line.decode('utf-8', errors='replace').rstrip('\r')
+
+    def _read_reply(self, conn, deadline):
+        lines = []
+        while True:
+            try:
+                line = self._read_line(conn, deadline)
+            except EOFError:
+                # Обрыв посреди ответа повторять нельзя: команда могла уже выполниться
+                if lines or conn['buffer']:
+                    raise socket.timeout("Liquidsoap closed the connection mid-reply")
+                raise
+            if line == self.END_MARKER:
+                return '\n'.join(lines).strip()
+            lines.append(line)
+
+    def _exchange(self, conn, commands, timeout):
+        conn['sock'].settimeout(timeout)
+        conn['sock'].sendall(self._payload(commands))
+        deadline = time.time() + timeout
+        return [self._read_reply(conn, deadline) for _ in commands]
+
+    def pipeline(self, commands, timeout=None):
+        if not commands:
+            return []
+        timeout = timeout or self.timeout
+        conn = self._pool.get()
+        start_time = time.time()
+        try:
+            if conn['sock'] is not None and start_time - conn['last_used'] > self.idle_timeout:
+                self._close(conn)
+            reused = conn['sock'] is not None
+            if not reused:
+                self._open(conn)
+            try:
+                responses = self._exchange(conn, commands, timeout)
+            except (EOFError, ConnectionError) as e:
+                self._close(conn)
+                if not reused:
+                    raise
+                self._reconnecting(e)
+                self._open(conn)
+                responses = self._exchange(conn, commands, timeout)
+            conn['last_used'] = time.time()
+            self._record(commands, conn['last_used'] - start_time)
+            return responses
+        except Exception as e:
+            # После ошибки или таймаута поток ответов рассинхронизирован, сессию не переиспользуем
+            self._close(conn)
+            raise self._failed(commands, start_time, e) from e
+        finally:
+            self._pool.put(conn)
+
+    def command(self, command, timeout=None):
+        return self.pipeline([command], timeout)[0]
+
+    def close(self):
+        for _ in range(self._pool.qsize()):
+            conn = self._pool.get()
+            self._close(conn)
+            self._pool.put(conn)
+
+# Те же сессии на потоках asyncio, для RUNTIME=asyncio. Корутины должны выполняться на
+# control_loop; остальные потоки идут через liquidsoap_command() и liquidsoap_pipeline(),
+# которые передают вызов в цикл и ждут результата.
+class AsyncLiquidsoapClient(LiquidsoapClientBase):
+    def __init__(self, host, port, pool_size=2, timeout=5.0, idle_timeout=25.0, max_backoff=30.0):
+        super().__init__(host, port, pool_size, timeout, idle_timeout, max_backoff)
+        self._pool = None
+
+    def _get_pool(self):
+        # Очередь создаётся уже в цикле событий, при первой команде
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+            for _ in range(self.pool_size):
+                self._pool.put_nowait({'reader': None, 'writer': None, 'last_used': 0.0})
+        return self._pool
+
+    async def _open(self, conn):
+        self._check_backoff()
+        try:
+            conn['reader'], conn['writer'] = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise self._connect_failed(e)
+        self._connect_succeeded()
+
+    def _close(self, conn):
+        writer = conn['writer']
+        conn['reader'] = conn['writer'] = None
+        if writer is None:
+            return
+        try:
+            writer.write(b"quit\n")
+            writer.close()
+        except Exception:
+            pass
+
+    async def _read_reply(self, reader):
+        lines = []
+        while True:
+            data = await reader.readline()
+            if not data.endswith(b"\n"):
+                if not data and not lines:
+                    raise EOFError("Liquidsoap closed the connection")
+                raise socket.timeout("Liquidsoap closed the connection mid-reply")
+            line = data.decode('utf-8', errors='replace').rstrip('\r\n')
+            if line == self.END_MARKER:
+                return '\n'.join(lines).strip()
+            lines.append(line)
+
+    async def _exchange(self, conn, commands, timeout):
+        conn['writer'].write(self._payload(commands))
+        reader = conn['reader']
+
+        async def replies():
+            await conn['writer'].drain()
+            return [await self._read_reply(reader) for _ in commands]
+
+        return await asyncio.wait_for(replies(), timeout)
+
+    async def pipeline(self, commands, timeout=None):
+        if not commands:
+            return []
+        timeout = timeout or self.timeout
+        pool = self._get_pool()
+        conn = await pool.get()
+        start_time = time.time()
+        try:
+            if conn['writer'] is not None and start_time - conn['last_used'] > self.idle_timeout:
+                self._close(conn)
+            reused = conn['writer'] is not None
+            if not reused:
+                await self._open(conn)
+            try:
+                responses = await self._exchange(conn, commands, timeout)
+            except (EOFError, ConnectionError) as e:
+                self._close(conn)
+                if not reused:
+                    raise
+                self._reconnecting(e)
+                await self._open(conn)
+                responses = await self._exchange(conn, commands, timeout)
+            conn['last_used'] = time.time()
+            self._record(commands, conn['last_used'] - start_time)
+            return responses
+        except asyncio.CancelledError:
+            self._close(conn)
+            raise
+        except Exception as e:
+            self._close(conn)
+            raise self._failed(commands, start_time, e) from e
+        finally:
+            pool.put_nowait(conn)
+
+    async def command(self, command, timeout=None):
+        return (await self.pipeline([command], timeout))[0]
+
+    async def close(self):
+        if self._pool is None:
+            return
+        for _ in range(self._pool.qsize()):
+            conn = self._pool.get_nowait()
+            self._close(conn)
+            self._pool.put_nowait(conn)
+
+liquidsoap_client = (AsyncLiquidsoapClient if RUNTIME == 'asyncio' else LiquidsoapClient)(
+    TELNET_HOST,
+    TELNET_PORT,
+    pool_size=LIQUIDSOAP_POOL_SIZE,
+    timeout=LIQUIDSOAP_COMMAND_TIMEOUT,
+    idle_timeout=LIQUIDSOAP_IDLE_TIMEOUT,
+    max_backoff=LIQUIDSOAP_MAX_BACKOFF
+)
+
+def get_db(read_only=False):
     try:
-        conn = sqlite3.connect(db_path)
+        # isolation_level=None: транзакции открываются явно (BEGIN IMMEDIATE у писателя)
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, isolation_level=None, factory=TimedConnection,
+                               check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
         return conn
     except Exception as e:
-        logger.error(f"Error connecting to database at {db_path}: {str(e)}")
+        db_log.error("Error connecting to database at %s: %s", DB_PATH, e)
         raise
 
-def liquidsoap_command(command):
+def is_lock_error(e):
+    message = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+# Соединения SQLite на весь процесс. Читатели берутся из ограниченного набора свободных
+# соединений query_only (выдача не блокируется: если все заняты, открывается лишнее соединение
+# и закрывается при возврате). Все записи идут через одно соединение под блокировкой, каждая
+# в своей транзакции BEGIN IMMEDIATE.
+class SQLitePool:
+    def __init__(self, read_size=4, lock_retries=5, retry_delay=0.1):
+        self.read_size = max(1, read_size)
+        self.lock_retries = lock_retries
+        self.retry_delay = retry_delay
+        self._idle = Queue()
+        self._readers = 0
+        self._readers_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'read_checkouts': 0,
+            'read_overflow': 0,
+            'read_wait_time': 0.0,
+            'read_wait_max': 0.0,
+            'write_checkouts': 0,
+            'write_wait_time': 0.0,
+            'write_wait_max': 0.0,
+            'lock_retries': 0,
+            'lock_failures': 0,
+            'rollbacks': 0,
+            'connections_opened': 0
+        }
+
+    def _record(self, kind, waited):
+        with self._stats_lock:
+            self._stats[f'{kind}_checkouts'] += 1
+            self._stats[f'{kind}_wait_time'] += waited
+            self._stats[f'{kind}_wait_max'] = max(self._stats[f'{kind}_wait_max'], waited)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _open(self, read_only):
+        conn = get_db(read_only)
+        self._count('connections_opened')
+        return conn
+
+    def acquire_read(self):
+        start_time = time.time()
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = self._open(True)
+            with self._readers_lock:
+                self._readers += 1
+                if self._readers > self.read_size:
+                    self._count('read_overflow')
+        self._record('read', time.time() - start_time)
+        return conn
+
+    def release_read(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._idle.qsize() < self.read_size:
+                self._idle.put(conn)
+                return
+        except Exception:
+            pass
+        with self._readers_lock:
+            self._readers -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def read(self):
+        conn = self.acquire_read()
+        try:
+            yield conn
+        finally:
+            self.release_read(conn)
+
+    def _writer_conn(self):
+        if self._writer is None:
+            self._writer = self._open(False)
+            # journal_mode сохраняется в файле базы: читатели WAL не блокируют писателя
+            self._writer.execute("PRAGMA journal_mode=WAL")
+        return self._writer
+
+    def _begin(self, conn):
+        attempt = 0
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if not is_lock_error(e) or attempt >= self.lock_retries:
+                    if is_lock_error(e):
+                        self._count('lock_failures')
+                    raise
+                attempt += 1
+                self._count('lock_retries')
+                db_log.warning("Database locked, retrying write (%s/%s)", attempt, self.lock_retries)
+                time.sleep(self.retry_delay * (2 ** (attempt - 1)))
+
+    @contextmanager
+    def write(self):
+        start_time = time.time()
+        with self._writer_lock:
+            self._record('write', time.time() - start_time)
+            # Вложенный write() выполняется внутри уже открытой транзакции
+            if self._writer_depth:
+                self._writer_depth += 1
+                try:
+                    yield self._writer
+                finally:
+                    self._writer_depth -= 1
+                return
+            conn = self._writer_conn()
+            self._begin(conn)
+            self._writer_depth = 1
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                self._count('rollbacks')
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    self._writer = None
+                    conn.close()
+                raise
+            finally:
+                self._writer_depth = 0
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._readers_lock:
+            stats['readers_open'] = self._readers
+        stats['readers_idle'] = self._idle.qsize()
+        stats['read_size'] = self.read_size
+        stats['read_avg_wait'] = stats['read_wait_time'] / stats['read_checkouts'] if stats['read_checkouts'] else 0.0
+        stats['write_avg_wait'] = stats['write_wait_time'] / stats['write_checkouts'] if stats['write_checkouts'] else 0.0
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            with self._readers_lock:
+                self._readers -= 1
+            conn.close()
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+db_pool = SQLitePool(DB_READ_POOL_SIZE, DB_LOCK_RETRIES)
+
+# Версионированные миграции схемы; номер применённой версии хранится в PRAGMA user_version.
+# Каждая миграция выполняется в своей транзакции; при ошибке цепочка останавливается.
+SCHEMA_MIGRATIONS = [
+    (1, "Base tables", [
+        """CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            path TEXT,
+            artist TEXT,
+            title TEXT,
+            track_title TEXT,
+            duration INTEGER,
+            path_img TEXT,
+            style TEXT,
+            track_info TEXT DEFAULT 'track',
+            status TEXT DEFAULT 'available',
+            playcount INTEGER DEFAULT 0,
+            upload_date TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS schedule (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            track_path TEXT,
+            start_time TEXT,
+            enabled INTEGER DEFAULT 1,
+            queued INTEGER DEFAULT 0
+        )"""
+    ]),
+    (2, "Indexes for hot queries", [
+        "CREATE INDEX IF NOT EXISTS idx_tracks_name ON tracks(name)",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_listing ON tracks(status, COALESCE(upload_date, ''), id)",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_info_listing ON tracks(status, track_info, COALESCE(upload_date, ''), id)",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_status_style ON tracks(status, style)",
+        "CREATE INDEX IF NOT EXISTS idx_schedule_pending ON schedule(enabled, queued)",
+        "CREATE INDEX IF NOT EXISTS idx_schedule_track_path ON schedule(track_path, queued)"
+    ]),
+    # Уникальный индекс по path создаёт ensure_unique_path_index(): при дубликатах он не
+    # создастся, а остальные миграции от него не зависят и не должны вставать
+    (3, "Unique path (see ensure_unique_path_index)", []),
+    (4, "Content hash for upload dedup", [
+        "ALTER TABLE tracks ADD COLUMN content_hash TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_content_hash ON tracks(content_hash)"
+    ]),
+    (5, "File fingerprints for the library scanner", [
+        "ALTER TABLE tracks ADD COLUMN file_size INTEGER",
+        "ALTER TABLE tracks ADD COLUMN file_mtime INTEGER",
+        "ALTER TABLE tracks ADD COLUMN file_inode INTEGER"
+    ]),
+    (6, "Loudness and cue points", [
+        "ALTER TABLE tracks ADD COLUMN loudness_lufs REAL",
+        "ALTER TABLE tracks ADD COLUMN peak_db REAL",
+        "ALTER TABLE tracks ADD COLUMN cue_in REAL",
+        "ALTER TABLE tracks ADD COLUMN cue_out REAL",
+        "ALTER TABLE tracks ADD COLUMN analyzed_at TEXT",
+        "ALTER TABLE tracks ADD COLUMN analysis_error TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_tracks_unanalyzed ON tracks(id) WHERE analyzed_at IS NULL"
+    ]),
+    (7, "Cover art derivatives", [
+        "ALTER TABLE tracks ADD COLUMN cover_hash TEXT",
+        "ALTER TABLE tracks ADD COLUMN cover_source TEXT",
+        "ALTER TABLE tracks ADD COLUMN cover_error TEXT"
+    ])
+]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Пока в tracks есть дубликаты path, индекс не создаётся; попытка повторяется при каждом запуске
+def ensure_unique_path_index():
+    try:
+        with db_pool.write() as conn:
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tracks_path ON tracks(path)")
+    except sqlite3.IntegrityError:
+        with db_pool.read() as conn:
+            duplicates = conn.execute("SELECT path, COUNT(*) FROM tracks GROUP BY path HAVING COUNT(*) > 1").fetchall()
+        db_log.error(f"Unique index on tracks.path blocked by {len(duplicates)} duplicated paths, e.g. {[row[0] for row in duplicates[:5]]}")
+    except Exception as e:
+        db_log.error(f"Error creating unique index on tracks.path: {str(e)}")
+
+def run_migrations():
     try:
-        command = command.encode('utf-8').decode('utf-8')
+        with db_pool.read() as conn:
+            current = get_schema_version(conn)
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            try:
+                with db_pool.write() as conn:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                db_log.info(f"Applied schema migration {version}: {description}")
+            except Exception as e:
+                db_log.error(f"Schema migration {version} ({description}) failed: {str(e)}")
+                break
+        ensure_unique_path_index()
+        with db_pool.read() as conn:
+            db_log.info(f"Database schema version: {get_schema_version(conn)}")
+    except Exception as e:
+        db_log.error(f"Error running schema migrations: {str(e)}")
+
+# Запросы горячего пути для отчёта EXPLAIN QUERY PLAN (/db_query_plans)
+HOT_QUERIES = [
+    ('catalog_by_path', "SELECT * FROM tracks WHERE path = ?", ('',)),
+    ('catalog_new_rows', "SELECT * FROM tracks WHERE id > ?", (0,)),
+    ('catalog_by_name', "SELECT * FROM tracks WHERE name = ?", ('',)),
+    ('playcount_update', "UPDATE tracks SET playcount = playcount + ? WHERE path = ?", (1, '')),
+    ('update_style', "UPDATE tracks SET style = ? WHERE name = ?", ('', '')),
+    ('track_duration', "SELECT duration FROM tracks WHERE name = ?", ('',)),
+    ('tracks_listing', "SELECT * FROM tracks WHERE status = ? ORDER BY COALESCE(upload_date, '') DESC, id DESC LIMIT ?", ('available', 50)),
+    ('tracks_listing_radio_show', "SELECT * FROM tracks WHERE status = ? AND track_info = 'radio_show' ORDER BY COALESCE(upload_date, '') DESC, id DESC LIMIT ?", ('available', 50)),
+    ('styles', "SELECT style, COUNT(*) as count FROM tracks WHERE status = 'available' GROUP BY style", ()),
+    ('schedule_pending', "SELECT * FROM schedule WHERE enabled = 1 AND queued = 0", ()),
+    ('schedule_special_started', "UPDATE schedule SET queued = 0 WHERE track_path = ? AND queued = 1", ('',))
+]
+
+# Копия таблицы tracks на весь процесс с индексами по path, id и name.
+# Загружается один раз при старте; эндпоинты записи обновляют ровно те строки, которые изменили.
+class TrackCatalog:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_path = {}
+        self._by_id = {}
+        self._by_name = {}
+        self._missing = set()
+        self._max_id = 0
+        self._listeners = []
+
+    # listener(path, track): track равен None при удалении, path равен None после полной перезагрузки
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, path, track):
+        for listener in self._listeners:
+            try:
+                listener(path, track)
+            except Exception as e:
+                logger.error("Error in track catalog listener: %s", e)
+
+    def _index(self, track, notify=True):
+        path = track.get('path')
+        if not path:
+            return
+        old = self._by_path.get(path)
+        if old is not None:
+            self._unindex(old, notify=False)
+        self._by_path[path] = track
+        self._missing.discard(path)
+        if track.get('id') is not None:
+            self._by_id[track['id']] = track
+            self._max_id = max(self._max_id, track['id'])
+        if track.get('name'):
+            self._by_name.setdefault(track['name'], track)
+        if notify:
+            self._notify(path, track)
+
+    def _unindex(self, track, notify=True):
+        self._by_path.pop(track.get('path'), None)
+        if self._by_id.get(track.get('id')) is track:
+            del self._by_id[track['id']]
+        if self._by_name.get(track.get('name')) is track:
+            del self._by_name[track['name']]
+        if notify:
+            self._notify(track.get('path'), None)
+
+    def _fetch(self, where, params=()):
+        with db_pool.read() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT * FROM tracks WHERE {where}", params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def load(self):
         start_time = time.time()
-        tn = telnetlib.Telnet(TELNET_HOST, TELNET_PORT)
-        tn.write((command + "\n").encode('utf-8'))
-        response = tn.read_until(b"\n").decode('utf-8').strip()
-        tn.write(b"quit\n")
-        tn.close()
+        try:
+            tracks = self._fetch("1=1")
+        except Exception as e:
+            logger.error(f"Error loading track catalog: {str(e)}")
+            return 0
+        with self._lock:
+            self._by_path = {}
+            self._by_id = {}
+            self._by_name = {}
+            self._missing = set()
+            self._max_id = 0
+            for track in tracks:
+                self._index(track, notify=False)
+            self._notify(None, None)
+        logger.info(f"Loaded track catalog: {len(tracks)} tracks in {time.time() - start_time:.2f}s")
+        return len(tracks)
+
+    def refresh(self, where, params=()):
+        try:
+            tracks = self._fetch(where, params)
+        except Exception as e:
+            logger.error("Error refreshing track catalog (%s): %s", where, e)
+            return 0
+        with self._lock:
+            for track in tracks:
+                self._index(track)
+        return len(tracks)
+
+    def refresh_path(self, path):
+        if not self.refresh("path = ?", (path,)):
+            self.remove(path)
+
+    def refresh_new(self):
+        with self._lock:
+            max_id = self._max_id
+            self._missing.clear()
+        return self.refresh("id > ?", (max_id,))
+
+    def remove(self, path):
+        with self._lock:
+            track = self._by_path.get(path)
+            if track is not None:
+                self._unindex(track)
+
+    def get(self, path):
+        if not path:
+            return None
+        with self._lock:
+            track = self._by_path.get(path)
+            if track is not None or path in self._missing:
+                return track
+        # Промах: строка могла появиться в базе в обход API
+        if self.refresh("path = ?", (path,)):
+            with self._lock:
+                return self._by_path.get(path)
+        with self._lock:
+            self._missing.add(path)
+        return None
+
+    def get_by_id(self, track_id):
+        with self._lock:
+            return self._by_id.get(track_id)
+
+    def get_by_name(self, name):
+        with self._lock:
+            return self._by_name.get(name)
+
+    def increment_playcount(self, path):
+        with self._lock:
+            track = self._by_path.get(path)
+            if track is not None:
+                track['playcount'] = (track.get('playcount') or 0) + 1
+                self._notify(path, track)
+
+    def reset_playcounts(self):
+        with self._lock:
+            for track in self._by_path.values():
+                track['playcount'] = 0
+            self._notify(None, None)
+
+    def all_tracks(self):
+        with self._lock:
+            return list(self._by_path.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_path)
+
+track_catalog = TrackCatalog()
+
+# Ограниченное окно недавно сыгранных путей против повторов, проверка вхождения за O(1).
+# persist() дописывает проигрывания в PLAYBACK_HISTORY_FILE пачками; файл целиком
+# атомарно перезаписывается только раз в `compact_every` дописываний.
+class PlaybackHistory:
+    def __init__(self, path, max_size=30, compact_every=100):
+        self.path = path
+        self.max_size = max(1, max_size)
+        self.compact_every = max(1, compact_every)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._appends = 0
+
+    def _push(self, track_path):
+        if track_path in self._items:
+            self._items.move_to_end(track_path)
+        else:
+            self._items[track_path] = None
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def load(self):
+        with self._lock:
+            self._items = OrderedDict()
+            if not self.path or not os.path.exists(self.path):
+                return 0
+            try:
+                lines = 0
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            self._push(line)
+                            lines += 1
+                self._appends = max(0, lines - len(self._items))
+                logger.info(f"Loaded playback history, {len(self._items)} tracks")
+            except Exception as e:
+                logger.error(f"Error loading playback history: {str(e)}")
+            if self._appends >= self.compact_every:
+                self._compact()
+            return len(self._items)
+
+    def _compact(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                for track_path in self._items:
+                    f.write(f"{track_path}\n")
+            os.replace(tmp_path, self.path)
+            self._appends = 0
+            logger.info(f"Compacted playback history, {len(self._items)} tracks")
+        except Exception as e:
+            logger.error(f"Error compacting playback history: {str(e)}")
+
+    def add(self, track_path):
+        if not track_path:
+            return
+        with self._lock:
+            self._push(track_path)
+
+    # Дописывает уже учтённые в памяти треки в файл (вызывается писателем событий)
+    def persist(self, track_paths):
+        if not self.path or not track_paths:
+            return
+        with self._lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.writelines(f"{track_path}\n" for track_path in track_paths)
+                self._appends += len(track_paths)
+            except Exception as e:
+                logger.error(f"Error saving playback history: {str(e)}")
+            if self._appends >= self.compact_every:
+                self._compact()
+
+    def last(self, count):
+        if count <= 0:
+            return []
+        with self._lock:
+            return list(self._items)[-count:]
+
+    def tracks(self):
+        with self._lock:
+            return list(self._items)
+
+    def __contains__(self, track_path):
+        return track_path in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+playback_history = PlaybackHistory(PLAYBACK_HISTORY_FILE, MAX_HISTORY_SIZE, PLAYBACK_HISTORY_COMPACT_EVERY)
+
+# Отложенная запись событий проигрывания. Потоки запросов только ставят события в очередь;
+# один поток-писатель разбирает её и применяет каждую пачку одной транзакцией SQLite.
+# Увеличения playcount для одного пути складываются, на диск пишутся только последний снимок
+# now playing и последний сыгранный путь.
+class PlayEventWriter:
+    def __init__(self, history, batch_size=50, flush_interval=1.0, max_retries=3):
+        self.history = history
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._events = Queue()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._retries = 0
+        self.flushed_batches = 0
+        self.flushed_events = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='play-event-writer', daemon=True)
+            self._thread.start()
+
+    def play(self, track_path):
+        self._events.put(('play', track_path))
+
+    def history_append(self, track_path):
+        self._events.put(('history', track_path))
+
+    def last_played(self, track_path):
+        self._events.put(('last_played', track_path))
+
+    def now_playing(self, snapshot):
+        self._events.put(('now_playing', snapshot))
+
+    def special_started(self, track_path):
+        self._events.put(('special_started', track_path))
+
+    def pending(self):
+        return self._events.qsize()
+
+    def _collect(self):
+        try:
+            batch = [self._events.get(timeout=self.flush_interval)]
+        except Empty:
+            return []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size and not self._stopping.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._events.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._events.get_nowait())
+            except Empty:
+                return batch
+
+    def flush(self, batch):
+        if not batch:
+            return
+        plays = {}
+        history = []
+        specials = []
+        last_played = None
+        current = None
+        for kind, track_path in batch:
+            if kind == 'wake':
+                continue
+            elif kind == 'play':
+                plays[track_path] = plays.get(track_path, 0) + 1
+            elif kind == 'history':
+                history.append(track_path)
+            elif kind == 'special_started':
+                if track_path not in specials:
+                    specials.append(track_path)
+            elif kind == 'last_played':
+                last_played = track_path
+            elif kind == 'now_playing':
+                current = track_path
+        if plays or specials:
+            with db_pool.write() as conn:
+                cursor = conn.cursor()
+                cursor.executemany("UPDATE tracks SET playcount = playcount + ? WHERE path = ?",
+                                   [(count, track_path) for track_path, count in plays.items()])
+                for track_path in specials:
+                    cursor.execute("UPDATE schedule SET queued = 0 WHERE track_path = ? AND queued = 1", (track_path,))
+                    if cursor.rowcount > 0:
+                        logger.info("Cleared queued=0 for started special track: %s", track_path)
+            if plays:
+                logger.info("Flushed playcounts for %s tracks in one transaction", len(plays))
+        if history:
+            self.history.persist(history)
+        if current is not None:
+            try:
+                now_playing.persist_current(current)
+            except Exception as e:
+                logger.error("Error saving current track: %s", e)
+        if last_played is not None:
+            try:
+                now_playing.persist_last_played(last_played)
+            except Exception as e:
+                logger.error("Error saving last played track: %s", e)
+        self.flushed_batches += 1
+        self.flushed_events += len(batch)
+
+    def _flush_with_retry(self, batch):
+        while True:
+            try:
+                self.flush(batch)
+                self._retries = 0
+                return
+            except Exception as e:
+                self._retries += 1
+                if self._retries > self.max_retries:
+                    logger.error("Dropping %s play events after %s retries: %s", len(batch), self.max_retries, e)
+                    self._retries = 0
+                    return
+                logger.error("Error flushing play events (attempt %s/%s): %s", self._retries, self.max_retries, e)
+                if self._stopping.is_set():
+                    continue
+                time.sleep(self.flush_interval)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._flush_with_retry(self._collect())
+        self._flush_with_retry(self._drain())
+
+    # Вызывается при остановке процесса: всё, что уже в очереди, попадает в базу
+    def stop(self, timeout=10):
+        self._stopping.set()
+        # Будим писателя, если он ждёт событие в _collect
+        self._events.put(('wake', None))
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            self._flush_with_retry(self._drain())
+
+play_event_writer = PlayEventWriter(playback_history, PLAY_WRITER_BATCH_SIZE, PLAY_WRITER_FLUSH_INTERVAL)
+
+def write_file_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb' if isinstance(text, bytes) else 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class NowPlayingSnapshot(namedtuple('NowPlayingSnapshot', 'version current next_track last_played updated_at')):
+    __slots__ = ()
+
+    def current_dict(self):
+        return dict(self.current)
+
+# Единственный источник правды о том, что в эфире. Каждое изменение увеличивает `version` и
+# подменяет неизменяемый снимок целиком, поэтому читатели не видят полуобновлённого состояния;
+# файлы — лишь отложенная копия (временный файл + rename) для восстановления после перезапуска.
+class NowPlayingState:
+    def __init__(self, current_file=None, last_played_file=None):
+        self.current_file = current_file
+        self.last_played_file = last_played_file
+        self._lock = threading.Lock()
+        self._snapshot = NowPlayingSnapshot(0, MappingProxyType({}), None, None, clock.time())
+        self._listeners = []
+
+    # listener(snapshot) вызывается после каждой смены версии, вне блокировки
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def load(self):
+        current = {}
+        last_played = None
+        try:
+            if self.current_file and os.path.exists(self.current_file):
+                with open(self.current_file, 'r') as f:
+                    current = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading current track: {str(e)}")
+        try:
+            if self.last_played_file and os.path.exists(self.last_played_file):
+                with open(self.last_played_file, 'r') as f:
+                    last_played = f.read().strip() or None
+        except Exception as e:
+            logger.error(f"Error reading last played track: {str(e)}")
+        with self._lock:
+            self._snapshot = NowPlayingSnapshot(self._snapshot.version + 1, MappingProxyType(dict(current)),
+                                                self._snapshot.next_track, last_played, clock.time())
+        logger.info(f"Loaded now playing state: {current.get('filename', '')}, last played: {last_played}")
+
+    def snapshot(self):
+        return self._snapshot
+
+    def _replace(self, **changes):
+        with self._lock:
+            old = self._snapshot
+            snapshot = old._replace(version=old.version + 1, updated_at=clock.time(), **changes)
+            self._snapshot = snapshot
+        return old, snapshot
+
+    def _changed(self, old, snapshot):
+        if snapshot.current is not old.current:
+            play_event_writer.now_playing(snapshot)
+        if snapshot.last_played != old.last_played:
+            play_event_writer.last_played(snapshot.last_played)
+        for listener in self._listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.error("Error in now playing listener: %s", e)
+
+    # Обновляет текущий трек и атомарно определяет, новый ли это трек (не повтор метаданных)
+    def start_track(self, current):
+        filename = current.get('filename')
+        with self._lock:
+            old = self._snapshot
+            is_new = old.last_played != filename
+            current = dict(current)
+            # Время старта трека хранится вместе с ним (и переживает перезапуск через файл)
+            if is_new or old.current.get('filename') != filename or 'started_at' not in old.current:
+                current['started_at'] = clock.time()
+            else:
+                current['started_at'] = old.current['started_at']
+            snapshot = old._replace(version=old.version + 1, updated_at=clock.time(),
+                                    current=MappingProxyType(current),
+                                    last_played=filename if is_new else old.last_played)
+            self._snapshot = snapshot
+        self._changed(old, snapshot)
+        return is_new
+
+    def set_next_track(self, track_path):
+        old, snapshot = self._replace(next_track=track_path)
+        self._changed(old, snapshot)
+
+    def set_last_played(self, track_path):
+        old, snapshot = self._replace(last_played=track_path)
+        self._changed(old, snapshot)
+
+    # Новая версия без изменения полей — когда поменялись данные каталога для текущего/следующего трека
+    def touch(self):
+        old, snapshot = self._replace()
+        self._changed(old, snapshot)
+
+    def persist_current(self, snapshot):
+        if self.current_file:
+            write_file_atomic(self.current_file, json.dumps(snapshot.current_dict()))
+
+    def persist_last_played(self, track_path):
+        if self.last_played_file:
+            write_file_atomic(self.last_played_file, track_path or '')
+
+now_playing = NowPlayingState(CURRENT_TRACK_FILE, LAST_PLAYED_TRACK_FILE)
+
+# Ротация подходящих музыкальных треков (status='available', track_info='track').
+# Треки лежат в корзинах по playcount; выбор берёт из самых младших непустых корзин, пропускает
+# кольцо недавних и взвешивает кандидатов по свежести, разнообразию стилей и разнесению
+# исполнителей. Изменение playcount переносит один трек между корзинами.
+class RotationEngine:
+    def __init__(self, history, candidates=20, freshness_weight=1.0, freshness_half_life_days=30.0,
+                 style_weight=0.5, style_window=3, artist_separation=3, seed=None):
+        self.candidates = candidates
+        self.freshness_weight = freshness_weight
+        self.freshness_half_life_days = freshness_half_life_days
+        self.style_weight = style_weight
+        self.style_window = style_window
+        self.artist_separation = artist_separation
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._buckets = {}
+        self._counts = []
+        self._info = {}
+        self.history = history
+
+    @staticmethod
+    def is_eligible(track):
+        return track is not None and track.get('status') == 'available' and track.get('track_info') == 'track'
+
+    def _freshness(self, upload_date):
+        if not self.freshness_weight or not upload_date:
+            return 1.0
+        try:
+            uploaded = datetime.strptime(str(upload_date)[:10], '%Y-%m-%d')
+        except ValueError:
+            return 1.0
+        age_days = max(0.0, (clock.now() - uploaded).total_seconds() / 86400)
+        return 1.0 + self.freshness_weight * 0.5 ** (age_days / self.freshness_half_life_days)
+
+    def _bucket_add(self, path, playcount):
+        bucket = self._buckets.get(playcount)
+        if bucket is None:
+            bucket = self._buckets[playcount] = ([], {})
+            bisect.insort(self._counts, playcount)
+        paths, positions = bucket
+        positions[path] = len(paths)
+        paths.append(path)
+
+    def _bucket_remove(self, path, playcount):
+        paths, positions = self._buckets[playcount]
+        index = positions.pop(path)
+        last = paths.pop()
+        if last != path:
+            paths[index] = last
+            positions[last] = index
+        if not paths:
+            del self._buckets[playcount]
+            del self._counts[bisect.bisect_left(self._counts, playcount)]
+
+    def _add(self, track):
+        path = track['path']
+        playcount = track.get('playcount') or 0
+        self._info[path] = {
+            'playcount': playcount,
+            'upload_date': track.get('upload_date'),
+            'artist': (track.get('artist') or '').strip().lower(),
+            'style': (track.get('style') or '').strip().lower(),
+            'freshness': self._freshness(track.get('upload_date'))
+        }
+        self._bucket_add(path, playcount)
+
+    def _remove(self, path):
+        info = self._info.pop(path, None)
+        if info is not None:
+            self._bucket_remove(path, info['playcount'])
+
+    def rebuild(self, tracks):
+        with self._lock:
+            self._buckets = {}
+            self._counts = []
+            self._info = {}
+            for track in tracks:
+                if self.is_eligible(track) and track.get('path'):
+                    self._add(track)
+        logger.info(f"Rotation rebuilt: {len(self._info)} eligible tracks in {len(self._counts)} playcount buckets")
+
+    def sync(self, path, track):
+        with self._lock:
+            if not self.is_eligible(track):
+                self._remove(path)
+                return
+            info = self._info.get(path)
+            if info is None:
+                self._add(track)
+                return
+            playcount = track.get('playcount') or 0
+            if info['playcount'] != playcount:
+                self._bucket_remove(path, info['playcount'])
+                self._bucket_add(path, playcount)
+                info['playcount'] = playcount
+            info['artist'] = (track.get('artist') or '').strip().lower()
+            info['style'] = (track.get('style') or '').strip().lower()
+
+    def _recent_attribute(self, key, window):
+        values = []
+        for path in self.history.last(window):
+            info = self._info.get(path)
+            if info and info[key]:
+                values.append(info[key])
+        return values
+
+    def _sample_bucket(self, paths, need, excluded):
+        history = self.history
+        if len(paths) <= need * 4:
+            return [path for path in paths if path not in excluded and path not in history]
+        found = set()
+        attempts = need * 8
+        while attempts and len(found) < need:
+            path = paths[self._random.randrange(len(paths))]
+            if path not in excluded and path not in history:
+                found.add(path)
+            attempts -= 1
+        return list(found)
+
+    def pick(self, exclude=()):
+        with self._lock:
+            excluded = set(exclude)
+            candidates = []
+            for playcount in self._counts:
+                paths, _ = self._buckets[playcount]
+                candidates.extend(self._sample_bucket(paths, self.candidates - len(candidates), excluded))
+                if len(candidates) >= self.candidates:
+                    break
+            if not candidates:
+                return None
+            recent_artists = set(self._recent_attribute('artist', self.artist_separation))
+            separated = [path for path in candidates if self._info[path]['artist'] not in recent_artists]
+            if separated:
+                candidates = separated
+            recent_styles = self._recent_attribute('style', self.style_window)
+            weights = []
+            for path in candidates:
+                info = self._info[path]
+                weight = info['freshness']
+                if recent_styles and info['style']:
+                    weight *= 1.0 - self.style_weight * recent_styles.count(info['style']) / len(recent_styles)
+                weights.append(max(weight, 0.01))
+            path = self._random.choices(candidates, weights)[0]
+            return dict(self._info[path], path=path)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._info)
+
+rotation_engine = RotationEngine(
+    playback_history,
+    candidates=ROTATION_CANDIDATES,
+    freshness_weight=ROTATION_FRESHNESS_WEIGHT,
+    freshness_half_life_days=ROTATION_FRESHNESS_HALF_LIFE_DAYS,
+    style_weight=ROTATION_STYLE_WEIGHT,
+    style_window=ROTATION_STYLE_WINDOW,
+    artist_separation=ROTATION_ARTIST_SEPARATION,
+    seed=ROTATION_SEED
+)
+
+def sync_rotation(path, track):
+    if path is None:
+        rotation_engine.rebuild(track_catalog.all_tracks())
+    else:
+        rotation_engine.sync(path, track)
+
+track_catalog.add_listener(sync_rotation)
+
+def get_table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [col['name'] for col in cursor.fetchall()]
+
+# FTS5-индекс по artist/title/name, синхронизируется триггерами
+def ensure_tracks_fts():
+    global tracks_fts_available
+    try:
+        with db_pool.read() as conn:
+            cursor = conn.cursor()
+            columns = [col for col in TRACKS_FTS_COLUMNS if col in get_table_columns(cursor, 'tracks')]
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tracks_fts'")
+            exists = cursor.fetchone() is not None
+        if not exists:
+            column_list = ', '.join(columns)
+            new_values = ', '.join(f"new.{col}" for col in columns)
+            old_values = ', '.join(f"old.{col}" for col in columns)
+            # executescript сам делает COMMIT, поэтому выражения выполняются по одному в транзакции писателя
+            with db_pool.write() as conn:
+                conn.execute(f"CREATE VIRTUAL TABLE tracks_fts USING fts5({column_list}, content='tracks', content_rowid='id')")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS tracks_fts_ai AFTER INSERT ON tracks BEGIN
+                    INSERT INTO tracks_fts(rowid, {column_list}) VALUES (new.id, {new_values});
+                END""")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS tracks_fts_ad AFTER DELETE ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                END""")
+                conn.execute(f"""CREATE TRIGGER IF NOT EXISTS tracks_fts_au AFTER UPDATE ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                    INSERT INTO tracks_fts(rowid, {column_list}) VALUES (new.id, {new_values});
+                END""")
+                conn.execute("INSERT INTO tracks_fts(tracks_fts) VALUES ('rebuild')")
+            logger.info(f"Created FTS5 index tracks_fts over {column_list}")
+        tracks_fts_available = True
+    except Exception as e:
+        tracks_fts_available = False
+        logger.error(f"FTS5 search index unavailable, falling back to LIKE: {str(e)}")
+
+def build_fts_query(text):
+    # Каждое слово — отдельный префиксный терм в кавычках, чтобы ввод пользователя не ломал синтаксис FTS5
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"*' for term in terms if term)
+
+def encode_tracks_cursor(row):
+    raw = json.dumps([row['upload_date'] or '', row['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_tracks_cursor(token):
+    upload_date, track_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    return upload_date, int(track_id)
+
+def liquidsoap_command(command, timeout=None):
+    return liquidsoap_pipeline([command], timeout)[0]
+
+def liquidsoap_pipeline(commands, timeout=None):
+    # Команды уходят одной записью в сокет, ответы читаются по порядку
+    if not commands:
+        return []
+    try:
+        commands = [command.encode('utf-8').decode('utf-8') for command in commands]
+        start_time = time.time()
+        if control_loop is not None:
+            # Страховка поверх таймаутов клиента: ожидание соединения из пула, переподключение и повтор
+            responses = control_loop.call(liquidsoap_client.pipeline(commands, timeout),
+                                          (timeout or LIQUIDSOAP_COMMAND_TIMEOUT) * 4)
+        else:
+            responses = liquidsoap_client.pipeline(commands, timeout)
         elapsed_time = time.time() - start_time
-        logger.info(f"Liquidsoap command '{command}' executed, response: '{response}', time: {elapsed_time:.2f}s")
-        return response
+        for command, response in zip(commands, responses):
+            # Опросы (get_*) пишем выборочно; аргументы форматируются только если запись пройдёт
+            liquidsoap_log.info("Liquidsoap command '%s' executed, response: '%s', time: %.2fs", command, response, elapsed_time,
+                                extra={'sample': LOG_POLL_SAMPLE} if command.startswith('get_') else None)
+        return responses
     except Exception as e:
-        logger.error(f"Error sending command to Liquidsoap: {str(e)}")
-        return str(e)
+        liquidsoap_log.error("Error sending command to Liquidsoap: %s", e)
+        return [str(e)] * len(commands)
 
 def get_normal_queue_length():
-    response = liquidsoap_command("get_normal_queue_length")
+    return parse_normal_queue_length(liquidsoap_command("get_normal_queue_length"))
+
+def parse_normal_queue_length(response):
     if response:
         try:
-            return int(response.split("\n")[0])
+            length = int(response.split("\n")[0])
+            queue_depth.set(length, 'normal')
+            return length
         except (ValueError, IndexError):
             logger.error("Failed to parse normal_queue_length")
             return 0
     return 0
 
 def get_current_track():
-    try:
-        with open(CURRENT_TRACK_FILE, 'r') as f:
-            data = json.load(f)
-        return data
-    except Exception as e:
-        logger.error(f"Error reading current track: {str(e)}")
+    current = now_playing.snapshot().current
+    if not current:
         return {"filename": "", "artist": "VTRNK", "title": "Radio Show"}
+    return dict(current)
 
 def get_last_played_track():
-    try:
-        with open(LAST_PLAYED_TRACK_FILE, 'r') as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return None
-    except Exception as e:
-        logger.error(f"Error reading last played track: {str(e)}")
-        return None
+    return now_playing.snapshot().last_played
 
-def save_last_played_track(track_path):
-    try:
-        with open(LAST_PLAYED_TRACK_FILE, 'w') as f:
-            f.write(track_path)
-        logger.info(f"Saved last played track: {track_path}")
-    except Exception as e:
-        logger.error(f"Error saving last played track: {str(e)}")
+def save_last_played_track(track_path):
+    now_playing.set_last_played(track_path)
+    logger.info("Saved last played track: %s", track_path)
 
 def load_playback_history():
-    try:
-        if not os.path.exists(PLAYBACK_HISTORY_FILE):
-            return []
-        with open(PLAYBACK_HISTORY_FILE, 'r') as f:
-            history = [line.strip() for line in f.readlines() if line.strip()]
-        logger.info(f"Loaded playback history, {len(history)} tracks")
-        return history
-    except Exception as e:
-        logger.error(f"Error loading playback history: {str(e)}")
-        return []
-
-def save_playback_history(history):
-    try:
-        history = history[-MAX_HISTORY_SIZE:]
-        with open(PLAYBACK_HISTORY_FILE, 'w') as f:
-            for track in history:
-                f.write(f"{track}\n")
-        logger.info(f"Saved playback history, {len(history)} tracks")
-    except Exception as e:
-        logger.error(f"Error saving playback history: {str(e)}")
+    return playback_history.tracks()
 
 def add_to_playback_history(track_path):
-    history = load_playback_history()
-    if track_path in history:
-        history.remove(track_path)
-    history.append(track_path)
-    save_playback_history(history)
-    logger.info(f"Added track {track_path} to playback history")
-
-def select_next_track():
+    playback_history.add(track_path)
+    play_event_writer.history_append(track_path)
+    logger.info("Added track %s to playback history", track_path)
+
+def select_next_track(exclude=None):
+    with track_selection_seconds.time():
+        return _select_next_track(exclude)
+
+def _select_next_track(exclude=None):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        current_track_data = get_current_track()
-        current_track = current_track_data.get('filename', '')
-        history = load_playback_history()
-        exclude_tracks = history[-30:]
-        if current_track and current_track not in exclude_tracks:
-            exclude_tracks.append(current_track)
-        placeholders = ','.join(['?'] * len(exclude_tracks))
-        exclude_condition = f"path NOT IN ({placeholders})" if exclude_tracks else "1=1"
-        cursor.execute(f"""
-            SELECT path, playcount, upload_date
-            FROM tracks
-            WHERE {exclude_condition} AND status = 'available' AND track_info = 'track'
-            ORDER BY playcount ASC, upload_date DESC
-            LIMIT 20
-        """, exclude_tracks)
-        candidates = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        if not candidates:
-            logger.warning("No eligible tracks found for selection, excluded tracks: %s", exclude_tracks)
-            return None
-        selected_track = random.choice(candidates)
-        logger.info(f"Selected next track: {repr(selected_track['path'])}, playcount={selected_track['playcount']}, upload_date={selected_track['upload_date']}")
+        current_track = get_current_track().get('filename', '')
+        exclude_tracks = [track for track in [current_track] + list(exclude or []) if track]
+        while True:
+            selected_track = rotation_engine.pick(exclude_tracks)
+            if not selected_track:
+                logger.warning("No eligible tracks found for selection, excluded tracks: %s", playback_history.tracks() + exclude_tracks)
+                return None
+            # Файл мог пропасть между проходами сканера — мёртвый путь в Liquidsoap не отдаём
+            if os.path.exists(selected_track['path']):
+                break
+            library_scanner.mark_unavailable([selected_track['path']])
+            exclude_tracks.append(selected_track['path'])
+        logger.info("Selected next track: %r, playcount=%s, upload_date=%s", selected_track['path'],
+                    selected_track['playcount'], selected_track['upload_date'])
         return selected_track['path']
     except Exception as e:
-        logger.error(f"Error selecting next track: {str(e)}")
+        logger.error("Error selecting next track: %s", e)
         return None
 
 def increment_play_count(track_path):
     if not track_path:
         logger.warning("Cannot increment playcount: track_path is empty")
         return
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT playcount FROM tracks WHERE path = ?", (track_path,))
-        track = cursor.fetchone()
-        if not track:
-            logger.warning(f"Track {track_path} does not exist in the database, cannot increment playcount")
-            conn.close()
-            return
-        cursor.execute("UPDATE tracks SET playcount = playcount + 1 WHERE path = ?", (track_path,))
-        affected_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
-        if affected_rows == 0:
-            logger.warning(f"No track found with path {track_path} to increment playcount")
-        else:
-            logger.info(f"Incremented playcount for track {track_path}, affected rows: {affected_rows}")
-    except Exception as e:
-        logger.error(f"Error incrementing playcount for track {str(e)}")
+    if track_catalog.get(track_path) is None:
+        logger.warning("Track %s does not exist in the database, cannot increment playcount", track_path)
+        return
+    # В памяти сразу, в базу — пачкой из писателя событий
+    track_catalog.increment_playcount(track_path)
+    play_event_writer.play(track_path)
+    logger.info("Incremented playcount for track %s", track_path)
 
-def add_track_to_queue():
-    queue_length = get_normal_queue_length()
-    if queue_length < 2:
-        track_path = select_next_track()
-        if track_path:
-            global next_track
-            next_track = track_path
-            response = liquidsoap_command(f"set_next_track {track_path}")
-            logger.info(f"Added track to normal_queue: {track_path}, response: {response}")
-        else:
-            logger.error("No track selected for normal_queue")
+def add_track_to_queue(queue_length=None, before=()):
+    # Команды before (skip, play_playlist...) уходят одной записью с запросом длины очереди,
+    # выбранные треки — второй; возвращаются ответы на before
+    with refill_lock, queue_refill_seconds.time():
+        responses = liquidsoap_pipeline(list(before) + (["get_normal_queue_length"] if queue_length is None else []))
+        if queue_length is None:
+            queue_length = parse_normal_queue_length(responses.pop())
+        missing = REFILL_TARGET_DEPTH - queue_length
+        queued = []
+        for _ in range(missing):
+            track_path = select_next_track(exclude=recently_queued)
+            if not track_path:
+                logger.error("No track selected for normal_queue")
+                break
+            now_playing.set_next_track(track_path)
+            recently_queued.append(track_path)
+            queued.append(track_path)
+        pushed = liquidsoap_pipeline([f"set_next_track {liquidsoap_uri(track_path)}" for track_path in queued])
+        for track_path, response in zip(queued, pushed):
+            logger.info("Added track to normal_queue: %s, response: %s", track_path, response)
+        return responses
+
+def refill_prefetch():
+    logger.info("Prefetch refill before current track ends")
+    add_track_to_queue()
+
+def schedule_refill_prefetch(track_path):
+    duration = get_track_duration(track_path)
+    if not duration:
+        return
+    delay = max(0, float(duration) - REFILL_PREFETCH_SECONDS)
+    run_date = clock.now() + timedelta(seconds=delay)
+    scheduler.add_job(refill_prefetch, "date", run_date=run_date, id='refill_prefetch',
+                      replace_existing=True, misfire_grace_time=REFILL_PREFETCH_SECONDS)
+    logger.info("Scheduled prefetch refill in %.0fs for %s", delay, track_path)
 
 def skip_track():
     response = liquidsoap_command("skip_track")
-    logger.info(f"Skipped track, response: {response}")
+    logger.info("Skipped track, response: %s", response)
     return response
 
 def smart_skip():
-    try:
-        logger.info("Starting smart skip process")
+    # Сначала пополняем очередь, через COMMAND_DELAY пропускаем текущий трек.
+    # Пока другой skip или запуск шоу не завершён, повторный skip присоединяется к нему
+    def refill():
         add_track_to_queue()
-        logger.info(f"Added next track, waiting {COMMAND_DELAY} seconds")
-        time.sleep(COMMAND_DELAY)
-        skip_track()
-        logger.info("Smart skip completed successfully")
-        return {"success": True, "message": "Smart skip executed successfully"}
-    except Exception as e:
-        logger.error(f"Error in smart_skip: {str(e)}")
-        return {"success": False, "error": str(e)}
+        logger.info("Added next track, skipping in %s seconds", COMMAND_DELAY)
+
+    def skip():
+        return {'response': skip_track()}
+
+    return control_jobs.submit('smart_skip', [(0, 'refill', refill), (COMMAND_DELAY, 'skip', skip)],
+                               coalesce=lambda job: job['kind'] in ('smart_skip', 'play_radio_show'))
+
+def play_radio_show_job(track_path):
+    def play():
+        response = liquidsoap_command(f"play_radio_show {track_path}")
+        logger.info("Sent to Liquidsoap: play_radio_show %s, response: %s", track_path, response)
+        return {'response': response}
+
+    def skip():
+        # Задержка COMMAND_DELAY перед шагом — время на обработку в Liquidsoap
+        save_last_played_track(track_path)
+        skip_response, = add_track_to_queue(before=["skip_normal"])
+        logger.info("Skipped normal queue after manual show play, response: %s", skip_response)
+        return {'skip_response': skip_response}
+
+    return control_jobs.submit('play_radio_show', [(0, 'play', play), (COMMAND_DELAY, 'skip', skip)],
+                               params={'track_path': track_path},
+                               coalesce=lambda job: job['kind'] == 'play_radio_show' and job['params']['track_path'] == track_path)
 
 def get_track_duration(track_path):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT duration FROM tracks WHERE path = ?", (track_path,))
-        track = cursor.fetchone()
-        conn.close()
+        track = track_catalog.get(track_path)
         if track and track['duration']:
-            logger.info(f"Found duration for {track_path}: {track['duration']}s")
+            logger.debug("Found duration for %s: %ss", track_path, track['duration'])
             return track['duration']
-        logger.warning(f"No duration found for track {track_path}")
+        logger.warning("No duration found for track %s", track_path)
         return None
     except Exception as e:
-        logger.error(f"Error fetching duration for track {track_path}: {str(e)}")
+        logger.error("Error fetching duration for track %s: %s", track_path, e)
         return None
 
 def get_track_metadata(track_path):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT artist, track_title, name FROM tracks WHERE path = ?", (track_path,))
-        track = cursor.fetchone()
-        conn.close()
+        track = track_catalog.get(track_path)
         if track:
             artist = track['artist'] if track['artist'] and track['artist'].strip() else "VTRNK"
             title = track['track_title'] if track['track_title'] and track['track_title'].strip() else (track['name'] if track['name'] and track['name'].strip() else "Radio Show")
-            logger.info(f"Found metadata for {track_path}: artist={artist}, title={title}")
+            logger.debug("Found metadata for %s: artist=%s, title=%s", track_path, artist, title)
             return artist, title
-        logger.warning(f"No metadata found for track {track_path}")
+        logger.warning("No metadata found for track %s", track_path)
         return "VTRNK", "Radio Show"
     except Exception as e:
-        logger.error(f"Error fetching metadata for track {track_path}: {str(e)}")
+        logger.error("Error fetching metadata for track %s: %s", track_path, e)
         return "VTRNK", "Radio Show"
 
+def get_cover_for_track(track_path):
+    track = track_catalog.get(track_path)
+    # Готовая производная вместо исходника, который может весить несколько мегабайт
+    covers = cover_set(track)
+    if covers and str(COVER_DEFAULT_SIZE) in covers:
+        return covers[str(COVER_DEFAULT_SIZE)]['jpeg']
+    return track['path_img'] if track and track.get('path_img') else "/images/placeholder2.png"
+
 @app.route('/track_started', methods=['POST'])
 def track_started():
     try:
@@ -294,15 +2338,17 @@ def track_started():
             increment_play_count(track_path)
             add_to_playback_history(track_path)
             save_last_played_track(track_path)
-            logger.info(f"Track started: {track_path}, playcount incremented")
+            logger.info("Track started: %s, playcount incremented", track_path)
         return jsonify({'success': True})
     except Exception as e:
-        logger.error(f"Error in track_started: {str(e)}")
+        logger.error("Error in track_started: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/track', methods=['GET', 'POST'])
 def handle_track():
+    global track_callback_at
     if request.method == 'POST':
+        track_callback_at = time.time()
         try:
             data = request.get_json()
             artist_from_request = data.get('artist', 'Unknown Artist')
@@ -314,7 +2360,17 @@ def handle_track():
             artist = artist_from_db or artist_from_request
             title = title_from_db or title_from_request
             normal_queue_length = data.get('normal_queue_length', 0)
+            try:
+                reported_queue_length = int(normal_queue_length)
+            except (TypeError, ValueError):
+                reported_queue_length = None
             special_queue_length = data.get('special_queue_length', 0)
+            if reported_queue_length is not None:
+                queue_depth.set(reported_queue_length, 'normal')
+            try:
+                queue_depth.set(int(special_queue_length), 'special')
+            except (TypeError, ValueError):
+                pass
             timestamp = data.get('timestamp', 'Unknown Timestamp')
             special_queue_timestamp = data.get('special_queue_timestamp', '')
             normal_queue_timestamp = data.get('normal_queue_timestamp', '')
@@ -332,44 +2388,31 @@ def handle_track():
                 'track_queue_timestamp': track_queue_timestamp,
                 'queue': queue
             }
-            with open(CURRENT_TRACK_FILE, 'w') as f:
-                json.dump(current_track_json, f)
-            last_played = get_last_played_track()
-            if last_played != filename:
-                logger.info(f"Received and saved track metadata: artist={artist}, title={title}, filename={filename}, queue={queue}")
+            if now_playing.start_track(current_track_json):
+                logger.info("Received and saved track metadata: artist=%s, title=%s, filename=%s, queue=%s", artist, title, filename, queue)
                 increment_play_count(filename)
                 add_to_playback_history(filename)
-                save_last_played_track(filename)
-                add_track_to_queue()
-            socketio.emit('track_update', current_track_json)
+                # Длина очереди уже пришла от Liquidsoap, лишний запрос не нужен;
+                # команды Liquidsoap уходят из фонового потока, ответ на callback не ждёт
+                scheduler.add_job(add_track_to_queue, args=[reported_queue_length], id='refill_event', replace_existing=True)
+                schedule_refill_prefetch(filename)
             # Добавленный блок для сброса queued при старте special трека
             if data.get('queue') == 'special':
-                try:
-                    conn = get_db()
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE schedule SET queued = 0 WHERE track_path = ? AND queued = 1", (data.get('filename'),))
-                    affected_rows = cursor.rowcount
-                    conn.commit()
-                    conn.close()
-                    if affected_rows > 0:
-                        logger.info(f"Cleared queued=0 for started special track: {data.get('filename')}")
-                except Exception as e:
-                    logger.error(f"Error clearing queued in handle_track: {str(e)}")
+                play_event_writer.special_started(data.get('filename'))
             return jsonify({'success': True})
         except Exception as e:
-            logger.error(f"Error in handle_track (POST): {str(e)}")
+            logger.error("Error in handle_track (POST): %s", e)
             return jsonify({'error': str(e)}), 500
     else:
         try:
-            with open(CURRENT_TRACK_FILE, 'r') as f:
-                data = json.load(f)
+            data = now_playing.snapshot().current
             return jsonify([
                 ["filename", data.get("filename", "Unknown File")],
                 ["artist", data.get("artist", "Unknown Artist")],
                 ["title", data.get("title", "Unknown Title")]
             ])
         except Exception as e:
-            logger.error(f"Error in handle_track (GET): {str(e)}")
+            logger.error("Error in handle_track (GET): %s", e)
             return jsonify([
                 ["filename", "Unknown File"],
                 ["artist", "Unknown Artist"],
@@ -389,11 +2432,12 @@ def track_added_special():
             'queue': queue,
             'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
         }
-        logger.info(f"Track added to special queue: filename={filename}, type={track_type}, queue={queue}")
-        socketio.emit('track_added_special', track_added_json)
+        logger.info("Track added to special queue: filename=%s, type=%s, queue=%s", filename, track_type, queue)
+        with broadcast_seconds.time('track_added_special'):
+            socketio.emit('track_added_special', track_added_json)
         return jsonify({'success': True})
     except Exception as e:
-        logger.error(f"Error in track_added_special: {str(e)}")
+        logger.error("Error in track_added_special: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/track_added_normal', methods=['POST'])
@@ -409,109 +2453,1218 @@ def track_added_normal():
             'queue': queue,
             'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
         }
-        logger.info(f"Track added to normal queue: filename={filename}, type={track_type}, queue={queue}")
-        socketio.emit('track_added_normal', track_added_json)
+        logger.info("Track added to normal queue: filename=%s, type=%s, queue=%s", filename, track_type, queue)
+        with broadcast_seconds.time('track_added_normal'):
+            socketio.emit('track_added_normal', track_added_json)
+        return jsonify({'success': True})
+    except Exception as e:
+        logger.error("Error in track_added_normal: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/update_show', methods=['POST'])
+def update_show():
+    try:
+        data = request.form
+        track_path = data.get('track_path')
+        new_artist = data.get('new_artist')
+        new_title = data.get('new_title')
+        new_style = data.get('new_style')
+        if not track_path:
+            logger.warning("Missing track_path in update_show request")
+            return jsonify({'success': False, 'error': 'Missing track_path'}), 400
+        # Проверяем, существует ли запись
+        with db_pool.read() as conn:
+            exists = conn.execute("SELECT 1 FROM tracks WHERE path = ?", (track_path,)).fetchone() is not None
+        if not exists:
+            logger.warning(f"No show found with path {track_path}")
+            return jsonify({'success': False, 'error': f"No show found with path {track_path}"}), 404
+        update_query = "UPDATE tracks SET "
+        update_params = []
+        if new_artist:
+            update_query += "artist = ?, "
+            update_params.append(new_artist)
+        if new_title:
+            update_query += "title = ?, "
+            update_params.append(new_title)
+        if new_style:
+            update_query += "style = ?, "
+            update_params.append(new_style)
+        if 'coverFile' in request.files:
+            cover_file = request.files['coverFile']
+            if cover_file.filename != '':
+                if not cover_file.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    logger.warning("Invalid cover file format")
+                    return jsonify({'success': False, 'error': 'Invalid cover file format. Only JPG, JPEG, PNG allowed.'}), 400
+                cover_dir = os.path.join(IMAGES_DIR, 'show_covers/')
+                if not os.path.exists(cover_dir):
+                    os.makedirs(cover_dir)
+                    logger.info(f"Created directory {cover_dir}")
+                # Имя по хэшу содержимого: одинаковые имена файлов у разных шоу больше не затирают друг друга
+                cover_data = cover_file.read()
+                cover_name = hashlib.sha256(cover_data).hexdigest()[:20] + os.path.splitext(cover_file.filename)[1].lower()
+                cover_path = os.path.join(cover_dir, cover_name)
+                write_file_atomic(cover_path, cover_data)
+                logger.info(f"Saved cover file to {cover_path}")
+                update_query += "path_img = ?, "
+                update_params.append('/images/show_covers/' + cover_name)
+        if update_params:
+            update_query = update_query.rstrip(', ') + " WHERE path = ?"
+            update_params.append(track_path)
+            with db_pool.write() as conn:
+                affected_rows = conn.execute(update_query, update_params).rowcount
+            if affected_rows > 0:
+                logger.info(f"Updated show for path {track_path}")
+                track_catalog.refresh_path(track_path)
+                cover_worker.wake()
+                return jsonify({'success': True})
+            else:
+                logger.warning(f"No show found with path {track_path} after update attempt")
+                return jsonify({'success': False, 'error': f"No show found with path {track_path}"}), 404
+        else:
+            return jsonify({'success': False, 'error': 'No updates provided'}), 400
+    except Exception as e:
+        logger.error(f"Error in update_show: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def move_into_place(source, target):
+    try:
+        os.replace(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Другая файловая система: копируем рядом с целью и подменяем атомарно
+        tmp_path = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.tmp")
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+        os.remove(source)
+
+# Процессы пулов разбора запускаются через forkserver: fork из процесса с потоками (очередь логов,
+# планировщик, писатель, inotify) мог унести в дочерний процесс захваченную блокировку. Сервер
+# заранее импортирует audio_probe, рабочие процессы ответвляются от него.
+def worker_process_context():
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['audio_probe'])
+    main_module = sys.modules['__main__']
+    if getattr(main_module, '__spec__', None) is None and hasattr(main_module, '__file__'):
+        # radio_player.py запущен как скрипт: иначе каждый рабочий процесс исполнил бы его заново
+        # (под именем __mp_main__) вместе с планировщиками, а рабочим нужен только audio_probe
+        main_module.__spec__ = importlib.machinery.ModuleSpec('__main__', None)
+    return context
+
+def db_pool_columns(table):
+    with db_pool.read() as conn:
+        return get_table_columns(conn.cursor(), table)
+
+# Пул процессов считает хеш и читает теги готовых загрузок, пока они ещё лежат в UPLOAD_TMP_DIR;
+# затем поток завершения веб-процесса пишет строку каталога (через db_pool).
+# Файл, чей хеш содержимого уже есть в каталоге, отбрасывается, не попадая в библиотеку.
+# Иначе он переносится под своим именем, а если оно занято — под name-2, name-3...:
+# существующий файл библиотеки никогда не заменяется.
+class IngestPipeline:
+    def __init__(self, workers=2):
+        self.workers = max(1, workers)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._completed = Queue()
+        self._thread = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_process_context())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ingest-completion', daemon=True)
+                self._thread.start()
+            return self._executor
+
+    def pending_paths(self):
+        with self._lock:
+            return set(self._pending)
+
+    def submit(self, source_path, target_dir, filename, kind, callback=None):
+        try:
+            future = self._pool().submit(probe_audio_file, source_path)
+        except BrokenProcessPool:
+            with self._lock:
+                self._executor = None
+            future = self._pool().submit(probe_audio_file, source_path)
+        # Колбэк исполняется в служебном потоке пула; запись в базу и перенос файла делает свой поток
+        future.add_done_callback(lambda done: self._completed.put((done, source_path, target_dir, filename, kind, callback)))
+        return future
+
+    def _run(self):
+        while True:
+            job = self._completed.get()
+            if job is None:
+                return
+            try:
+                self._complete(*job)
+            except Exception as e:
+                library_log.error(f"Ingest completion failed for {job[3]}: {str(e)}")
+
+    def probe_many(self, paths):
+        futures = {}
+        for path in paths:
+            try:
+                futures[self._pool().submit(probe_audio_file, path)] = path
+            except BrokenProcessPool:
+                with self._lock:
+                    self._executor = None
+                futures[self._pool().submit(probe_audio_file, path)] = path
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], {'content_hash': None, 'error': str(e)}
+
+    def find_duplicate(self, content_hash):
+        if not content_hash or 'content_hash' not in db_pool_columns('tracks'):
+            return None
+        with db_pool.read() as conn:
+            rows = conn.execute("SELECT id, path FROM tracks WHERE content_hash = ?", (content_hash,)).fetchall()
+        for row in rows:
+            if os.path.exists(row['path']):
+                return dict(row)
+        return None
+
+    def _place(self, source_path, target_dir, filename):
+        # Имя занимается через O_EXCL, поэтому две загрузки с одним именем не попадут в один файл
+        os.makedirs(target_dir, exist_ok=True)
+        stem, ext = os.path.splitext(filename)
+        number = 1
+        while True:
+            path = os.path.join(target_dir, filename if number == 1 else f"{stem}-{number}{ext}")
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                break
+            except FileExistsError:
+                number += 1
+        with self._lock:
+            self._pending.add(path)
+        try:
+            move_into_place(source_path, path)
+        except Exception:
+            os.remove(path)
+            raise
+        if number > 1:
+            library_log.warning(f"{os.path.join(target_dir, filename)} already exists, upload stored as {path}")
+        return path
+
+    def _complete(self, future, source_path, target_dir, filename, kind, callback):
+        path = None
+        try:
+            info = future.result()
+            duplicate = self.find_duplicate(info['content_hash'])
+            if duplicate is not None:
+                library_log.warning(f"Upload {filename} duplicates {duplicate['path']} (id={duplicate['id']}), removed")
+                result = {'state': 'duplicate', 'track_id': duplicate['id'], 'track_path': duplicate['path']}
+            else:
+                path = self._place(source_path, target_dir, filename)
+                result = self.store(path, kind, info)
+        except Exception as e:
+            library_log.error(f"Ingest failed for {filename}: {str(e)}")
+            result = {'state': 'failed', 'error': str(e)}
+        finally:
+            # После перемещения исходного файла уже нет; дубликат и сбой убирают его здесь
+            try:
+                os.remove(source_path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self._pending.discard(path)
+        if callback is not None:
+            callback(result)
+
+    def store(self, path, kind, info):
+        if info.get('error'):
+            library_log.warning(f"No tags for {path}: {info['error']}")
+        columns = set(db_pool_columns('tracks'))
+        content_hash = info['content_hash'] if 'content_hash' in columns else None
+        with db_pool.write() as conn:
+            if content_hash:
+                duplicate = conn.execute("SELECT id, path FROM tracks WHERE content_hash = ? AND path != ?",
+                                         (content_hash, path)).fetchone()
+                if duplicate and os.path.exists(duplicate['path']):
+                    duplicate = dict(duplicate)
+                else:
+                    duplicate = None
+            else:
+                duplicate = None
+            if duplicate is None:
+                existing = conn.execute("SELECT id FROM tracks WHERE path = ?", (path,)).fetchone()
+                title = info['title']
+                if existing:
+                    # Строка осталась от пропавшего файла с этим путём: отредактированные вручную поля
+                    # не затираем пустыми тегами
+                    conn.execute("""
+                        UPDATE tracks SET artist = COALESCE(?, artist), track_title = COALESCE(?, track_title),
+                            duration = COALESCE(?, duration), track_info = ?, status = 'available'
+                        WHERE id = ?
+                    """, (info['artist'], title, info['duration'], kind, existing['id']))
+                    track_id = existing['id']
+                else:
+                    track_id = conn.execute("""
+                        INSERT INTO tracks (name, path, artist, title, track_title, duration, track_info, status, playcount, upload_date)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, 'available', 0, ?)
+                    """, (os.path.basename(path), path, info['artist'], title if kind == 'radio_show' else None, title,
+                          info['duration'], kind, datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))).lastrowid
+                if content_hash:
+                    # Новое содержимое под тем же путём нужно проанализировать заново
+                    if 'analyzed_at' in columns:
+                        conn.execute("UPDATE tracks SET analyzed_at = NULL WHERE id = ? AND content_hash IS NOT ?",
+                                     (track_id, content_hash))
+                    if 'cover_source' in columns:
+                        conn.execute("UPDATE tracks SET cover_source = NULL WHERE id = ? AND content_hash IS NOT ?",
+                                     (track_id, content_hash))
+                    conn.execute("UPDATE tracks SET content_hash = ? WHERE id = ?", (content_hash, track_id))
+                if 'file_inode' in columns:
+                    # Отпечаток файла, чтобы сканер библиотеки не разбирал его повторно
+                    conn.execute("UPDATE tracks SET file_size = ?, file_mtime = ?, file_inode = ? WHERE id = ?",
+                                 file_fingerprint(path) + (track_id,))
+        if duplicate is not None:
+            # Такой же файл загрузили одновременно; path занят этой загрузкой, удалять его безопасно
+            os.remove(path)
+            library_log.warning(f"Upload {path} duplicates {duplicate['path']} (id={duplicate['id']}), removed")
+            return {'state': 'duplicate', 'track_id': duplicate['id'], 'track_path': duplicate['path']}
+        track_catalog.refresh_path(path)
+        loudness_analyzer.wake()
+        cover_worker.wake()
+        library_log.info(f"Ingested {kind} {path}: id={track_id}, duration={info['duration']}, artist={info['artist']}, title={info['title']}")
+        return {'state': 'done', 'track_id': track_id, 'track_path': path}
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+            if self._thread is not None:
+                self._completed.put(None)
+                self._thread = None
+
+ingest_pipeline = IngestPipeline(INGEST_WORKERS)
+
+class UploadConflict(Exception):
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+# Докачиваемые загрузки. Сессия — это файл <id>.part и метаданные <id>.json в UPLOAD_TMP_DIR;
+# подтверждённое смещение равно размеру .part, поэтому прерванная загрузка продолжается с
+# GET /uploads/<id> даже после перезапуска.
+class UploadManager:
+    def __init__(self, tmp_dir, max_size, block_size=1024 * 1024, expire_seconds=86400):
+        self.tmp_dir = tmp_dir
+        self.max_size = max_size
+        self.block_size = block_size
+        self.expire_seconds = expire_seconds
+        self._sessions = {}
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def _path(self, upload_id, suffix):
+        return os.path.join(self.tmp_dir, f"{upload_id}{suffix}")
+
+    def _save(self, session):
+        write_file_atomic(self._path(session['id'], '.json'), json.dumps(session))
+
+    @staticmethod
+    def target_dir(kind):
+        return os.getenv(UPLOAD_KINDS[kind][0])
+
+    @staticmethod
+    def validate(filename, kind):
+        if kind not in UPLOAD_KINDS:
+            raise ValueError(f"Unknown upload kind: {kind}")
+        filename = os.path.basename(filename or '')
+        if not filename or filename.startswith('.'):
+            raise ValueError("Invalid filename")
+        if not filename.lower().endswith(UPLOAD_KINDS[kind][1]):
+            raise ValueError(f"Invalid file format. Allowed: {', '.join(UPLOAD_KINDS[kind][1])}")
+        return filename
+
+    def create(self, filename, size, kind):
+        filename = self.validate(filename, kind)
+        if not isinstance(size, int) or size <= 0:
+            raise ValueError("Invalid size")
+        if size > self.max_size:
+            raise ValueError(f"File too large, limit is {self.max_size} bytes")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.expire()
+        session = {
+            'id': uuid.uuid4().hex,
+            'filename': filename,
+            'kind': kind,
+            'size': size,
+            'offset': 0,
+            'state': 'uploading',
+            'created_at': time.time(),
+            'result': None
+        }
+        open(self._path(session['id'], '.part'), 'wb').close()
+        with self._lock:
+            self._sessions[session['id']] = session
+        self._save(session)
+        upload_log.info(f"Upload {session['id']} started: {filename} ({size} bytes, {kind})")
+        return dict(session)
+
+    def get(self, upload_id):
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if session is None:
+            if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+                return None
+            try:
+                with open(self._path(upload_id, '.json'), 'r') as f:
+                    session = json.load(f)
+            except (OSError, ValueError):
+                return None
+            with self._lock:
+                session = self._sessions.setdefault(upload_id, session)
+        if session['state'] == 'uploading':
+            try:
+                session['offset'] = os.path.getsize(self._path(upload_id, '.part'))
+            except OSError:
+                pass
+        return dict(session)
+
+    def append(self, upload_id, offset, stream):
+        session = self.get(upload_id)
+        if session is None:
+            raise KeyError(upload_id)
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadConflict("Another chunk for this upload is in progress", session['offset'])
+            self._busy.add(upload_id)
+        try:
+            if session['state'] != 'uploading':
+                raise UploadConflict(f"Upload is {session['state']}", session['offset'])
+            if offset != session['offset']:
+                raise UploadConflict("Offset mismatch", session['offset'])
+            part_path = self._path(upload_id, '.part')
+            remaining = session['size'] - offset
+            written = 0
+            with open(part_path, 'ab') as f:
+                while True:
+                    block = stream.read(self.block_size)
+                    if not block:
+                        break
+                    if written + len(block) > remaining:
+                        f.truncate(offset + written)
+                        raise ValueError("Chunk exceeds declared upload size")
+                    f.write(block)
+                    written += len(block)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                stored = self._sessions[upload_id]
+                stored['offset'] = offset + written
+                if stored['offset'] == stored['size']:
+                    stored['state'] = 'ingesting'
+                session = dict(stored)
+            if session['state'] == 'ingesting':
+                self._finish(session, part_path)
+            return self.get(upload_id)
+        finally:
+            with self._lock:
+                self._busy.discard(upload_id)
+
+    def add_file(self, source_path, filename, kind):
+        # Для старых /upload_track и /upload_radio_show: файл уже целиком на диске
+        filename = self.validate(filename, kind)
+        size = os.path.getsize(source_path)
+        if size > self.max_size:
+            os.remove(source_path)
+            raise ValueError(f"File too large, limit is {self.max_size} bytes")
+        session = {
+            'id': uuid.uuid4().hex,
+            'filename': filename,
+            'kind': kind,
+            'size': size,
+            'offset': size,
+            'state': 'ingesting',
+            'created_at': time.time(),
+            'result': None
+        }
+        with self._lock:
+            self._sessions[session['id']] = session
+        self._finish(session, source_path)
+        return dict(session)
+
+    def _finish(self, session, source_path):
+        # Файл разбирается ещё во временном каталоге; расширение нужно mutagen для определения формата
+        ingest_path = self._path(session['id'], os.path.splitext(session['filename'])[1].lower())
+        os.replace(source_path, ingest_path)
+        upload_log.info(f"Upload {session['id']} complete, ingesting {session['filename']}")
+        ingest_pipeline.submit(ingest_path, self.target_dir(session['kind']), session['filename'], session['kind'],
+                               lambda result: self._update(session['id'], state=result['state'], result=result,
+                                                           track_path=result.get('track_path')))
+
+    def _update(self, upload_id, **changes):
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if session is None:
+                return
+            session.update(changes)
+            session = dict(session)
+        try:
+            self._save(session)
+        except OSError as e:
+            upload_log.error(f"Error saving upload session {upload_id}: {str(e)}")
+
+    def cancel(self, upload_id):
+        session = self.get(upload_id)
+        if session is None:
+            return False
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadConflict("A chunk for this upload is in progress", session['offset'])
+            self._sessions.pop(upload_id, None)
+        for suffix in ('.part', '.json'):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+        upload_log.info(f"Upload {upload_id} cancelled")
+        return True
+
+    def expire(self):
+        cutoff = time.time() - self.expire_seconds
+        try:
+            names = os.listdir(self.tmp_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    with self._lock:
+                        self._sessions.pop(name.split('.')[0], None)
+            except OSError:
+                pass
+
+upload_manager = UploadManager(UPLOAD_TMP_DIR, UPLOAD_MAX_SIZE, UPLOAD_BLOCK_SIZE, UPLOAD_EXPIRE_SECONDS)
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    try:
+        data = request.get_json() or {}
+        session = upload_manager.create(data.get('filename'), data.get('size'), data.get('kind', 'track'))
+        session['chunk_size'] = UPLOAD_CHUNK_SIZE
+        return jsonify(session), 201
+    except ValueError as e:
+        upload_log.warning(f"Rejected upload: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        upload_log.error(f"Error in create_upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    session = upload_manager.get(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(session)
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def append_upload(upload_id):
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', -1)))
+        session = upload_manager.append(upload_id, offset, request.stream)
+        return jsonify(session)
+    except KeyError:
+        return jsonify({'error': 'Upload not found'}), 404
+    except UploadConflict as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except ValueError as e:
+        upload_log.warning(f"Rejected chunk for upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        upload_log.error(f"Error in append_upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    try:
+        if not upload_manager.cancel(upload_id):
+            return jsonify({'error': 'Upload not found'}), 404
         return jsonify({'success': True})
+    except UploadConflict as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except Exception as e:
+        upload_log.error(f"Error in cancel_upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def save_legacy_upload(file, kind):
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_TMP_DIR, f"{uuid.uuid4().hex}.legacy")
+    # FileStorage.save копирует поток блоками, файл целиком в память не попадает
+    file.save(tmp_path, buffer_size=UPLOAD_BLOCK_SIZE)
+    try:
+        return upload_manager.add_file(tmp_path, file.filename, kind)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Минимальная обёртка над inotify (Linux) через ctypes: следит за деревом каталогов и
+# отдаёт пачки событий (path, mask).
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK | self.IN_ONLYDIR)
+        if wd < 0:
+            library_log.warning(f"Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+            return
+        self._dirs[wd] = directory
+
+    def add_tree(self, root):
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            self.add(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    stack.extend(entry.path for entry in entries
+                                 if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def read(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self._dirs.get(wd)
+            if mask & self.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not name.startswith('.'):
+                    self.add_tree(path)
+            elif mask & self.IN_CREATE:
+                # Файл ещё пишется — дождёмся IN_CLOSE_WRITE
+                continue
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+# Сверяет аудиофайлы в корнях библиотеки с таблицей tracks. Отпечаток файла — (size, mtime_ns,
+# inode); хеш и теги на пуле процессов ingest считаются только для новых и изменённых файлов,
+# если не запрошено полное пересканирование. Изменения пишутся пакетными транзакциями. Файл,
+# появившийся под новым путём с известным хешем содержимого, сохраняет свою строку
+# (переименование). Строки пропавших файлов получают status='unavailable' и выпадают из ротации.
+class LibraryScanner:
+    def __init__(self, roots, radio_root=None, extensions=('.mp3',), batch_size=500,
+                 watch=False, debounce=2.0, poll_interval=300):
+        self.roots = []
+        for root in roots:
+            root = os.path.normpath(root) if root else None
+            if root and root not in self.roots:
+                self.roots.append(root)
+        self.radio_root = os.path.normpath(radio_root) if radio_root else None
+        self.extensions = tuple(extensions)
+        self.batch_size = max(1, batch_size)
+        self.watch = watch
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.running = None
+        self.last_result = None
+
+    def kind_for(self, path):
+        if self.radio_root and path.startswith(self.radio_root + os.sep):
+            return 'radio_show'
+        return 'track'
+
+    def _is_audio(self, name):
+        return not name.startswith('.') and name.lower().endswith(self.extensions)
+
+    def _walk(self, root, found):
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not entry.name.startswith('.'):
+                                    stack.append(entry.path)
+                            elif self._is_audio(entry.name) and entry.is_file():
+                                stat = entry.stat()
+                                found[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                        except OSError:
+                            continue
+            except OSError as e:
+                # Недоступный корень не повод объявлять все его треки пропавшими
+                if directory == root:
+                    raise
+                library_log.warning(f"Library scan skipped {directory}: {str(e)}")
+
+    def scan(self, full=False):
+        found = {}
+        prefixes = []
+        for root in self.roots:
+            try:
+                self._walk(root, found)
+                prefixes.append(root + os.sep)
+            except OSError as e:
+                library_log.error(f"Library root {root} is not readable, skipping: {str(e)}")
+        return self._run('full' if full else 'incremental', found, prefixes, set(), full)
+
+    def scan_paths(self, paths):
+        found = {}
+        prefixes = []
+        exact = set()
+        for path in paths:
+            if os.path.isdir(path):
+                try:
+                    self._walk(path, found)
+                except OSError:
+                    continue
+                prefixes.append(path + os.sep)
+            elif os.path.isfile(path):
+                if self._is_audio(os.path.basename(path)):
+                    found[path] = file_fingerprint(path)
+                exact.add(path)
+            else:
+                # Удалён файл или каталог целиком
+                exact.add(path)
+                prefixes.append(path + os.sep)
+        return self._run('watch', found, prefixes, exact, False)
+
+    def _run(self, mode, found, prefixes, exact, full):
+        with self._lock:
+            self.running = mode
+            try:
+                result = self._reconcile(mode, found, prefixes, exact, full)
+            except Exception as e:
+                library_log.error(f"Library {mode} scan failed: {str(e)}")
+                result = {'mode': mode, 'error': str(e)}
+            finally:
+                self.running = None
+            self.last_result = result
+            return result
+
+    def _reconcile(self, mode, found, prefixes, exact, full):
+        start_time = time.time()
+        prefixes = tuple(prefixes)
+        with db_pool.read() as conn:
+            rows = conn.execute("""
+                SELECT id, path, status, content_hash, file_size, file_mtime, file_inode FROM tracks
+            """).fetchall()
+        existing = {row['path']: dict(row) for row in rows
+                    if row['path'] and (row['path'] in exact or row['path'].startswith(prefixes))}
+        pending = ingest_pipeline.pending_paths()
+        to_probe = []
+        revive = []
+        for path, fingerprint in found.items():
+            row = existing.get(path)
+            if path in pending:
+                continue
+            if full or row is None or (row['file_size'], row['file_mtime'], row['file_inode']) != fingerprint:
+                to_probe.append(path)
+            elif row['status'] != 'available':
+                revive.append(path)
+        gone = {path: row for path, row in existing.items() if path not in found and path not in pending}
+        gone_by_hash = {row['content_hash']: row for row in gone.values() if row['content_hash']}
+        result = {'mode': mode, 'files': len(found), 'probed': len(to_probe), 'inserted': 0, 'updated': 0,
+                  'renamed': 0, 'revived': len(revive), 'unavailable': 0, 'errors': 0}
+        changed = set(revive)
+        removed = set()
+        batch = []
+
+        def flush():
+            if batch:
+                with db_pool.write() as conn:
+                    for statement, params in batch:
+                        conn.execute(statement, params)
+                del batch[:]
+
+        for path, info in ingest_pipeline.probe_many(to_probe):
+            if info.get('content_hash') is None:
+                result['errors'] += 1
+                library_log.warning(f"Library scan could not read {path}: {info.get('error')}")
+                continue
+            size, mtime, inode = found[path]
+            kind = self.kind_for(path)
+            title = info['title']
+            renamed = gone_by_hash.pop(info['content_hash'], None) if path not in existing else None
+            if path in existing:
+                batch.append(("""
+                    UPDATE tracks SET artist = COALESCE(?, artist), track_title = COALESCE(?, track_title),
+                        duration = COALESCE(?, duration),
+                        analyzed_at = CASE WHEN content_hash IS NULL OR content_hash = ? THEN analyzed_at END,
+                        cover_source = CASE WHEN content_hash IS NULL OR content_hash = ? THEN cover_source END,
+                        content_hash = ?, file_size = ?, file_mtime = ?, file_inode = ?, status = 'available'
+                    WHERE id = ?
+                """, (info['artist'], title, info['duration'], info['content_hash'], info['content_hash'],
+                      info['content_hash'], size, mtime, inode, existing[path]['id'])))
+                result['updated'] += 1
+            elif renamed is not None:
+                # Тот же файл под новым путём: сохраняем строку вместе с playcount и стилем
+                batch.append(("""
+                    UPDATE tracks SET path = ?, name = ?, file_size = ?, file_mtime = ?, file_inode = ?,
+                        status = 'available'
+                    WHERE id = ?
+                """, (path, os.path.basename(path), size, mtime, inode, renamed['id'])))
+                gone.pop(renamed['path'], None)
+                removed.add(renamed['path'])
+                result['renamed'] += 1
+                library_log.info(f"Library: {renamed['path']} moved to {path}")
+            else:
+                batch.append(("""
+                    INSERT INTO tracks (name, path, artist, title, track_title, duration, track_info, status,
+                        playcount, upload_date, content_hash, file_size, file_mtime, file_inode)
+                    SELECT ?, ?, ?, ?, ?, ?, ?, 'available', 0, ?, ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM tracks WHERE path = ?)
+                """, (os.path.basename(path), path, info['artist'], title if kind == 'radio_show' else None, title,
+                      info['duration'], kind, datetime.fromtimestamp(mtime / 1e9).strftime('%Y-%m-%dT%H:%M:%S'),
+                      info['content_hash'], size, mtime, inode, path)))
+                result['inserted'] += 1
+            changed.add(path)
+            if len(batch) >= self.batch_size:
+                flush()
+        missing = [path for path, row in gone.items() if row['status'] != 'unavailable']
+        for path in revive:
+            batch.append(("UPDATE tracks SET status = 'available' WHERE path = ?", (path,)))
+        for path in missing:
+            batch.append(("UPDATE tracks SET status = 'unavailable' WHERE path = ?", (path,)))
+            if len(batch) >= self.batch_size:
+                flush()
+        flush()
+        result['unavailable'] = len(missing)
+        changed.update(missing)
+        if result['inserted'] or result['updated'] or result['revived']:
+            loudness_analyzer.wake()
+            cover_worker.wake()
+        if len(changed) + len(removed) > self.batch_size:
+            track_catalog.load()
+        else:
+            for path in removed:
+                track_catalog.remove(path)
+            for path in changed:
+                track_catalog.refresh_path(path)
+        result['elapsed'] = round(time.time() - start_time, 3)
+        result['finished_at'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        if mode != 'watch' or len(changed) + len(removed):
+            library_log.info(f"Library {mode} scan: {result}")
+        return result
+
+    def mark_unavailable(self, paths):
+        paths = [path for path in paths if path]
+        if not paths:
+            return
+        with db_pool.write() as conn:
+            conn.executemany("UPDATE tracks SET status = 'unavailable' WHERE path = ?", [(path,) for path in paths])
+        for path in paths:
+            track_catalog.refresh_path(path)
+        library_log.warning(f"Marked {len(paths)} tracks unavailable (file missing): {paths[:5]}")
+
+    def start(self, scan_on_start=True):
+        if self._thread is None and self.roots:
+            self._thread = threading.Thread(target=self._loop, args=(scan_on_start,), name='library-scanner', daemon=True)
+            self._thread.start()
+
+    def scan_in_background(self, full=False):
+        if self.running:
+            return False
+        threading.Thread(target=self.scan, args=(full,), name='library-rescan', daemon=True).start()
+        return True
+
+    def _loop(self, scan_on_start):
+        watcher = None
+        if self.watch:
+            try:
+                watcher = InotifyWatcher()
+                for root in self.roots:
+                    if os.path.isdir(root):
+                        watcher.add_tree(root)
+                library_log.info(f"Watching library roots with inotify: {self.roots}")
+            except (OSError, AttributeError) as e:
+                library_log.warning(f"inotify unavailable, polling every {self.poll_interval}s: {str(e)}")
+                watcher = None
+        # Слежение включено до первого прохода: изменения во время сканирования не теряются
+        if scan_on_start:
+            self.scan()
+        if watcher is None:
+            while self.poll_interval:
+                time.sleep(self.poll_interval)
+                self.scan()
+            return
+        changed = set()
+        while True:
+            events = watcher.read(self.debounce if changed else None)
+            if not events:
+                # Тишина в течение debounce: изменения закончились, сверяем пачкой
+                if changed:
+                    paths, changed = changed, set()
+                    if None in paths:
+                        self.scan()
+                    else:
+                        self.scan_paths(paths)
+                continue
+            for path, mask in events:
+                changed.add(path)
+
+library_scanner = LibraryScanner(
+    [TRACKS_DIR, os.getenv('UPLOAD_TRACK_DIR'), os.getenv('UPLOAD_RADIO_DIR')],
+    radio_root=os.getenv('UPLOAD_RADIO_DIR'),
+    extensions=LIBRARY_EXTENSIONS,
+    batch_size=LIBRARY_SCAN_BATCH,
+    watch=LIBRARY_WATCH,
+    debounce=LIBRARY_WATCH_DEBOUNCE,
+    poll_interval=LIBRARY_POLL_INTERVAL
+)
+
+@app.route('/library/scan', methods=['GET'])
+def library_scan_status():
+    return jsonify({
+        'roots': library_scanner.roots,
+        'watch': library_scanner.watch,
+        'running': library_scanner.running,
+        'last_result': library_scanner.last_result
+    })
+
+@app.route('/library/scan', methods=['POST'])
+def library_scan():
+    try:
+        data = request.get_json(silent=True) or {}
+        full = bool(data.get('full')) or request.args.get('full') in ('1', 'true')
+        if not library_scanner.scan_in_background(full):
+            return jsonify({'error': f"Scan already running ({library_scanner.running})"}), 409
+        library_log.info(f"Started {'full' if full else 'incremental'} library scan")
+        return jsonify({'success': True, 'mode': 'full' if full else 'incremental'}), 202
+    except Exception as e:
+        library_log.error(f"Error in library_scan: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Основа фоновых стадий, которые берут пачки строк из SQLite и обрабатывают их на своём пуле
+# процессов. Подклассы реализуют _next_batch() и process(rows); wake() прерывает ожидание,
+# когда появляется новая работа.
+class BackgroundBatchWorker(ABC):
+    name = 'batch-worker'
+
+    def __init__(self, workers=1, batch_size=20, interval=60):
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopped = False
+        self.processed = 0
+        self.failed = 0
+        self.last_batch_at = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_process_context())
+        return self._executor
+
+    def _submit(self, fn, *args):
+        try:
+            return self._pool().submit(fn, *args)
+        except BrokenProcessPool:
+            self._executor = None
+            return self._pool().submit(fn, *args)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    @abstractmethod
+    def _next_batch(self):
+        pass
+
+    @abstractmethod
+    def process(self, rows):
+        pass
+
+    def _closing(self):
+        # concurrent.futures закрывает пулы при выходе интерпретатора раньше наших atexit-обработчиков
+        return self._stopped or concurrent.futures.process._global_shutdown
+
+    def _run(self):
+        while not self._closing():
+            try:
+                rows = self._next_batch()
+                if rows and not self._closing():
+                    self.process(rows)
+                    self.last_batch_at = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+                    continue
+            except Exception as e:
+                # Пул закрыли посреди пачки — это выход, а не ошибка
+                if self._closing():
+                    return
+                library_log.error(f"Error in {self.name}: {str(e)}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def shutdown(self):
+        self._stopped = True
+        self._wake.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+# Офлайн-анализ громкости и точек cue. Берёт доступные треки, которые ещё не анализировались
+# (или у которых изменилось содержимое), декодирует их на пуле и сохраняет громкость, пик и
+# точки cue, одной транзакцией записи на пачку. Ошибки тоже сохраняются, поэтому битый файл не
+# разбирается повторно, пока не изменится его содержимое.
+class LoudnessAnalyzer(BackgroundBatchWorker):
+    name = 'loudness-analyzer'
+
+    def __init__(self, workers=1, batch_size=20, interval=60, silence_db=-50.0, min_silence=0.5):
+        super().__init__(workers, batch_size, interval)
+        self.silence_db = silence_db
+        self.min_silence = min_silence
+
+    @staticmethod
+    def _decodable():
+        # Без ffmpeg разбираются только WAV; остальное ждёт, а не помечается ошибкой
+        return "" if FFMPEG_BIN else " AND lower(path) LIKE '%.wav'"
+
+    def pending(self):
+        with db_pool.read() as conn:
+            return conn.execute(f"""
+                SELECT COUNT(*) FROM tracks WHERE analyzed_at IS NULL AND status = 'available'{self._decodable()}
+            """).fetchone()[0]
+
+    def _next_batch(self):
+        with db_pool.read() as conn:
+            rows = conn.execute(f"""
+                SELECT id, path FROM tracks WHERE analyzed_at IS NULL AND status = 'available'{self._decodable()}
+                ORDER BY id LIMIT ?
+            """, (self.batch_size,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def process(self, rows):
+        futures = {self._submit(analyze_audio_file, row['path'], self.silence_db, self.min_silence): row for row in rows}
+        updates = []
+        analyzed_at = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'error': str(e)}
+            if result.get('error'):
+                self.failed += 1
+                library_log.warning(f"Loudness analysis failed for {row['path']}: {result['error']}")
+            else:
+                self.processed += 1
+            updates.append((result.get('loudness'), result.get('peak'), result.get('cue_in'), result.get('cue_out'),
+                            analyzed_at, result.get('error'), row['id']))
+        with db_pool.write() as conn:
+            conn.executemany("""
+                UPDATE tracks SET loudness_lufs = ?, peak_db = ?, cue_in = ?, cue_out = ?, analyzed_at = ?, analysis_error = ?
+                WHERE id = ?
+            """, updates)
+        ids = [row['id'] for row in rows]
+        track_catalog.refresh(f"id IN ({', '.join('?' * len(ids))})", ids)
+        library_log.info(f"Analyzed loudness for {len(rows)} tracks")
+
+    def stats(self):
+        return {
+            'analyzed': self.processed,
+            'failed': self.failed,
+            'pending': self.pending(),
+            'last_batch_at': self.last_batch_at,
+            'target_lufs': LOUDNESS_TARGET_LUFS,
+            'decoder': 'ffmpeg' if FFMPEG_BIN else 'pcm'
+        }
+
+loudness_analyzer = LoudnessAnalyzer(ANALYSIS_WORKERS, ANALYSIS_BATCH, ANALYSIS_INTERVAL, LOUDNESS_SILENCE_DB, LOUDNESS_MIN_SILENCE)
+
+# URI для Liquidsoap: громкость и cue-точки посчитаны заранее и передаются аннотациями,
+# поэтому Liquidsoap не анализирует трек при каждом проигрывании
+def liquidsoap_uri(track_path):
+    track = track_catalog.get(track_path)
+    if not LIQUIDSOAP_ANNOTATE or not track or not track.get('analyzed_at'):
+        return track_path
+    annotations = []
+    gain = replay_gain(track.get('loudness_lufs'), track.get('peak_db'), LOUDNESS_TARGET_LUFS, LOUDNESS_MAX_GAIN, LOUDNESS_PEAK_CEILING)
+    if gain is not None:
+        annotations.append(f'liq_amplify="{gain:.2f} dB"')
+    if track.get('cue_in'):
+        annotations.append(f'liq_cue_in="{track["cue_in"]:.3f}"')
+    if track.get('cue_out'):
+        annotations.append(f'liq_cue_out="{track["cue_out"]:.3f}"')
+    if not annotations:
+        return track_path
+    return f"annotate:{','.join(annotations)}:{track_path}"
+
+@app.route('/loudness_stats', methods=['GET'])
+def loudness_stats_endpoint():
+    try:
+        return jsonify(loudness_analyzer.stats())
     except Exception as e:
-        logger.error(f"Error in track_added_normal: {str(e)}")
+        logger.error(f"Error in loudness_stats_endpoint: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/update_show', methods=['POST'])
-def update_show():
+# Производные обложек. Для каждого доступного трека, у которого изменился источник обложки
+# (path_img или встроенная картинка, если path_img нет), рисует фиксированные размеры в WebP и
+# JPEG с именем по хешу исходных байтов, чтобы nginx отдавал их как неизменяемые. В базе
+# хранится только хеш; URL выводятся из него.
+class CoverArtWorker(BackgroundBatchWorker):
+    name = 'cover-art'
+
+    def __init__(self, out_dir, sizes=(96, 300, 800), workers=1, batch_size=20, interval=60):
+        super().__init__(workers, batch_size, interval)
+        self.out_dir = out_dir
+        self.sizes = tuple(sizes)
+
+    def pending(self):
+        with db_pool.read() as conn:
+            return conn.execute("""
+                SELECT COUNT(*) FROM tracks WHERE status = 'available' AND cover_source IS NOT COALESCE(path_img, '')
+            """).fetchone()[0]
+
+    def _next_batch(self):
+        with db_pool.read() as conn:
+            rows = conn.execute("""
+                SELECT id, path, path_img FROM tracks
+                WHERE status = 'available' AND cover_source IS NOT COALESCE(path_img, '')
+                ORDER BY id LIMIT ?
+            """, (self.batch_size,)).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def image_file(path_img):
+        # path_img — URL вида /images/...; внешние ссылки не обрабатываем
+        if not path_img.startswith('/images/'):
+            return None
+        relative = os.path.normpath(path_img[len('/images/'):])
+        if relative.startswith('..'):
+            return None
+        return os.path.join(IMAGES_DIR, relative)
+
+    def process(self, rows):
+        futures = {}
+        updates = []
+        for row in rows:
+            source = row['path_img'] or ''
+            image_path = self.image_file(source) if source else None
+            if source and image_path is None:
+                updates.append((None, source, 'Unsupported cover location', row['id'], source))
+                continue
+            futures[self._submit(render_cover_derivatives, image_path, row['path'], self.out_dir, self.sizes)] = row
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'hash': None, 'error': str(e)}
+            if result['error']:
+                self.failed += 1
+                library_log.warning(f"Cover derivatives failed for {row['path']}: {result['error']}")
+            elif result['hash']:
+                self.processed += 1
+            source = row['path_img'] or ''
+            updates.append((result['hash'], source, result['error'], row['id'], source))
+        with db_pool.write() as conn:
+            # path_img мог смениться, пока шла обработка — тогда строка попадёт в следующую пачку
+            conn.executemany("""
+                UPDATE tracks SET cover_hash = ?, cover_source = ?, cover_error = ?
+                WHERE id = ? AND COALESCE(path_img, '') = ?
+            """, updates)
+        ids = [row['id'] for row in rows]
+        track_catalog.refresh(f"id IN ({', '.join('?' * len(ids))})", ids)
+        library_log.info(f"Processed cover art for {len(rows)} tracks")
+
+    def stats(self):
+        return {
+            'rendered': self.processed,
+            'failed': self.failed,
+            'pending': self.pending(),
+            'last_batch_at': self.last_batch_at,
+            'sizes': list(self.sizes)
+        }
+
+cover_worker = CoverArtWorker(COVERS_DIR, COVER_SIZES, COVER_WORKERS, COVER_BATCH, COVER_INTERVAL)
+
+def cover_set(track):
+    cover_hash = track.get('cover_hash') if track else None
+    if not cover_hash:
+        return None
+    return {
+        str(size): {fmt: f"{COVERS_URL}/{cover_file_name(cover_hash, size, fmt)}" for fmt in ('webp', 'jpeg')}
+        for size in COVER_SIZES
+    }
+
+@app.route('/cover_stats', methods=['GET'])
+def cover_stats_endpoint():
     try:
-        data = request.form
-        track_path = data.get('track_path')
-        new_artist = data.get('new_artist')
-        new_title = data.get('new_title')
-        new_style = data.get('new_style')
-        if not track_path:
-            logger.warning("Missing track_path in update_show request")
-            return jsonify({'success': False, 'error': 'Missing track_path'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        # Проверяем, существует ли запись
-        cursor.execute("SELECT 1 FROM tracks WHERE path = ?", (track_path,))
-        if not cursor.fetchone():
-            logger.warning(f"No show found with path {track_path}")
-            conn.close()
-            return jsonify({'success': False, 'error': f"No show found with path {track_path}"}), 404
-        update_query = "UPDATE tracks SET "
-        update_params = []
-        if new_artist:
-            update_query += "artist = ?, "
-            update_params.append(new_artist)
-        if new_title:
-            update_query += "title = ?, "
-            update_params.append(new_title)
-        if new_style:
-            update_query += "style = ?, "
-            update_params.append(new_style)
-        if 'coverFile' in request.files:
-            cover_file = request.files['coverFile']
-            if cover_file.filename != '':
-                if not cover_file.filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    logger.warning("Invalid cover file format")
-                    return jsonify({'success': False, 'error': 'Invalid cover file format. Only JPG, JPEG, PNG allowed.'}), 400
-                cover_dir = os.path.join(os.getenv('IMAGES_DIR', '/home/beasty197/projects/vtrnk_radio/images/'), 'show_covers/')
-                if not os.path.exists(cover_dir):
-                    os.makedirs(cover_dir)
-                    logger.info(f"Created directory {cover_dir}")
-                cover_path = os.path.join(cover_dir, cover_file.filename)
-                cover_file.save(cover_path)
-                logger.info(f"Saved cover file to {cover_path}")
-                update_query += "path_img = ?, "
-                update_params.append('/images/show_covers/' + cover_file.filename)
-        if update_params:
-            update_query = update_query.rstrip(', ') + " WHERE path = ?"
-            update_params.append(track_path)
-            cursor.execute(update_query, update_params)
-            affected_rows = cursor.rowcount
-            conn.commit()
-            if affected_rows > 0:
-                logger.info(f"Updated show for path {track_path}")
-                conn.close()
-                return jsonify({'success': True})
-            else:
-                logger.warning(f"No show found with path {track_path} after update attempt")
-                conn.close()
-                return jsonify({'success': False, 'error': f"No show found with path {track_path}"}), 404
-        else:
-            conn.close()
-            return jsonify({'success': False, 'error': 'No updates provided'}), 400
+        return jsonify(cover_worker.stats())
     except Exception as e:
-        logger.error(f"Error in update_show: {str(e)}")
-        try:
-            conn.close()
-        except:
-            pass
-        return jsonify({'success': False, 'error': str(e)}), 500
+        logger.error(f"Error in cover_stats_endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/upload_radio_show', methods=['POST'])
 def upload_radio_show():
     try:
-        print("Upload request received at /upload_radio_show")
         if 'radioFile' not in request.files:
-            print("No file in request")
+            upload_log.warning("No file in upload_radio_show request")
             return "Нет файла", 400
         file = request.files['radioFile']
-        print(f"File received: {file.filename}")
         if file.filename == '':
-            print("File filename is empty")
+            upload_log.warning("Empty filename in upload_radio_show request")
             return "Файл не выбран", 400
         if not file.filename.lower().endswith('.mp3'):
-            print("File is not MP3")
+            upload_log.warning("Rejected non-MP3 radio show upload: %s", file.filename)
             return "Допустим только формат MP3", 400
-        file_path = os.path.join(os.getenv('UPLOAD_RADIO_DIR'), file.filename)
-        print(f"Saving to: {file_path}")
-        if not os.path.exists(os.getenv('UPLOAD_RADIO_DIR')):
-            os.makedirs(os.getenv('UPLOAD_RADIO_DIR'))
-        file.save(file_path)
-        print(f"File saved successfully to {file_path}")
-        logger.info(f"Uploaded radio show: {file.filename} to {file_path}")
+        session = save_legacy_upload(file, 'radio_show')
+        upload_log.info(f"Uploaded radio show: {file.filename}, upload id {session['id']}")
         return "Радио-шоу успешно загружено", 200
     except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        logger.error(f"Error in upload_radio_show: {str(e)}")
+        upload_log.error(f"Error in upload_radio_show: {str(e)}")
         return f"Ошибка загрузки: {str(e)}", 500
 
 @app.route('/delete_radio_show', methods=['POST'])
@@ -520,27 +3673,24 @@ def delete_radio_show():
         data = request.get_json()
         track_path = data.get('track_path')
         if not track_path:
-            logger.warning("Missing track_path in delete_radio_show request")
+            upload_log.warning("Missing track_path in delete_radio_show request")
             return jsonify({'success': False, 'error': 'Missing track_path'}), 400
         # Удаляем запись из базы данных
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM tracks WHERE path = ? AND track_info = 'radio_show'", (track_path,))
-        affected_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with db_pool.write() as conn:
+            affected_rows = conn.execute("DELETE FROM tracks WHERE path = ? AND track_info = 'radio_show'", (track_path,)).rowcount
         if affected_rows == 0:
-            logger.warning(f"No radio show found with path {track_path}")
+            upload_log.warning(f"No radio show found with path {track_path}")
             return jsonify({'success': False, 'error': f"No radio show found with path {track_path}"}), 404
+        track_catalog.remove(track_path)
         # Удаляем файл с диска
         if os.path.exists(track_path):
             os.remove(track_path)
-            logger.info(f"Deleted radio show file: {track_path}")
+            upload_log.info(f"Deleted radio show file: {track_path}")
         else:
-            logger.warning(f"File not found on disk: {track_path}")
+            upload_log.warning(f"File not found on disk: {track_path}")
         return jsonify({'success': True, 'message': f"Radio show {track_path} deleted successfully"})
     except Exception as e:
-        logger.error(f"Error in delete_radio_show: {str(e)}")
+        upload_log.error(f"Error in delete_radio_show: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/upload_track', methods=['POST'])
@@ -554,17 +3704,59 @@ def upload_track():
         valid_extensions = {'.mp3', '.wav', '.flac'}
         if not any(file.filename.lower().endswith(ext) for ext in valid_extensions):
             return "Недопустимый формат файла", 400
-        file_path = os.path.join(os.getenv('UPLOAD_TRACK_DIR'), file.filename)
-        file.save(file_path)
+        session = save_legacy_upload(file, 'track')
+        upload_log.info(f"Uploaded track: {file.filename}, upload id {session['id']}")
         return "Файл успешно загружен", 200
     except Exception as e:
-        logger.error(f"Error in upload_track: {str(e)}")
+        upload_log.error(f"Error in upload_track: {str(e)}")
         return f"Ошибка загрузки: {str(e)}", 500
 
-@app.route('/db_schema', methods=['GET'])
-def get_db_schema():
-    try:
-        conn = get_db()
+# Сериализованные ответы редко меняющихся эндпоинтов (байты JSON, статус и ETag) в порядке LRU.
+# Ключ включает поколения таблиц, из которых собран ответ, снятые до запроса, поэтому после
+# записи в одну из них старая запись больше не находится и просто вытесняется. 304 отдаётся
+# так же, как для /now_playing.
+class ResponseCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, args, tables, build):
+        key = (endpoint, args, table_generations.snapshot(tables))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            response_cache_requests.inc(endpoint, 'hit')
+            return entry
+        response_cache_requests.inc(endpoint, 'miss')
+        document, status = build()
+        body = json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        entry = (body, status, hashlib.sha1(body).hexdigest()[:20])
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def response(self, endpoint, args, tables, build):
+        body, status, etag = self.get(endpoint, args, tables, build)
+        response = Response(body, status=status, mimetype='application/json')
+        if status != 200:
+            return response
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    def __len__(self):
+        return len(self._entries)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def build_db_schema():
+    with db_pool.read() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
         tables = cursor.fetchall()
@@ -574,20 +3766,55 @@ def get_db_schema():
             cursor.execute(f"PRAGMA table_info({table_name})")
             columns = cursor.fetchall()
             schema[table_name] = [{'name': col['name'], 'type': col['type']} for col in columns]
-        conn.close()
-        logger.info(f"Fetched database schema: {schema}")
-        return jsonify(schema), 200
+    logger.info(f"Fetched database schema: {schema}")
+    return schema, 200
+
+@app.route('/db_schema', methods=['GET'])
+def get_db_schema():
+    try:
+        return response_cache.response('db_schema', None, ('sqlite_master',), build_db_schema)
     except Exception as e:
         logger.error(f"Error fetching database schema: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/db_query_plans', methods=['GET'])
+def get_db_query_plans():
+    try:
+        with db_pool.read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_autoindex%'")
+            indexes = {}
+            for row in cursor.fetchall():
+                indexes.setdefault(row['tbl_name'], []).append({'name': row['name'], 'sql': row['sql']})
+            queries = []
+            for name, sql, params in HOT_QUERIES:
+                try:
+                    cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+                    plan = [row['detail'] for row in cursor.fetchall()]
+                except Exception as e:
+                    plan = [f"error: {str(e)}"]
+                queries.append({
+                    'name': name,
+                    'sql': sql,
+                    'plan': plan,
+                    # SCAN без индекса — полный проход по таблице
+                    'full_scan': any(step.startswith('SCAN') and 'INDEX' not in step for step in plan)
+                })
+            schema_version = get_schema_version(conn)
+        return jsonify({'schema_version': schema_version, 'indexes': indexes, 'queries': queries}), 200
+    except Exception as e:
+        logger.error(f"Error fetching query plans: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @socketio.on('connect')
 def handle_connect():
+    websocket_clients.inc()
     logger.info("WebSocket client connected")
-    emit('track_update', {'message': 'WebSocket connection established'})
+    emit('track_update', get_now_playing_payload()['document'])
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    websocket_clients.dec()
     logger.info("WebSocket client disconnected")
 
 def get_special_queue_contents():
@@ -608,105 +3835,447 @@ def skip_normal_queue():
         logger.error(f"Error skipping normal queue: {str(e)}")
         return str(e)
 
-def schedule_checker():
-    last_played = None
-    conn = get_db()
-    cursor = conn.cursor()
+# Управляющие задания (smart skip, ручной запуск шоу), которые выполняет один поток-секвенсор.
+# Задание — список шагов (delay, name, step); паузы между командами, нужные Liquidsoap, проходят
+# на секвенсоре, поэтому HTTP-обработчики только ставят задание и возвращают его id. Новое
+# задание, дублирующее незавершённое (предикат coalesce), сливается с ним. Недавние задания
+# хранятся для /jobs/<id>, каждое изменение состояния уходит клиентам Socket.IO как 'job_update'.
+# Шаги выполняются на TimerLoop, так что паузы — это события таймера, а не спящий поток.
+class ControlJobQueue(TimerLoop):
+    name = 'control-jobs'
+
+    def __init__(self, keep=200):
+        super().__init__(jobs_log)
+        self.keep = keep
+        self._pending = deque()
+        self._jobs = OrderedDict()
+        self._events = Queue()
+        self._active = None
+
+    def start(self):
+        self._start_thread()
+
+    @staticmethod
+    def view(job):
+        public = {key: value for key, value in job.items() if not key.startswith('_')}
+        public['result'] = dict(job['result'])
+        return public
+
+    def submit(self, kind, steps, params=None, coalesce=None):
+        with self._cond:
+            if coalesce is not None:
+                for job in self._jobs.values():
+                    if job['status'] in ('queued', 'running') and coalesce(job):
+                        job['coalesced'] += 1
+                        control_jobs_coalesced.inc(kind)
+                        jobs_log.info(f"Control job {kind} coalesced into {job['kind']} job {job['id']}")
+                        return self.view(job)
+            job = {
+                'id': uuid.uuid4().hex[:12],
+                'kind': kind,
+                'status': 'queued',
+                'step': None,
+                'params': dict(params or {}),
+                'result': {},
+                'error': None,
+                'coalesced': 0,
+                'created_at': clock.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                'started_at': None,
+                'finished_at': None,
+                '_steps': list(steps)
+            }
+            self._jobs[job['id']] = job
+            self._pending.append(job)
+            self._prune()
+            view = self.view(job)
+        self._events.put(view)
+        jobs_log.info(f"Queued control job {kind} id={job['id']}")
+        self._push(self.now(), self._start_next)
+        return view
+
+    def _prune(self):
+        # Держим не больше keep завершённых заданий; незавершённые не трогаем
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return self.view(job) if job else None
+
+    def recent(self, limit=50):
+        with self._cond:
+            return [self.view(job) for job in list(self._jobs.values())[-limit:]][::-1]
+
+    def _update(self, job, **fields):
+        with self._cond:
+            job.update(fields)
+            view = self.view(job)
+        self._events.put(view)
+
+    def drain_events(self):
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except Empty:
+                return events
+
+    # Задания выполняются строго по одному; паузы между шагами — отложенные события в куче
+    def _start_next(self):
+        with self._cond:
+            if self._active is not None or not self._pending:
+                return
+            job = self._active = self._pending.popleft()
+        job['_started'] = self.now()
+        self._update(job, status='running', started_at=clock.now().strftime('%Y-%m-%dT%H:%M:%S'))
+        self._push(self.now() + job['_steps'][0][0], self._advance, job, 0)
+
+    def _advance(self, job, index):
+        delay, name, step = job['_steps'][index]
+        self._update(job, step=name)
+        try:
+            result = step() or {}
+        except Exception as e:
+            jobs_log.error(f"Control job {job['kind']} id={job['id']} failed at step {name}: {str(e)}")
+            self._finish(job, status='failed', error=str(e))
+            return
+        with self._cond:
+            job['result'].update(result)
+        if index + 1 < len(job['_steps']):
+            self._push(self.now() + job['_steps'][index + 1][0], self._advance, job, index + 1)
+            return
+        jobs_log.info(f"Control job {job['kind']} id={job['id']} completed")
+        self._finish(job, status='done')
+
+    def _finish(self, job, **fields):
+        self._update(job, finished_at=clock.now().strftime('%Y-%m-%dT%H:%M:%S'), **fields)
+        control_job_seconds.observe(self.now() - job['_started'], job['kind'])
+        with self._cond:
+            self._active = None
+        self._start_next()
+
+control_jobs = ControlJobQueue(CONTROL_JOB_KEEP)
+
+# Socket.IO-задача: emit только из неё, а не из потока секвенсора
+def job_event_broadcaster():
     while True:
+        socketio.sleep(NOW_PLAYING_BROADCAST_INTERVAL)
         try:
-            msk_tz = pytz.timezone('Europe/Moscow')
-            current_time = datetime.now(msk_tz)
-            if current_time.second % 10 != 0:  # Проверяем каждые 10 сек (00, 10, 20, 30, 40, 50)
-                time.sleep(1)
-                continue
-            current_time_rounded = current_time.replace(second=0, microsecond=0)
-            current_time_str = current_time_rounded.strftime('%Y-%m-%dT%H:%M')
-            logger.info(f"Checking schedule at {current_time_str}")
-            cursor.execute("SELECT * FROM schedule WHERE enabled = 1 AND queued = 0")
-            schedule = [dict(row) for row in cursor.fetchall()]
-            for entry in schedule:
-                try:
-                    # Парсинг start_time
-                    try:
-                        scheduled_time = datetime.strptime(entry['start_time'], '%Y-%m-%dT%H:%M').replace(tzinfo=msk_tz)
-                    except ValueError:
-                        scheduled_time = datetime.strptime(entry['start_time'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=msk_tz)
-                    scheduled_time_str = scheduled_time.strftime('%Y-%m-%dT%H:%M')
-                    window_end = scheduled_time + timedelta(minutes=5)
-                    window_end_str = window_end.strftime('%Y-%m-%dT%H:%M')
-                    logger.info(f"Schedule entry: id={entry['id']}, track_path={entry['track_path']}, start_time={scheduled_time_str}, current_time={current_time_str}, window_end={window_end_str}")
-                    if current_time_str >= scheduled_time_str and current_time_str <= window_end_str:
-                        success = False
-                        for attempt in range(1, 4):  # 3 attempts
-                            logger.info(f"Attempt {attempt}/3 to add show {entry['track_path']} to special_queue")
-                            # Send play_radio_show without checks
-                            response = liquidsoap_command(f"play_radio_show {entry['track_path']}")
-                            # Skip normal queue
-                            time.sleep(5)  # Увеличено до 5s для switch/crossfade
-                            skip_response = skip_normal_queue()
-                            logger.info(f"Skipped normal queue after 5s delay, response: {skip_response}")
-                            # Sleep 55s
-                            time.sleep(55)
-                            # Check
-                            current_track_data = get_current_track()
-                            current_filename = current_track_data.get('filename', '')
-                            special_contents = get_special_queue_contents()
-                            if current_filename == entry['track_path']:
-                                logger.info(f"Success on attempt {attempt}: Show {entry['track_path']} is playing")
-                                success = True
-                                break
-                            elif entry['track_path'] in special_contents.split(','):
-                                logger.info(f"Success on attempt {attempt}: Show {entry['track_path']} in special_queue")
-                                success = True
-                                break
-                            else:
-                                logger.warning(f"Retry: Show not found, special_contents={special_contents}, current_filename={current_filename}")
-                        if success:
-                            cursor.execute("UPDATE schedule SET queued = 1, enabled = 0 WHERE id = ?", (entry['id'],))
-                            conn.commit()
-                            logger.info(f"Marked as queued=1 and enabled=0 for schedule entry id={entry['id']}, track={entry['track_path']}")
-                        else:
-                            logger.error(f"Failed to add show {entry['track_path']} after 3 attempts")
-                    else:
-                        logger.info(f"Condition not met for entry id={entry['id']}")
-                except ValueError as e:
-                    logger.error(f"Invalid start_time for entry {entry['id']}: {str(e)}")
-                    continue
-            time.sleep(1)  # Пауза
+            for event in control_jobs.drain_events():
+                socketio.emit('job_update', event)
+        except Exception as e:
+            jobs_log.error(f"Error broadcasting job_update: {str(e)}")
+
+socketio.start_background_task(job_event_broadcaster)
+
+# Куча таймеров для шоу по расписанию. Ближайшие записи загружаются один раз (и снова после
+# /schedule_play, /schedule/delete или по SCHEDULE_RELOAD_INTERVAL); поток спит до самого
+# раннего события. Каждое шоу идёт своим конечным автоматом из шагов по времени
+# (insert -> skip -> verify -> retry), поэтому шоу никогда не ждут друг друга.
+class ScheduleExecutor(TimerLoop):
+    name = 'schedule-executor'
+
+    def __init__(self, timezone, window_minutes=5, attempts=3, skip_delay=5, verify_delay=55, reload_interval=300):
+        super().__init__(schedule_log)
+        self.timezone = timezone
+        self.window = timedelta(minutes=window_minutes)
+        self.attempts = attempts
+        self.skip_delay = skip_delay
+        self.verify_delay = verify_delay
+        self.reload_interval = reload_interval
+        self._generation = 0
+        self._entries = {}
+        self._running = {}
+
+    @staticmethod
+    def parse_start_time(value, tz):
+        try:
+            scheduled_time = datetime.strptime(value, '%Y-%m-%dT%H:%M')
+        except ValueError:
+            scheduled_time = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+        return tz.localize(scheduled_time) if hasattr(tz, 'localize') else scheduled_time.replace(tzinfo=tz)
+
+    def start(self):
+        if self._thread is None:
+            self.reload()
+            self._start_thread()
+
+    def reload(self):
+        try:
+            with db_pool.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM schedule WHERE enabled = 1 AND queued = 0")
+                rows = [dict(row) for row in cursor.fetchall()]
         except Exception as e:
-            logger.error(f"Error in schedule_checker: {str(e)}")
+            schedule_log.error(f"Error loading schedule: {str(e)}")
+            return
+        now = self.now()
+        entries = {}
+        for entry in rows:
             try:
-                conn.close()
-            except:
-                pass
+                scheduled_time = self.parse_start_time(entry['start_time'], self.timezone)
+            except (ValueError, TypeError) as e:
+                schedule_log.error(f"Invalid start_time for entry {entry['id']}: {str(e)}")
+                continue
+            # Как и раньше, показ запускается в течение окна после start_time (с точностью до минуты)
+            window_end = (scheduled_time + self.window).replace(second=59)
+            if window_end.timestamp() < now:
+                continue
+            entry['due'] = scheduled_time.timestamp()
+            entry['window_end'] = window_end.timestamp()
+            entries[entry['id']] = entry
+        with self._cond:
+            self._generation += 1
+            generation = self._generation
+            previous = self._entries
+            self._entries = entries
+            for entry_id in list(self._running):
+                if entry_id not in entries:
+                    schedule_log.info(f"Schedule entry id={entry_id} removed, cancelling its run")
+                    del self._running[entry_id]
+        for entry_id, entry in entries.items():
+            # Уже взведённые записи с тем же временем повторно в кучу не кладём
+            old = previous.get(entry_id)
+            if entry_id not in self._running and (old is None or old['due'] != entry['due']):
+                self._push(max(entry['due'], now), self._begin, entry_id, entry['due'])
+        if self.reload_interval:
+            self._push(now + self.reload_interval, self._periodic_reload, generation)
+        schedule_log.info(f"Loaded schedule: {len(entries)} upcoming entries")
+
+    def _periodic_reload(self, generation):
+        if generation == self._generation:
+            self.reload()
+
+    def _begin(self, entry_id, due):
+        with self._cond:
+            entry = self._entries.get(entry_id)
+            if entry is None or entry['due'] != due or entry_id in self._running:
+                return
+            run = {'entry': entry, 'attempt': 0}
+            self._running[entry_id] = run
+        self._insert(entry_id, run)
+
+    def _active(self, entry_id, run):
+        with self._cond:
+            return self._running.get(entry_id) is run
+
+    def _insert(self, entry_id, run):
+        if not self._active(entry_id, run):
+            return
+        entry = run['entry']
+        run['attempt'] += 1
+        schedule_log.info(f"Attempt {run['attempt']}/{self.attempts} to add show {entry['track_path']} to special_queue")
+        response = liquidsoap_command(f"play_radio_show {entry['track_path']}")
+        schedule_log.info(f"Sent to Liquidsoap: play_radio_show {entry['track_path']}, response: {response}")
+        # Задержка 5s для switch/crossfade, затем пропуск normal_queue
+        self._push(self.now() + self.skip_delay, self._skip, entry_id, run)
+
+    def _skip(self, entry_id, run):
+        if not self._active(entry_id, run):
+            return
+        skip_response = skip_normal_queue()
+        schedule_log.info(f"Skipped normal queue after {self.skip_delay}s delay, response: {skip_response}")
+        self._push(self.now() + self.verify_delay, self._verify, entry_id, run)
+
+    def _verify(self, entry_id, run):
+        if not self._active(entry_id, run):
+            return
+        entry = run['entry']
+        current_filename = get_current_track().get('filename', '')
+        special_contents = get_special_queue_contents()
+        if current_filename == entry['track_path']:
+            schedule_attempts.inc('success')
+            schedule_log.info(f"Success on attempt {run['attempt']}: Show {entry['track_path']} is playing")
+        elif entry['track_path'] in special_contents.replace('\n', ',').split(','):
+            schedule_attempts.inc('success')
+            schedule_log.info(f"Success on attempt {run['attempt']}: Show {entry['track_path']} in special_queue")
+        else:
+            schedule_log.warning(f"Retry: Show not found, special_contents={special_contents}, current_filename={current_filename}")
+            if run['attempt'] < self.attempts:
+                schedule_attempts.inc('retry')
+                self._push(self.now(), self._insert, entry_id, run)
+                return
+            schedule_attempts.inc('failure')
+            schedule_log.error(f"Failed to add show {entry['track_path']} after {self.attempts} attempts")
+            with self._cond:
+                self._running.pop(entry_id, None)
+            # Пока окно не закрылось, запускаем новый круг попыток
+            if self.now() < entry['window_end']:
+                self._push(self.now(), self._begin, entry_id, entry['due'])
+            return
+        self._mark_queued(entry)
+        with self._cond:
+            self._running.pop(entry_id, None)
+            self._entries.pop(entry_id, None)
+
+    def _mark_queued(self, entry):
+        try:
+            with db_pool.write() as conn:
+                conn.execute("UPDATE schedule SET queued = 1, enabled = 0 WHERE id = ?", (entry['id'],))
+            schedule_log.info(f"Marked as queued=1 and enabled=0 for schedule entry id={entry['id']}, track={entry['track_path']}")
+        except Exception as e:
+            schedule_log.error(f"Error marking schedule entry id={entry['id']} as queued: {str(e)}")
+
+    def pending(self):
+        with self._cond:
+            return [
+                {'id': entry_id, 'track_path': entry['track_path'], 'start_time': entry['start_time'],
+                 'running': entry_id in self._running}
+                for entry_id, entry in sorted(self._entries.items(), key=lambda item: item[1]['due'])
+            ]
+
+schedule_executor = ScheduleExecutor(
+    pytz.timezone('Europe/Moscow'),
+    window_minutes=SCHEDULE_WINDOW_MINUTES,
+    attempts=SCHEDULE_ATTEMPTS,
+    reload_interval=SCHEDULE_RELOAD_INTERVAL
+)
+
+# Выбор лидера среди процессов radio_player, запущенных cluster.py. Лидер всю жизнь держит
+# исключительную POSIX-блокировку (lockf) на LEADER_LOCK_FILE и пишет туда свой HTTP-адрес;
+# ядро снимает блокировку, когда процесс умирает, и её забирает ведомый, повторяющий попытку
+# каждые LEADER_RETRY_INTERVAL секунд. В отличие от flock, блокировка не делится с рабочими
+# процессами пулов, которые могут пережить лидера. Без LEADER_LOCK_FILE процесс единственный
+# и сразу лидер.
+class LeaderElection:
+    def __init__(self, lock_path, address, retry_interval):
+        self.lock_path = lock_path
+        self.address = address
+        self.retry_interval = retry_interval
+        self.is_leader = not lock_path
+        self._file = None
+        self._leader_cache = (None, None)
+        self._thread = None
+
+    @staticmethod
+    def _open(path):
+        # Без усечения (его сделает только лидер) и с позицией в начале: lockf блокирует от позиции до конца файла
+        return os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+')
+
+    @contextmanager
+    def exclusive(self, name):
+        # Короткая межпроцессная блокировка, например на время миграций при одновременном старте
+        if not self.lock_path:
+            yield
+            return
+        with self._open(f"{self.lock_path}.{name}") as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
             try:
-                conn = get_db()
-                cursor = conn.cursor()
-            except Exception as db_err:
-                logger.error(f"Failed to reconnect to database: {str(db_err)}")
-            time.sleep(10)
-    try:
-        conn.close()
-    except:
-        pass
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def try_acquire(self):
+        f = self._open(self.lock_path)
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(f"{self.address} {os.getpid()} {WORKER_ID}\n")
+        f.flush()
+        self._file = f
+        self.is_leader = True
+        logger.info(f"Worker {WORKER_ID} (pid {os.getpid()}) is the leader, address {self.address}")
+        return True
+
+    def leader_address(self):
+        if self.is_leader:
+            return self.address
+        try:
+            mtime = os.stat(self.lock_path).st_mtime_ns
+            if self._leader_cache[0] != mtime:
+                with open(self.lock_path) as f:
+                    fields = f.read().split()
+                self._leader_cache = (mtime, fields[0] if fields else None)
+            return self._leader_cache[1]
+        except OSError:
+            return None
+
+    def start(self, on_elected):
+        if not self.lock_path:
+            on_elected(False)
+            return
+        if self.try_acquire():
+            on_elected(False)
+            return
+        logger.info(f"Worker {WORKER_ID} is a follower, leader at {self.leader_address()}")
+        self._thread = threading.Thread(target=self._wait, args=(on_elected,), name='leader-election', daemon=True)
+        self._thread.start()
+
+    def _wait(self, on_elected):
+        while not self.try_acquire():
+            time.sleep(self.retry_interval)
+        try:
+            on_elected(True)
+        except Exception as e:
+            logger.error(f"Error taking over leader duties: {str(e)}")
+
+leader_election = LeaderElection(LEADER_LOCK_FILE, f"127.0.0.1:{HTTP_PORT}", LEADER_RETRY_INTERVAL)
+
+with leader_election.exclusive('init'):
+    run_migrations()
+    ensure_tracks_fts()
+track_catalog.load()
+playback_history.load()
+now_playing.load()
+play_event_writer.start()
+# atexit вызывает в обратном порядке: сначала дописываем очередь, потом закрываем соединения
+atexit.register(db_pool.close)
+atexit.register(play_event_writer.stop)
+atexit.register(ingest_pipeline.shutdown)
+atexit.register(loudness_analyzer.shutdown)
+atexit.register(cover_worker.shutdown)
+if control_loop is not None:
+    # Пополнение очереди — задания AsyncIOScheduler в control_loop; синхронные задания идут в пул потоков цикла
+    scheduler = AsyncIOScheduler(event_loop=control_loop.loop)
+    control_loop.add_shutdown_hook(liquidsoap_client.close)
+
+    async def stop_scheduler():
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+
+    control_loop.add_shutdown_hook(stop_scheduler)
+    control_loop.start()
+    # Регистрируется последним, значит при выходе останавливается первым: задачи цикла ещё пишут в базу
+    atexit.register(control_loop.stop)
+else:
+    scheduler = BackgroundScheduler()
 
-threading.Thread(target=schedule_checker, daemon=True).start()
-scheduler = AsyncIOScheduler()
-scheduler.add_job(add_track_to_queue, "interval", seconds=10)
-logger.info("Starting scheduler for add_track_to_queue every 10 seconds")
-scheduler.start()
-logger.info("Scheduler started")
-add_track_to_queue()
+# Всё, что говорит с Liquidsoap или пишет в фоне, работает только у лидера
+def start_leader_duties(takeover):
+    if takeover:
+        # Пока процесс был ведомым, плейаутом занимался другой лидер: состояние в памяти устарело
+        track_catalog.load()
+        playback_history.load()
+        now_playing.load()
+    schedule_executor.start()
+    control_jobs.start()
+    library_scanner.start(LIBRARY_SCAN_ON_START)
+    loudness_analyzer.start()
+    cover_worker.start()
+    scheduler.add_job(add_track_to_queue, "interval", seconds=REFILL_SAFETY_INTERVAL, id='refill_safety')
+    logger.info(f"Starting scheduler for add_track_to_queue every {REFILL_SAFETY_INTERVAL} seconds")
+    scheduler.start()
+    logger.info("Scheduler started")
+    add_track_to_queue()
+
+leader_election.start(start_leader_duties)
+if SOCKETIO_MESSAGE_QUEUE and not socketio.server.manager_initialized:
+    # Слушатель шины стартует с первым клиентом Socket.IO; ведомому он нужен сразу, ради зеркала track_update
+    socketio.server.manager_initialized = True
+    socketio.server.manager.initialize()
 logger.info("Starting radio player, initializing Flask server")
 
 def reset_play_counts():
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tracks SET playcount = 0")
-        affected_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with db_pool.write() as conn:
+            affected_rows = conn.execute("UPDATE tracks SET playcount = 0").rowcount
+        track_catalog.reset_playcounts()
         logger.info(f"Reset play counts for {affected_rows} tracks")
         return {"success": True, "message": f"Reset play counts for {affected_rows} tracks"}
     except Exception as e:
@@ -715,49 +4284,29 @@ def reset_play_counts():
 
 def fetch_cover_path():
     try:
-        with open(CURRENT_TRACK_FILE, 'r') as f:
-            data = json.load(f)
-        filename = data.get('filename', '')
+        filename = now_playing.snapshot().current.get('filename', '')
         if not filename:
-            logger.warning("No filename found in JSON")
+            logger.warning("No current track in now playing state")
             return "/images/placeholder2.png"
-        static_cover = getattr(fetch_cover_path, 'static_cover', None)
-        if static_cover and static_cover['filename'] == filename:
-            return static_cover['cover_path']
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT path_img FROM tracks WHERE path = ?", (filename,))
-        track = cursor.fetchone()
-        conn.close()
-        cover_path = track['path_img'] if track and track['path_img'] else "/images/placeholder2.png"
-        logger.debug(f"Found cover for {filename}: {cover_path}")
-        fetch_cover_path.static_cover = {'filename': filename, 'cover_path': cover_path}
+        cover_path = get_cover_for_track(filename)
+        logger.debug("Found cover for %s: %s", filename, cover_path)
         return cover_path
     except Exception as e:
-        logger.error(f"Error fetching cover path: {str(e)}")
+        logger.error("Error fetching cover path: %s", e)
         return "/images/placeholder2.png"
 
 @app.route('/get_next_track', methods=['GET'])
 def get_next_track_endpoint():
-    global next_track
     try:
+        next_track = now_playing.snapshot().next_track
         if not next_track:
             logger.warning("No next track available")
             return jsonify({"next_track": "", "cover_path": "/images/placeholder2.png"}), 200
-        static_next_track = getattr(get_next_track_endpoint, 'static_next_track', None)
-        if static_next_track and static_next_track['next_track'] == next_track:
-            return jsonify({"next_track": next_track, "cover_path": static_next_track['cover_path']})
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT path_img FROM tracks WHERE path = ?", (next_track,))
-        track = cursor.fetchone()
-        conn.close()
-        cover_path = track['path_img'] if track and track['path_img'] else "/images/placeholder2.png"
-        logger.debug(f"Returning next track: {next_track}, cover: {cover_path}")
-        get_next_track_endpoint.static_next_track = {'next_track': next_track, 'cover_path': cover_path}
+        cover_path = get_cover_for_track(next_track)
+        logger.debug("Returning next track: %s, cover: %s", next_track, cover_path)
         return jsonify({"next_track": next_track, "cover_path": cover_path})
     except Exception as e:
-        logger.error(f"Error in get_next_track_endpoint: {str(e)}")
+        logger.error("Error in get_next_track_endpoint: %s", e)
         return jsonify({"next_track": "", "cover_path": "/images/placeholder2.png"}), 500
 
 @app.route('/test', methods=['GET'])
@@ -765,6 +4314,91 @@ def test_endpoint():
     logger.info("Test endpoint accessed")
     return jsonify({"message": "Test endpoint works!"})
 
+@app.route('/liquidsoap_stats', methods=['GET'])
+def liquidsoap_stats_endpoint():
+    try:
+        return jsonify(liquidsoap_client.stats())
+    except Exception as e:
+        logger.error(f"Error in liquidsoap_stats_endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/db_pool_stats', methods=['GET'])
+def db_pool_stats_endpoint():
+    try:
+        return jsonify(db_pool.stats())
+    except Exception as e:
+        logger.error(f"Error in db_pool_stats_endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Шаблон маршрута, а не сам URL, чтобы число серий не росло с каждым id
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - started, route, request.method)
+        http_requests_total.inc(route, request.method, str(response.status_code))
+    return response
+
+# Что ведомый процесс обслуживает сам: чтение из SQLite, /now_playing с шины и собственные метрики.
+# Остальное (команды Liquidsoap, записи, загрузки, состояние фоновых задач) пересылается лидеру
+FOLLOWER_LOCAL_ENDPOINTS = frozenset((
+    'static', 'get_tracks', 'get_styles', 'get_schedule', 'get_db_schema', 'get_db_query_plans',
+    'get_track_duration_endpoint', 'now_playing_endpoint', 'test_endpoint', 'metrics_endpoint', 'db_pool_stats_endpoint'
+))
+HOP_BY_HOP_HEADERS = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+    'transfer-encoding', 'upgrade', 'content-length', 'server', 'date'
+))
+
+@app.before_request
+def forward_to_leader():
+    if leader_election.is_leader or request.endpoint is None or request.endpoint in FOLLOWER_LOCAL_ENDPOINTS:
+        return None
+    address = leader_election.leader_address()
+    # Пересланный запрос пришёл не к лидеру (лидер только что сменился) — второй раз не пересылаем
+    if not address or request.headers.get('X-Radio-Forwarded'):
+        return jsonify({'error': 'No leader process available'}), 503
+    host, port = address.rsplit(':', 1)
+    connection = http.client.HTTPConnection(host, int(port), timeout=LEADER_PROXY_TIMEOUT, blocksize=UPLOAD_BLOCK_SIZE)
+    try:
+        with leader_proxy_seconds.time():
+            headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+            headers['X-Radio-Forwarded'] = WORKER_ID
+            # Тело (загрузки до UPLOAD_MAX_SIZE) передаётся потоком блоками по UPLOAD_BLOCK_SIZE, в память
+            # целиком не читается; без Content-Length http.client отправит его chunked
+            body = None
+            if request.content_length is not None:
+                headers['Content-Length'] = str(request.content_length)
+                body = request.stream
+            elif request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = request.stream
+            connection.request(request.method, request.full_path if request.query_string else request.path,
+                               body=body, headers=headers)
+            upstream = connection.getresponse()
+            body = upstream.read()
+        # CORS-заголовки добавит flask_cors этого процесса
+        headers = [(key, value) for key, value in upstream.getheaders()
+                   if key.lower() not in HOP_BY_HOP_HEADERS and not key.lower().startswith('access-control-')]
+        return Response(body, status=upstream.status, headers=headers)
+    except (OSError, http.client.HTTPException) as e:
+        logger.error("Error forwarding %s %s to leader %s: %s", request.method, request.path, address, e)
+        return jsonify({'error': f"Leader unavailable: {str(e)}"}), 502
+    finally:
+        connection.close()
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    try:
+        return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    except Exception as e:
+        logger.error(f"Error in metrics_endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/reset_play_counts', methods=['POST'])
 def reset_play_counts_endpoint():
     try:
@@ -779,20 +4413,106 @@ def reset_play_counts_endpoint():
 
 @app.route('/tracks', methods=['GET'])
 def get_tracks():
+    conn = None
     try:
-        conn = get_db()
+        args = request.args
+        conn = db_pool.acquire_read()
         cursor = conn.cursor()
-        if 'schedule' in request.url:
-            cursor.execute("SELECT * FROM tracks WHERE status = 'available' AND track_info = 'radio_show' ORDER BY upload_date DESC")
-        else:
-            cursor.execute("SELECT * FROM tracks WHERE status = 'available' ORDER BY upload_date DESC")
-        tracks = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        logger.info(f"Fetched {len(tracks)} tracks")
-        return jsonify(tracks)
+        columns = get_table_columns(cursor, 'tracks')
+        fields = [field for field in args.get('fields', '').split(',') if field]
+        unknown = [field for field in fields if field not in columns]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+        select_columns = list(dict.fromkeys((fields or columns) + ['id', 'upload_date']))
+        conditions = ["status = ?"]
+        params = [args.get('status', 'available')]
+        # Раньше выбор делался по подстроке 'schedule' в URL; теперь явный параметр ?schedule или track_info
+        if 'schedule' in args or 'schedule' in args.values():
+            conditions.append("track_info = 'radio_show'")
+        for column in ('style', 'track_info'):
+            if args.get(column):
+                conditions.append(f"{column} = ?")
+                params.append(args[column])
+        if args.get('artist'):
+            conditions.append("artist = ? COLLATE NOCASE")
+            params.append(args['artist'])
+        query = args.get('q', '').strip()
+        if query:
+            if tracks_fts_available:
+                conditions.append("id IN (SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ?)")
+                params.append(build_fts_query(query))
+            else:
+                searchable = [col for col in TRACKS_FTS_COLUMNS if col in columns]
+                conditions.append('(' + ' OR '.join(f"{col} LIKE ?" for col in searchable) + ')')
+                params.extend([f"%{query}%"] * len(searchable))
+        if args.get('cursor'):
+            try:
+                cursor_date, cursor_id = decode_tracks_cursor(args['cursor'])
+            except Exception:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            conditions.append("(COALESCE(upload_date, '') < ? OR (COALESCE(upload_date, '') = ? AND id < ?))")
+            params.extend([cursor_date, cursor_date, cursor_id])
+        limit = args.get('limit', type=int)
+        sql = f"""
+            SELECT {', '.join(select_columns)}
+            FROM tracks
+            WHERE {' AND '.join(conditions)}
+            ORDER BY COALESCE(upload_date, '') DESC, id DESC
+        """
+        if limit is not None:
+            limit = max(1, min(limit, TRACKS_PAGE_MAX))
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        cursor.execute(sql, params)
+
+        def project(row):
+            track = dict(row)
+            return {field: track[field] for field in fields} if fields else track
+
+        if args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+            # Соединение остаётся у генератора до конца потока
+            stream_conn, conn = conn, None
+
+            def generate():
+                try:
+                    sent = 0
+                    while True:
+                        rows = cursor.fetchmany(200)
+                        if not rows:
+                            break
+                        for row in rows:
+                            if limit is not None and sent >= limit:
+                                return
+                            sent += 1
+                            yield json.dumps(project(row), ensure_ascii=False) + "\n"
+                finally:
+                    db_pool.release_read(stream_conn)
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        rows = cursor.fetchall()
+        if limit is None:
+            tracks = [project(row) for row in rows]
+            logger.info(f"Fetched {len(tracks)} tracks")
+            return jsonify(tracks)
+        next_cursor = encode_tracks_cursor(rows[limit - 1]) if len(rows) > limit else None
+        tracks = [project(row) for row in rows[:limit]]
+        logger.info(f"Fetched page of {len(tracks)} tracks")
+        return jsonify({'tracks': tracks, 'next_cursor': next_cursor})
     except Exception as e:
         logger.error(f"Error in get_tracks: {str(e)}")
         return jsonify([]), 500
+    finally:
+        if conn is not None:
+            db_pool.release_read(conn)
+
+def build_track_duration(track_name):
+    with db_pool.read() as conn:
+        track = conn.execute("SELECT duration FROM tracks WHERE name = ?", (track_name,)).fetchone()
+    if track and track['duration']:
+        logger.info(f"Found duration for {track_name}: {track['duration']}")
+        return {'duration': track['duration']}, 200
+    logger.warning(f"No duration found for {track_name}")
+    return {'error': f"No duration found for {track_name}"}, 404
 
 @app.route('/track_duration', methods=['POST'])
 def get_track_duration_endpoint():
@@ -802,31 +4522,22 @@ def get_track_duration_endpoint():
         if not track_name:
             logger.warning("Missing track_name in track_duration request")
             return jsonify({'error': 'Missing track_name'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT duration FROM tracks WHERE name = ?", (track_name,))
-        track = cursor.fetchone()
-        conn.close()
-        if track and track['duration']:
-            logger.info(f"Found duration for {track_name}: {track['duration']}")
-            return jsonify({'duration': track['duration']})
-        else:
-            logger.warning(f"No duration found for {track_name}")
-            return jsonify({'error': f"No duration found for {track_name}"}), 404
+        return response_cache.response('track_duration', track_name, ('tracks',), lambda: build_track_duration(track_name))
     except Exception as e:
         logger.error(f"Error in get_track_duration: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def build_styles():
+    with db_pool.read() as conn:
+        cursor = conn.execute("SELECT style, COUNT(*) as count FROM tracks WHERE status = 'available' GROUP BY style")
+        styles = [{'style': row['style'] or 'Unknown', 'count': row['count']} for row in cursor.fetchall()]
+    logger.info(f"Fetched {len(styles)} styles")
+    return {'styles': styles}, 200
+
 @app.route('/styles', methods=['GET'])
 def get_styles():
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT style, COUNT(*) as count FROM tracks WHERE status = 'available' GROUP BY style")
-        styles = [{'style': row['style'] or 'Unknown', 'count': row['count']} for row in cursor.fetchall()]
-        conn.close()
-        logger.info(f"Fetched {len(styles)} styles")
-        return jsonify({'styles': styles})
+        return response_cache.response('styles', None, ('tracks',), build_styles)
     except Exception as e:
         logger.error(f"Error in get_styles: {str(e)}")
         return jsonify({'styles': []}), 500
@@ -840,15 +4551,12 @@ def update_style():
         if not track_name or not new_style:
             logger.warning("Missing track_name or style in update_style request")
             return jsonify({'error': 'Missing track_name or style'}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tracks SET style = ? WHERE name = ?", (new_style, track_name))
-        affected_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with db_pool.write() as conn:
+            affected_rows = conn.execute("UPDATE tracks SET style = ? WHERE name = ?", (new_style, track_name)).rowcount
         if affected_rows == 0:
             logger.warning(f"No track found with name {track_name}")
             return jsonify({'error': f"No track found with name {track_name}"}), 404
+        track_catalog.refresh("name = ?", (track_name,))
         logger.info(f"Updated style for track {track_name} to {new_style}")
         return jsonify({'success': True})
     except Exception as e:
@@ -868,39 +4576,170 @@ def update_track_info():
         if new_track_info not in valid_types:
             logger.warning(f"Invalid track_info value: {new_track_info}")
             return jsonify({'error': f"Invalid track_info value. Must be one of {valid_types}"}), 400
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tracks SET track_info = ? WHERE id = ?", (new_track_info, track_id))
-        affected_rows = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with db_pool.write() as conn:
+            affected_rows = conn.execute("UPDATE tracks SET track_info = ? WHERE id = ?", (new_track_info, track_id)).rowcount
         if affected_rows == 0:
             logger.warning(f"No track found with id {track_id}")
             return jsonify({'error': f"No track found with id {track_id}"}), 404
+        track_catalog.refresh("id = ?", (track_id,))
         logger.info(f"Updated track_info for track id {track_id} to {new_track_info}")
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error in update_track_info: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def describe_track(track_path):
+    track = track_catalog.get(track_path)
+    artist, title = get_track_metadata(track_path)
+    return {
+        'filename': track_path,
+        'artist': artist,
+        'title': title,
+        'cover_path': get_cover_for_track(track_path),
+        'cover': cover_set(track),
+        'duration': track['duration'] if track else None
+    }
+
+def build_now_playing(snapshot):
+    current = snapshot.current
+    filename = current.get('filename', '')
+    document = describe_track(filename) if filename else {
+        'filename': '', 'artist': 'VTRNK', 'title': 'Radio Show',
+        'cover_path': '/images/placeholder2.png', 'cover': None, 'duration': None
+    }
+    # Трека нет в каталоге — берём артиста и название, пришедшие от Liquidsoap
+    if filename and track_catalog.get(filename) is None:
+        document['artist'] = current.get('artist') or document['artist']
+        document['title'] = current.get('title') or document['title']
+    document.update({
+        'version': snapshot.version,
+        'started_at': current.get('started_at'),
+        'timestamp': current.get('timestamp'),
+        'queue': current.get('queue'),
+        'normal_queue_length': current.get('normal_queue_length'),
+        'special_queue_length': current.get('special_queue_length'),
+        'special_queue_timestamp': current.get('special_queue_timestamp', ''),
+        'normal_queue_timestamp': current.get('normal_queue_timestamp', ''),
+        'track_queue_timestamp': current.get('track_queue_timestamp', ''),
+        'next_track': describe_track(snapshot.next_track) if snapshot.next_track else None
+    })
+    return document
+
+# Сериализованный документ /now_playing, один на версию состояния
+now_playing_cache_lock = threading.Lock()
+now_playing_cache = {'version': None, 'document': None, 'body': b'', 'etag': ''}
+# Последний track_update лидера с шины Socket.IO: ведомый процесс отдаёт его вместо своего состояния
+bus_now_playing = None
+
+def now_playing_payload(version, document):
+    body = json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return {
+        'version': version,
+        'document': document,
+        'body': body,
+        'etag': hashlib.sha1(body).hexdigest()[:20]
+    }
+
+def get_now_playing_payload():
+    global now_playing_cache
+    if bus_now_playing is not None and not leader_election.is_leader:
+        return bus_now_playing
+    snapshot = now_playing.snapshot()
+    with now_playing_cache_lock:
+        if now_playing_cache['version'] == snapshot.version:
+            return now_playing_cache
+    payload = now_playing_payload(snapshot.version, build_now_playing(snapshot))
+    with now_playing_cache_lock:
+        if now_playing_cache['version'] is None or now_playing_cache['version'] < snapshot.version:
+            now_playing_cache = payload
+    return payload
+
+def mirror_bus_emit(message):
+    global bus_now_playing
+    # Только общая рассылка track_update; emit одному клиенту (room=sid) пропускаем
+    if message.get('event') != 'track_update' or message.get('room') is not None or leader_election.is_leader:
+        return
+    document = message.get('data')
+    if isinstance(document, list):
+        document = document[0] if document else None
+    if isinstance(document, dict):
+        bus_now_playing = now_playing_payload(document.get('version'), document)
+
+def refresh_now_playing_on_catalog_change(path, track):
+    snapshot = now_playing.snapshot()
+    if path is not None and path not in (snapshot.current.get('filename'), snapshot.next_track):
+        return
+    cached = get_now_playing_payload()['document']
+    if dict(build_now_playing(snapshot), version=cached['version']) != cached:
+        now_playing.touch()
+
+track_catalog.add_listener(refresh_now_playing_on_catalog_change)
+
+# Рассылает track_update с полным документом /now_playing один раз на изменение.
+# Работает как фоновая задача Socket.IO (greenlet под gevent), поэтому emit
+# никогда не вызывается из потоков планировщика или писателя.
+# Рассылает только лидер; ведомый лишь ретранслирует track_update с шины, иначе его устаревшее
+# состояние (touch() после изменения каталога) ушло бы всем клиентам. Задача живёт в каждом процессе:
+# лидерство приходит из потока LeaderElection, а greenlet создаётся в главном потоке.
+def now_playing_broadcaster():
+    last_version = now_playing.snapshot().version
+    while True:
+        socketio.sleep(NOW_PLAYING_BROADCAST_INTERVAL)
+        try:
+            if not leader_election.is_leader:
+                last_version = now_playing.snapshot().version
+                continue
+            if now_playing.snapshot().version == last_version:
+                continue
+            payload = get_now_playing_payload()
+            last_version = payload['version']
+            with broadcast_seconds.time('track_update'):
+                socketio.emit('track_update', payload['document'])
+        except Exception as e:
+            logger.error("Error broadcasting track_update: %s", e)
+
+socketio.start_background_task(now_playing_broadcaster)
+
+@app.route('/now_playing', methods=['GET'])
+def now_playing_endpoint():
+    try:
+        since = request.args.get('since', type=int)
+        if since is not None:
+            timeout = min(request.args.get('timeout', NOW_PLAYING_LONG_POLL_TIMEOUT, type=float), NOW_PLAYING_LONG_POLL_TIMEOUT)
+            deadline = time.time() + timeout
+            # Ждём только пока версия та же; версия из прошлого запуска процесса отвечается сразу
+            while get_now_playing_payload()['version'] == since and time.time() < deadline:
+                socketio.sleep(NOW_PLAYING_LONG_POLL_STEP)
+        payload = get_now_playing_payload()
+        if since is not None and payload['version'] == since:
+            response = Response(status=304)
+        else:
+            response = Response(payload['body'], mimetype='application/json')
+        response.set_etag(payload['etag'])
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.error("Error in now_playing_endpoint: %s", e)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/get_cover_path')
 def get_cover_path_endpoint():
     try:
         cover_path = fetch_cover_path()
         return jsonify({"cover_path": cover_path})
     except Exception as e:
-        logger.error(f"Error in get_cover_path_endpoint: {str(e)}")
+        logger.error("Error in get_cover_path_endpoint: %s", e)
         return jsonify({'cover_path': "/images/placeholder2.png"}), 500
 
+def build_schedule():
+    with db_pool.read() as conn:
+        schedule = [dict(row) for row in conn.execute("SELECT * FROM schedule").fetchall()]
+    return schedule, 200
+
 @app.route('/schedule', methods=['GET'])
 def get_schedule():
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM schedule")
-        schedule = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify(schedule)
+        return response_cache.response('schedule', None, ('schedule',), build_schedule)
     except Exception as e:
         logger.error(f"Error in get_schedule: {str(e)}")
         return jsonify([]), 500
@@ -919,12 +4758,10 @@ def schedule_play():
             scheduled_time = parsed_time.strftime('%Y-%m-%dT%H:%M')
         except ValueError:
             pass  # Если формат уже правильный, оставляем как есть
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO schedule (track_path, start_time, enabled) VALUES (?, ?, 1)",
-                      (track_path, scheduled_time))
-        conn.commit()
-        conn.close()
+        with db_pool.write() as conn:
+            conn.execute("INSERT INTO schedule (track_path, start_time, enabled) VALUES (?, ?, 1)",
+                         (track_path, scheduled_time))
+        schedule_executor.reload()
         logger.info(f"Scheduled radio show {track_path} for {scheduled_time}")
         return jsonify({'success': True})
     except Exception as e:
@@ -934,11 +4771,9 @@ def schedule_play():
 @app.route('/schedule/delete/<int:id>', methods=['DELETE'])
 def delete_schedule(id):
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM schedule WHERE id = ?", (id,))
-        conn.commit()
-        conn.close()
+        with db_pool.write() as conn:
+            conn.execute("DELETE FROM schedule WHERE id = ?", (id,))
+        schedule_executor.reload()
         logger.info(f"Deleted schedule entry with id {id}")
         return jsonify({'success': True})
     except Exception as e:
@@ -958,22 +4793,17 @@ def play_radio_show():
             if current_track == track_path:
                 logger.warning(f"Attempted to play the same track {track_path} twice consecutively")
                 return jsonify({'error': 'Cannot play the same track twice consecutively'}), 400
-            response = liquidsoap_command(f"play_radio_show {track_path}")
-            time.sleep(2)  # Задержка для обработки Liquidsoap
-            logger.info(f"Sent to Liquidsoap: play_radio_show {track_path}, response: {response}")
-            skip_response = skip_normal_queue()
-            logger.info(f"Skipped normal queue after manual show play, response: {skip_response}")
-            artist, title = get_track_metadata(track_path)
-            save_last_played_track(track_path)
-            add_track_to_queue()
-            return jsonify({
-                'success': True,
-                'response': response,
-                'skip_response': skip_response,
-                'track_path': track_path,
-                'artist': artist,
-                'title': title
-            })
+            job = play_radio_show_job(track_path)
+        artist, title = get_track_metadata(track_path)
+        # Команды выполняет секвенсор; результат — в /jobs/<id> и событии job_update
+        return jsonify({
+            'success': True,
+            'job_id': job['id'],
+            'status': job['status'],
+            'track_path': track_path,
+            'artist': artist,
+            'title': title
+        }), 202
     except Exception as e:
         logger.error(f"Error in play_radio_show: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -1010,22 +4840,42 @@ def add_track_to_queue_endpoint():
 def smart_skip_endpoint():
     try:
         logger.info("Received smart_skip request")
-        result = smart_skip()
-        if result["success"]:
-            logger.info("Smart skip executed successfully")
-            return jsonify(result)
-        else:
-            logger.error(f"Smart skip failed: {result['error']}")
-            return jsonify(result), 500
+        job = smart_skip()
+        return jsonify({
+            'success': True,
+            'message': 'Smart skip queued',
+            'job_id': job['id'],
+            'status': job['status'],
+            'coalesced': job['kind'] != 'smart_skip' or job['coalesced'] > 0
+        }), 202
     except Exception as e:
         logger.error(f"Error in smart_skip_endpoint: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    try:
+        return jsonify(control_jobs.recent(request.args.get('limit', 50, type=int)))
+    except Exception as e:
+        logger.error(f"Error in list_jobs: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        job = control_jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+    except Exception as e:
+        logger.error(f"Error in get_job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/skip_track', methods=['POST'])
 def skip_track_endpoint():
     try:
-        response = skip_track()
-        add_track_to_queue()
+        response, = add_track_to_queue(before=["skip_track"])
+        logger.info("Skipped track, response: %s", response)
         return jsonify({'success': True, 'response': response})
     except Exception as e:
         logger.error(f"Error skipping track: {str(e)}")
@@ -1034,16 +4884,25 @@ def skip_track_endpoint():
 @app.route('/play_playlist', methods=['POST'])
 def play_playlist():
     try:
-        response = liquidsoap_command("play_playlist")
-        add_track_to_queue()
+        response, = add_track_to_queue(before=["play_playlist"])
         return jsonify({'success': True, 'response': response})
     except Exception as e:
         logger.error(f"Error in play_playlist: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def stop_http_server(http_server, signum):
+    logger.info(f"Received {signal.Signals(signum).name}, stopping")
+    http_server.stop()
+
 if __name__ == '__main__':
     logger.info("Starting radio player, initializing Flask server...")
+    import gevent
     from gevent.pywsgi import WSGIServer
     from geventwebsocket.handler import WebSocketHandler
-    http_server = WSGIServer(('0.0.0.0', 5001), app, handler_class=WebSocketHandler)
+    http_server = WSGIServer(('0.0.0.0', HTTP_PORT), app, handler_class=WebSocketHandler)
+    # SIGTERM (systemctl stop, cluster.py) и SIGINT не запускают atexit сами по себе: останавливаем
+    # сервер, serve_forever возвращается, и при обычном выходе play_event_writer.stop дописывает
+    # отложенные события воспроизведения
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        gevent.signal_handler(signum, stop_http_server, http_server, signum)
     http_server.serve_forever()
\ No newline at end of file